@@ -0,0 +1,79 @@
+import logging
+
+from tourmap.resources import metadata as app_metadata
+from tourmap.app import app
+from tourmap.resources import db
+
+# need to import to register tables with SQLAlchemy
+import tourmap.models  # noqa: F401  pylint: disable=unused-import
+
+from sqlalchemy.schema import CreateColumn, CreateIndex, Index, Table, MetaData
+from sqlalchemy.schema import UniqueConstraint
+
+logger = logging.getLogger(__name__)
+
+
+def get_engine_from_app():
+    with app.app_context():
+        return db.get_engine()
+
+
+def main():
+    """
+    A hacki'sh script to bring an existing database up to date with
+    the models: Create missing tables, add missing columns and create
+    missing indexes and unique constraints (as unique indexes).
+
+    Columns are added as they are declared, so new columns need to be
+    nullable or have a server_default. Nothing is ever dropped.
+    """
+    logger.info("Start")
+
+    engine = get_engine_from_app()
+    app_metadata.create_all(bind=engine, checkfirst=True)
+
+    # Introspect the DB
+    meta = MetaData()
+    for table_name, app_table in app_metadata.tables.items():
+        table = Table(table_name, meta, autoload=True, autoload_with=engine)
+        logger.info("Loaded table %s", table_name)
+
+        for column in app_table.columns:
+            add_column_if_not_exists(engine, table, column)
+
+        existing_indexes = {i.name for i in table.indexes}
+        existing_indexes.update(c.name for c in table.constraints)
+        for index in app_table.indexes:
+            create_index_if_not_exists(engine, existing_indexes, index)
+
+        for constraint in app_table.constraints:
+            if not isinstance(constraint, UniqueConstraint):
+                continue
+            columns = [table.c[c.name] for c in constraint.columns]
+            index = Index(constraint.name, *columns, unique=True)
+            create_index_if_not_exists(engine, existing_indexes, index)
+
+
+def add_column_if_not_exists(engine, table, column):
+    if column.name in table.columns:
+        return
+
+    stmt = "ALTER TABLE {} ADD COLUMN {}".format(
+        table.name, CreateColumn(column).compile(dialect=engine.dialect)
+    )
+    logger.info("Adding column: %s", stmt)
+    engine.execute(stmt)
+
+
+def create_index_if_not_exists(engine, existing_indexes, index):
+    if index.name in existing_indexes:
+        return
+
+    logger.info("Creating index %s", index.name)
+    engine.execute(CreateIndex(index))
+    existing_indexes.add(index.name)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
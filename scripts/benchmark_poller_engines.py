@@ -0,0 +1,100 @@
+"""
+Benchmark the threads and the asyncio engine of the StravaPoller against
+a local fake Strava server, in users per minute.
+
+    $ PYTHONPATH=. python scripts/benchmark_poller_engines.py --users 500 --latency 0.2
+
+Every user is a latest fetch: listing their activities and fetching the
+photos of new ones. Only the fetching is measured, no database is used.
+"""
+import argparse
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tourmap.strava_poller import ENGINE_ASYNCIO, PollStateData, StravaPoller
+from tourmap.utils.asyncio_executor import AsyncioExecutor
+from tourmap.utils.objpool import ObjectPool
+from tourmap.utils.strava import StravaClient
+from tourmap.utils.strava_async import AsyncStravaClient
+
+from tourmap_test.fake_strava import FakeStrava
+
+logger = logging.getLogger(__name__)
+
+POLL_STATE = PollStateData(
+    full_fetch_completed=True,
+    full_fetch_next_page=None,
+    full_fetch_per_page=None,
+    full_fetch_before=None,
+    # The activities of FakeStrava are all new then.
+    last_fetch_completed_at=datetime.datetime(2019, 1, 2),
+    total_fetches=1,
+)
+
+
+def run(poller, fn, executor, users, in_flight):
+    """
+    Submit a job for every user, keeping at most in_flight running.
+
+    :returns: users per minute.
+    """
+    slots = threading.BoundedSemaphore(in_flight)
+    futures = []
+    start = time.perf_counter()
+    for user_id in range(users):
+        slots.acquire()
+        future = executor.submit(fn, user_id=user_id, access_token="TOKEN",
+                                 poll_state=POLL_STATE)
+        future.add_done_callback(lambda f: slots.release())
+        futures.append(future)
+    for f in futures:
+        f.result()
+    return users / (time.perf_counter() - start) * 60.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="seconds the fake Strava takes per request")
+    parser.add_argument("--activities", type=int, default=2,
+                        help="new activities per user")
+    parser.add_argument("--photos", type=int, default=1,
+                        help="photos per activity")
+    parser.add_argument("--threads", type=int, default=16,
+                        help="jobs in flight with the threads engine")
+    parser.add_argument("--tasks", type=int, default=500,
+                        help="jobs in flight with the asyncio engine")
+    args = parser.parse_args()
+
+    limits = (10 ** 9, 10 ** 9)
+    with FakeStrava(limits=limits, activity_count=args.activities,
+                    photo_count=args.photos, latency=args.latency) as fake_strava:
+        pool = ObjectPool(lambda: StravaClient("-1", "BENCHMARK",
+                                               base_url=fake_strava.base_url))
+        poller = StravaPoller(None, pool)
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            threads = run(poller, poller.fetch_activities, executor, args.users,
+                          args.threads)
+        print("threads  {:4} in flight: {:10.1f} users/min".format(args.threads, threads))
+
+        async_client = AsyncStravaClient("-1", "BENCHMARK", base_url=fake_strava.base_url,
+                                         connection_limit=args.tasks)
+        poller = StravaPoller(None, pool, engine=ENGINE_ASYNCIO,
+                              async_strava_client=async_client)
+        with AsyncioExecutor(on_shutdown=async_client.close) as executor:
+            asyncio_ = run(poller, poller.fetch_activities_async, executor, args.users,
+                           args.tasks)
+        print("asyncio  {:4} in flight: {:10.1f} users/min".format(args.tasks, asyncio_))
+        print("requests served: {}, max in flight: {}".format(
+            fake_strava.served, fake_strava.max_in_flight))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    # Warns about every user missing activities.
+    logging.getLogger("tourmap.strava_poller").setLevel(logging.ERROR)
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark StravaPoller._process_result() on a synthetic page of
+activities, comparing the ORM path with the upsert path.
+
+    $ PYTHONPATH=. python scripts/benchmark_process_result.py --activities 200
+
+Uses a throw-away SQLite database unless --database-url is given. Do not
+point this at a database you care about, all tables are dropped!
+"""
+import argparse
+import copy
+import datetime
+import logging
+import time
+
+import tourmap
+from tourmap.models import PollState, User
+from tourmap.resources import db
+from tourmap.strava_poller import StravaPoller
+
+logger = logging.getLogger(__name__)
+
+CONFIG = {
+    "DATABASE_URL": "sqlite:////tmp/tourmap_benchmark.db",
+    "STRAVA_CLIENT_ID": "-1",
+    "STRAVA_CLIENT_SECRET": "BENCHMARK",
+    "HASHIDS_SALT": "BENCHMARK",
+    "SECRET_KEY": "BENCHMARK",
+    "MAPBOX_ACCESS_TOKEN": "BENCHMARK",
+    "LOG_LEVEL": "WARNING",
+}
+
+
+def make_activity_info(strava_id, with_photos):
+    from tourmap_test.data import activity1_dict, photos2_dict
+    activity = copy.deepcopy(activity1_dict)
+    activity["id"] = strava_id
+    activity["name"] = "Synthetic activity {}".format(strava_id)
+    photos = {}
+    if with_photos:
+        photo = copy.deepcopy(photos2_dict)
+        photo["__tourmap_width"], photo["__tourmap_height"] = 306, 306
+        photos = {256: [photo], 1024: [photo]}
+    return {"activity": activity, "photos": photos}
+
+
+def make_page(first_strava_id, count, name_suffix=""):
+    activity_infos = [
+        make_activity_info(first_strava_id + i, with_photos=i % 4 == 0)
+        for i in range(count)
+    ]
+    for info in activity_infos:
+        info["activity"]["name"] += name_suffix
+    return {
+        "activity_infos": activity_infos,
+        "state_update": {
+            "last_fetch_completed_at": datetime.datetime.utcnow(),
+        },
+    }
+
+
+def run(upsert, activities, rounds):
+    for t in reversed(db.metadata.sorted_tables):
+        db.session.execute(t.delete())
+    user = User(strava_id=1)
+    poll_state = PollState(user=user)
+    db.session.add_all([user, poll_state])
+    db.session.commit()
+
+    poller = StravaPoller(db.session, strava_client_pool=None, upsert=upsert)
+    modes = [("insert", ""), ("update", " (updated)"), ("unchanged", " (updated)")]
+    results = {mode: 0.0 for mode, _ in modes}
+    for r in range(rounds):
+        for mode, name_suffix in modes:
+            page = make_page(first_strava_id=1000000 * (r + 1), count=activities,
+                             name_suffix=name_suffix)
+            start = time.perf_counter()
+            poller._process_result(poll_state, page)
+            results[mode] += time.perf_counter() - start
+
+    return {
+        mode: activities * rounds / elapsed
+        for mode, elapsed in results.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--activities", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--database-url", default=CONFIG["DATABASE_URL"])
+    args = parser.parse_args()
+
+    config = dict(CONFIG, DATABASE_URL=args.database_url)
+    app = tourmap.create_app(config=config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        for name, upsert in [("orm", False), ("upsert", True)]:
+            result = run(upsert, args.activities, args.rounds)
+            print("{:8} {}".format(name, "   ".join(
+                "{}: {:10.1f} rows/sec".format(mode, rate)
+                for mode, rate in result.items()
+            )))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
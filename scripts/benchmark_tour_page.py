@@ -0,0 +1,129 @@
+"""
+Benchmark the tour page and its data.json in requests per second,
+against a temporary sqlite database with a single user and tour.
+
+    $ PYTHONPATH=. python scripts/benchmark_tour_page.py --activities 1000
+
+Requests are logged in, so loading the user from the session is part of
+every request. Static assets are not built (ASSETS_DEBUG). With
+--revisit, requests carry the ETags of the first responses like those of
+a browser that visited the tour before.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import tempfile
+import time
+
+import polyline
+
+import tourmap
+from tourmap.models import Activity, ActivityPhotos, Tour, User
+from tourmap.resources import db
+
+logger = logging.getLogger(__name__)
+
+CONFIG = {
+    "STRAVA_CLIENT_ID": "-1",
+    "STRAVA_CLIENT_SECRET": "BENCHMARK",
+    "HASHIDS_SALT": "BENCHMARK",
+    "HASHIDS_MIN_LENGTH": 8,
+    "SECRET_KEY": "BENCHMARK",
+    "MAPBOX_ACCESS_TOKEN": "BENCHMARK",
+    "ASSETS_DEBUG": True,
+    "LOG_LEVEL": "WARNING",
+}
+
+
+def photos_json(i):
+    return json.dumps({
+        size: [{
+            "unique_id": "{}-{}".format(i, n),
+            "url": "https://example.com/{}/{}/{}.jpg".format(size, i, n),
+            "width": size,
+            "height": size,
+            "caption": None,
+        } for n in range(2)]
+        for size in (100, 2048)
+    })
+
+
+def populate(activity_count, points):
+    user = User(strava_id=1, firstname="Bench", lastname="Mark")
+    tour = Tour(user=user, name="Benchmark Tour", public=True)
+    db.session.add_all([user, tour])
+    start = datetime.datetime(2019, 5, 1)
+    for i in range(activity_count):
+        latlngs = [(47.0 + i * 0.01 + p * 0.001, 8.0 + p * 0.001) for p in range(points)]
+        activity = Activity(
+            user=user,
+            strava_id=1000 + i,
+            type="Ride",
+            name="Activity {}".format(i),
+            distance=50000.0,
+            moving_time=7200,
+            elapsed_time=9000,
+            total_elevation_gain=500.0,
+            start_date=start + datetime.timedelta(hours=i),
+            start_date_local=start + datetime.timedelta(hours=i),
+            utc_offset=0,
+            summary_polyline=polyline.encode(latlngs),
+        )
+        activity.pack_summary_polyline()
+        db.session.add(activity)
+        db.session.add(ActivityPhotos(user=user, activity=activity, data=photos_json(i)))
+    db.session.commit()
+    tour.rebuild_stats()
+    db.session.commit()
+    return user, tour
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--activities", type=int, default=1000)
+    parser.add_argument("--points", type=int, default=100,
+                        help="points of the polyline of each activity")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--revisit", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = dict(CONFIG, DATABASE_URL="sqlite:///{}".format(
+            os.path.join(tmpdir, "benchmark.db")))
+        app = tourmap.create_app(config=config)
+        with app.app_context():
+            db.create_all()
+            user, tour = populate(args.activities, args.points)
+            url = "/users/{}/tours/{}".format(user.hashid, tour.hashid)
+            urls = {"page": url, "data.json": url + "/data.json"}
+            user_hashid = user.hashid
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_id"] = user_hashid
+
+        headers = {}
+        for url in urls.values():
+            etag = client.get(url).headers["ETag"]
+            if args.revisit:
+                headers[url] = {"If-None-Match": etag}
+
+        for name, url in urls.items():
+            start, size = time.perf_counter(), 0
+            for _ in range(args.requests):
+                response = client.get(url, headers=headers.get(url))
+                if response.status_code not in (200, 304):
+                    raise Exception("Got status {}".format(response.status_code))
+                size = len(response.data)
+            elapsed = time.perf_counter() - start
+            print("{} ({} activities): {:.1f} requests/s ({:.1f} ms/request), "
+                  "{} bytes, status {}".format(
+                      name, args.activities, args.requests / elapsed,
+                      elapsed / args.requests * 1000.0, size, response.status_code))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
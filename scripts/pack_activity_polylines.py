@@ -0,0 +1,55 @@
+"""
+Pack the summary polylines of activities stored before packed_latlngs
+existed and rebuild the stats of all tours. Run after
+add_missing_columns_and_indexes.py:
+
+    $ PYTHONPATH=. python scripts/pack_activity_polylines.py
+
+Tours show such activities either way, but unpack them and add up their
+totals on every view.
+"""
+import argparse
+import logging
+
+from tourmap.app import app
+from tourmap.models import Activity, Tour
+from tourmap.resources import db
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    with app.app_context():
+        last_id, total = 0, 0
+        while True:
+            activities = (
+                Activity.query
+                .filter(Activity.id > last_id)
+                .filter(Activity.packed_latlngs.is_(None))
+                .filter(Activity.summary_polyline.isnot(None))
+                .order_by(Activity.id)
+                .limit(args.batch_size)
+                .all()
+            )
+            if not activities:
+                break
+            for activity in activities:
+                activity.pack_summary_polyline()
+            last_id = activities[-1].id
+            db.session.commit()
+            total += len(activities)
+            logger.info("Packed %d activities", total)
+
+        for tour in Tour.query.order_by(Tour.id):
+            tour.rebuild_stats()
+            db.session.commit()
+        logger.info("Rebuilt the stats of %d tours", Tour.query.count())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,72 @@
+"""
+Simulate the StravaPoller on a virtual clock against a synthetic population
+of users, to compare poll intervals and other settings before deploying them.
+
+    $ PYTHONPATH=. python scripts/simulate_poller.py --users 1000 --hours 24 \\
+        --profiles daily=0.3,weekly=0.5,inactive=0.2
+
+Options not listed below are passed to the StravaPoller the same way the
+strava_poller command reads them, from STRAVA_POLLER_* environment variables.
+The database is an in-memory SQLite one.
+"""
+import argparse
+import datetime
+import json
+import logging
+
+import tourmap
+from tourmap.poller_simulation import PROFILES, Simulation
+from tourmap.resources import db
+from tourmap.strava_poller import StravaPoller
+from tourmap.utils.scheduling import parse_class_values
+
+CONFIG = {
+    "DATABASE_URL": "sqlite://",
+    "STRAVA_CLIENT_ID": "-1",
+    "STRAVA_CLIENT_SECRET": "SIMULATION",
+    "HASHIDS_SALT": "SIMULATION",
+    "SECRET_KEY": "SIMULATION",
+    "MAPBOX_ACCESS_TOKEN": "SIMULATION",
+    "LOG_LEVEL": "WARNING",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--hours", type=float, default=24.0,
+                        help="virtual hours to simulate")
+    parser.add_argument("--profiles", type=parse_class_values,
+                        default="daily=0.3,weekly=0.5,inactive=0.2",
+                        help="fractions of users uploading like one of {}".format(
+                            ", ".join(sorted(PROFILES))))
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="mean seconds a request to Strava takes")
+    parser.add_argument("--limits", default="600,30000",
+                        help="requests per 15 minutes and per day")
+    parser.add_argument("--resolution", type=float, default=60.0,
+                        help="seconds the virtual clock moves at least")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = tourmap.create_app(config=CONFIG)
+    with app.app_context():
+        db.create_all()
+        poller_kwargs = StravaPoller.config_kwargs_from_env()
+        # Threads are not simulated.
+        for key in ["writer_batch_size", "token_refresh_interval_seconds", "engine"]:
+            poller_kwargs.pop(key)
+        simulation = Simulation(
+            db.session, users=args.users, profiles=args.profiles,
+            latency=args.latency,
+            limits=tuple(int(limit) for limit in args.limits.split(",")),
+            resolution=args.resolution, seed=args.seed, **poller_kwargs)
+        report = simulation.run(datetime.timedelta(hours=args.hours))
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    # Logs every job.
+    logging.getLogger("tourmap").setLevel(logging.ERROR)
+    main()
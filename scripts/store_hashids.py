@@ -0,0 +1,53 @@
+"""
+Store the hashids of users, tours and activities inserted before the
+hashid columns existed. Run after add_missing_columns_and_indexes.py:
+
+    $ PYTHONPATH=. python scripts/store_hashids.py
+
+After changing HASHIDS_SALT or HASHIDS_MIN_LENGTH, run it with --all to
+replace the stored hashids, too.
+"""
+import argparse
+import logging
+
+from tourmap.app import app
+from tourmap.models import Activity, Tour, User
+from tourmap.resources import db
+
+logger = logging.getLogger(__name__)
+
+
+def store_hashids(cls, batch_size, replace):
+    hashids = cls.get_Hashids()
+    last_id, total = 0, 0
+    while True:
+        query = db.session.query(cls.id).filter(cls.id > last_id)
+        if not replace:
+            query = query.filter(cls._hashid.is_(None))
+        ids = [id for id, in query.order_by(cls.id).limit(batch_size)]
+        if not ids:
+            break
+        db.session.bulk_update_mappings(cls, [
+            {"id": id, "_hashid": hashids.encode(id)} for id in ids
+        ])
+        db.session.commit()
+        last_id = ids[-1]
+        total += len(ids)
+        logger.info("Stored %d hashids of %s", total, cls.__tablename__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--all", action="store_true",
+                        help="replace hashids that are stored already")
+    args = parser.parse_args()
+
+    with app.app_context():
+        for cls in [User, Tour, Activity]:
+            store_hashids(cls, args.batch_size, args.all)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -61,11 +61,13 @@ def create_app(config=None):
     assets.register(bundles)
 
     # Install a few views...
-    from tourmap.views import activities, index, strava, tours, users
+    from tourmap.views import activities, index, strava, strava_webhook, tours, users
     app.register_blueprint(activities.create_user_activities_blueprint(app),
                            url_prefix="/users/<user_hashid>")
     app.register_blueprint(index.create_blueprint(app))
     app.register_blueprint(strava.create_blueprint(app), url_prefix="/strava")
+    app.register_blueprint(strava_webhook.create_blueprint(app),
+                           url_prefix="/strava/webhook")
     app.register_blueprint(users.create_user_blueprint(app), url_prefix="/users")
     app.register_blueprint(users.create_user_tours_blueprint(app),
                            url_prefix="/users/<user_hashid>")
@@ -74,9 +76,12 @@ def create_app(config=None):
     @app.after_request
     def add_cache_headers(response):
         """
-        Make sure we cache static files, but nothing else.
+        Make sure we cache static files, but nothing else, unless a
+        view set Cache-Control itself (tour pages).
         """
         # https://stackoverflow.com/a/2068407
+        if "Cache-Control" in response.headers:
+            return response
         if not request.path.startswith(app.static_url_path):
             response.cache_control.max_age = 0
             response.cache_control.no_cache = True
@@ -112,6 +117,9 @@ def create_app(config=None):
         strava_poller = StravaPoller(
             session=db.session,
             strava_client_pool=strava._pool,
+            rate_limiter=strava._rate_limiter,
+            circuit_breaker=strava._circuit_breaker,
+            metrics=strava._metrics,
             **kwargs,
         )
         import IPython
@@ -129,9 +137,21 @@ def create_app(config=None):
             configure_logging(app)
 
         kwargs = strava_poller.StravaPoller.config_kwargs_from_env(environ=app.config)
+        if kwargs["engine"] == strava_poller.ENGINE_ASYNCIO:
+            from tourmap.utils.strava_async import AsyncStravaClient
+            kwargs["async_strava_client"] = AsyncStravaClient.from_env(
+                environ=app.config,
+                rate_limiter=strava._rate_limiter,
+                circuit_breaker=strava._circuit_breaker,
+                metrics=strava._metrics,
+                connection_limit=kwargs["asyncio_max_concurrency"],
+            )
         strava_poller = strava_poller.StravaPoller(
             session=db.session,
             strava_client_pool=strava._pool,
+            rate_limiter=strava._rate_limiter,
+            circuit_breaker=strava._circuit_breaker,
+            metrics=strava._metrics,
             **kwargs,
         )
         try:
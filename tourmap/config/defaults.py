@@ -8,6 +8,40 @@ APP_NAME = "tourmap"
 STRAVA_OAUTH_AUTHORIZE_URL = "https://www.strava.com/oauth/authorize"
 STRAVA_OAUTH_TOKEN_URL = "https://www.strava.com/oauth/token"
 
+# Strava's rate limits for the 15 minute and daily window. These are
+# corrected from the X-RateLimit-* headers of responses. The reserve is
+# the fraction of each window the poller leaves unused.
+STRAVA_CLIENT_RATE_LIMITS = "100,1000"
+STRAVA_CLIENT_RATE_LIMIT_RESERVE = 0.05
+
+# API requests failing with a timeout, a connection error or a 5xx are
+# retried with exponential backoff and jitter. After a number of failed
+# requests in a row, requests are refused for a while (circuit breaker).
+STRAVA_CLIENT_RETRIES = 2
+STRAVA_CLIENT_RETRY_BACKOFF_SECONDS = 0.5
+STRAVA_CLIENT_RETRY_BACKOFF_MAX_SECONDS = 8.0
+STRAVA_CLIENT_BREAKER_FAILURE_THRESHOLD = 10
+STRAVA_CLIENT_BREAKER_OPEN_SECONDS = 60.0
+
+# At most this many StravaClient objects are pooled, 0 for no limit. They
+# share one pool of connections to Strava, keeping this many alive. A
+# request waiting longer for a client is answered with a 503.
+STRAVA_CLIENT_POOL_SIZE = 32
+STRAVA_CLIENT_POOL_TIMEOUT_SECONDS = 5.0
+STRAVA_CLIENT_HTTP_POOL_MAXSIZE = 32
+
+# Record Strava's responses to a cassette file or replay them from it
+# instead of talking to Strava, see tourmap.utils.cassette.
+STRAVA_CLIENT_CASSETTE = None
+STRAVA_CLIENT_CASSETTE_MODE = "replay"
+STRAVA_CLIENT_CASSETTE_LATENCY = 0.0
+
+# Strava webhook push subscription. The verify token is the one passed
+# when creating the subscription, without one the endpoint is disabled.
+# Events of other subscriptions are rejected if the id is set.
+STRAVA_WEBHOOK_VERIFY_TOKEN = None
+STRAVA_WEBHOOK_SUBSCRIPTION_ID = None
+
 HASHIDS_MIN_LENGTH = 8
 
 # New default for Flask-SQLAlchemy
@@ -1,7 +1,8 @@
 import logging
 
 from flask import current_app, url_for
-from tourmap.utils import meters_to_distance_str, seconds_to_readable_interval
+from tourmap.models import Activity, ActivityPhotos, TourStats
+from tourmap.utils import geometry, meters_to_distance_str, seconds_to_readable_interval
 
 
 logger = logging.getLogger(__name__)
@@ -24,20 +25,22 @@ class TourController(object):
 
     def _prepare_photos(self, activity):
         """
-        Create a list of activities to be displayed by the UI.
+        Create a list of photos of an activity loaded by
+        _load_activities() to be displayed by the UI.
         """
         result = []
 
-        if not activity.photos:
+        if not activity.photos_data:
             return result
 
-        photos = activity.photos.get_photos()
+        photos = ActivityPhotos.parse_data(activity.photos_data)
         keys = list(photos.keys())
         if not keys:
             return result
 
         if len(keys) != 2:
-            logger.warning("Got weird sizes %s for %s", repr(keys), activity)
+            logger.warning("Got weird sizes %s for activity %s", repr(keys),
+                           activity.strava_id)
 
         large = max(keys)
         small = min(keys)
@@ -50,64 +53,119 @@ class TourController(object):
             result.append(pdict)
         return result
 
+    def _load_activities(self, tour):
+        """
+        Load the columns of the activities of a tour the map needs,
+        together with their photos, in a single query.
+        """
+        return (
+            tour.activities
+            .outerjoin(ActivityPhotos, ActivityPhotos.activity_id == Activity.id)
+            .with_entities(
+                Activity.id,
+                Activity._hashid.label("hashid"),
+                Activity.strava_id,
+                Activity.name,
+                Activity.start_date_local,
+                Activity.distance,
+                Activity.elapsed_time,
+                Activity.moving_time,
+                Activity.summary_polyline,
+                Activity.packed_latlngs,
+                Activity.point_count,
+                Activity.min_lat,
+                Activity.min_lng,
+                Activity.max_lat,
+                Activity.max_lng,
+                ActivityPhotos.data.label("photos_data"),
+            )
+            .all()
+        )
+
+    def _packed_geometry(self, activity):
+        """
+        The packed polyline and bounding box of an activity loaded by
+        _load_activities(), packed right here if that was not done when
+        it was stored.
+        """
+        if activity.packed_latlngs is None:
+            return geometry.pack_polyline(activity.summary_polyline)
+        return {
+            "packed_latlngs": activity.packed_latlngs,
+            "point_count": activity.point_count,
+            "min_lat": activity.min_lat,
+            "min_lng": activity.min_lng,
+            "max_lat": activity.max_lat,
+            "max_lng": activity.max_lng,
+        }
+
+    def _tour_stats(self, tour):
+        """
+        The TourStats of a tour, aggregated right here without storing
+        them if the tour has none yet.
+        """
+        if tour.stats is not None:
+            return tour.stats
+        return TourStats(**TourStats.compute(tour))
+
     def prepare_activities_for_map(self, tour):
         """
-        Prepare activity data to be displayed on a map.
+        Prepare activity data to be displayed on a map. Polylines are
+        passed on packed (tourmap.utils.geometry), the browser unpacks
+        them. Totals come from the TourStats of the tour.
         """
         activities = []
-        total_distance = 0
-        total_elevation_gain = 0
-        total_moving_time = 0
-        for a in tour.activities:
-            latlngs = list(a.latlngs)
-            if not latlngs:
+        user_hashid = tour.user.hashid
+        activity_hashids = Activity.get_Hashids()
+        for a in self._load_activities(tour):
+            packed = self._packed_geometry(a)
+            if not packed["point_count"]:
                 continue
 
             photos = self._prepare_photos(a)
+            activity_hashid = a.hashid or activity_hashids.encode(a.id)
             activities.append({
                 "name": a.name,
                 "strava_id": str(a.strava_id),
                 "date": a.start_date_local.date().isoformat(),
-                "distance_str": a.distance_str,
-                "elapsed_time_str": a.elapsed_time_str,
-                "moving_time_str": a.moving_time_str,
-                "strava_link": a.strava_link,
+                "distance_str": meters_to_distance_str(a.distance),
+                "elapsed_time_str": seconds_to_readable_interval(a.elapsed_time),
+                "moving_time_str": seconds_to_readable_interval(a.moving_time),
+                "strava_link": Activity.strava_link_for(a.strava_id),
                 "summary_gpx_link": url_for("user_activities.summary_gpx",
-                                            user_hashid=a.user.hashid,
-                                            activity_hashid=a.hashid),
-                "latlngs": latlngs,
+                                            user_hashid=user_hashid,
+                                            activity_hashid=activity_hashid),
+                "packed_latlngs": geometry.packed_to_base64(packed["packed_latlngs"]),
+                "bounds": [
+                    (packed["min_lat"], packed["min_lng"]),
+                    (packed["max_lat"], packed["max_lng"]),
+                ],
                 "photos": photos,
             })
-            total_distance += (a.distance or 0)
-            total_elevation_gain += (a.total_elevation_gain or 0)
-            total_moving_time += (a.moving_time or 0)
 
+        stats = self._tour_stats(tour)
         return {
             "activities": activities,
             "totals": {
-                "distance_str": meters_to_distance_str(total_distance),
-                "moving_time_str": seconds_to_readable_interval(total_moving_time),
-                "elevation_gain_str": "{:.1f} m".format(total_elevation_gain),
+                "distance_str": meters_to_distance_str(stats.total_distance),
+                "moving_time_str": seconds_to_readable_interval(stats.total_moving_time),
+                "elevation_gain_str": "{:.1f} m".format(stats.total_elevation_gain),
             }
         }
 
     def _find_bounds(self, prepared_activities):
         """
-        Helper to find corner1 and corner2 values
-
-        TODO: Put this into prepare_activities_for_map() and store it there.
+        Helper to find corner1 and corner2 values from the bounds of
+        the prepared activities.
         """
         lat_min, lat_max = (90, -90)
         lng_min, lng_max = (180, -180)
         for a in prepared_activities:
-            if not a["latlngs"]:
-                continue
-
-            latlngs = a["latlngs"]
-            lat_min = min(lat_min, min([ll[0] for ll in latlngs]))
-            lat_max = max(lat_max, max([ll[0] for ll in latlngs]))
-            lng_min = min(lng_min, min([ll[1] for ll in latlngs]))
-            lng_max = max(lng_max, max([ll[1] for ll in latlngs]))
+            (a_lat_min, a_lng_min), (a_lat_max, a_lng_max) = a["bounds"]
+            lat_min = min(lat_min, a_lat_min)
+            lat_max = max(lat_max, a_lat_max)
+            lng_min = min(lng_min, a_lng_min)
+            lng_max = max(lng_max, a_lng_max)
 
         return [(lat_min, lng_min), (lat_max, lng_max)]
 
@@ -132,7 +190,8 @@ class TourController(object):
                 "id": tile_layer_id,
             }
         }
-        corner1, corner2 = self._find_bounds(prepared_activities)
+        bounds = tour.stats.bounds if tour.stats is not None else None
+        corner1, corner2 = bounds or self._find_bounds(prepared_activities)
         result["bounds"] = {
             "corner1": corner1,
             "corner2": corner2,
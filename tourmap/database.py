@@ -1 +1,69 @@
+import sqlalchemy
 from sqlalchemy.exc import IntegrityError  # pylint: disable=unused-import
+
+
+def supports_upsert(session):
+    """
+    Check if the database behind session understands
+    INSERT ... ON CONFLICT ... DO UPDATE.
+
+    Both, Postgres (9.5+) and SQLite (3.24+) use the same syntax.
+    """
+    dialect = session.get_bind().dialect
+    if dialect.name == "postgresql":
+        return (dialect.server_version_info or (0,)) >= (9, 5)
+    if dialect.name == "sqlite":
+        return dialect.dbapi.sqlite_version_info >= (3, 24, 0)
+    return False
+
+
+def supports_skip_locked(session):
+    """
+    Check if the database behind session understands
+    SELECT ... FOR UPDATE SKIP LOCKED (Postgres 9.5+).
+    """
+    dialect = session.get_bind().dialect
+    if dialect.name == "postgresql":
+        return (dialect.server_version_info or (0,)) >= (9, 5)
+    return False
+
+
+def upsert(session, table, rows, index_elements, update_columns=None):
+    """
+    Insert rows into table, updating existing rows that conflict
+    on index_elements. Runs as a single executemany() in the
+    transaction of session.
+
+    Note: SQLAlchemy 1.3 only provides on_conflict_do_update() for
+    Postgres, so the statement is put together by hand here.
+
+    :param rows: list of dicts, all with the same keys.
+    :param index_elements: columns of a unique constraint or index.
+    :param update_columns: columns to update on conflict, defaults to
+        all columns in rows that are not part of index_elements.
+    """
+    if not rows:
+        return
+
+    preparer = session.get_bind().dialect.identifier_preparer
+    columns = list(rows[0].keys())
+    if update_columns is None:
+        update_columns = [c for c in columns if c not in index_elements]
+
+    stmt = (
+        "INSERT INTO {table} ({columns}) VALUES ({values}) ON CONFLICT ({index})"
+    ).format(
+        table=preparer.format_table(table),
+        columns=", ".join(preparer.quote(c) for c in columns),
+        values=", ".join(":{}".format(c) for c in columns),
+        index=", ".join(preparer.quote(c) for c in index_elements),
+    )
+    if update_columns:
+        stmt += " DO UPDATE SET {}".format(", ".join(
+            "{0} = excluded.{0}".format(preparer.quote(c)) for c in update_columns
+        ))
+    else:
+        stmt += " DO NOTHING"
+
+    bindparams = [sqlalchemy.bindparam(c, type_=table.c[c].type) for c in columns]
+    session.execute(sqlalchemy.text(stmt).bindparams(*bindparams), rows)
@@ -4,15 +4,26 @@ Flask-Strava
 Providing the StravaClient in the form of a flask extension to any application.
 """
 import tourmap.utils.strava
-from tourmap.utils.objpool import ObjectPool
+from tourmap.utils import cassette
+from tourmap.utils.httpadapter import PooledHTTPAdapter
+from tourmap.utils.metrics import Metrics
+from tourmap.utils.objpool import Empty, ObjectPool
+from tourmap.utils.ratelimit import RateLimiter
+from tourmap.utils.retry import CircuitBreaker
 
-from flask import _app_ctx_stack as stack, current_app
+from flask import _app_ctx_stack as stack, abort, current_app
 
 
 class StravaState(object):
 
-    def __init__(self, cfn):
-        self.pool = ObjectPool(cfn=cfn)
+    def __init__(self, cfn, maxsize=0, timeout=None, rate_limiter=None,
+                 circuit_breaker=None, metrics=None, adapter=None):
+        self.pool = ObjectPool(cfn=cfn, maxsize=maxsize)
+        self.timeout = timeout
+        self.adapter = adapter
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.metrics = metrics
 
 
 class StravaClient(object):
@@ -26,11 +37,36 @@ class StravaClient(object):
         assert app.config["STRAVA_CLIENT_ID"], "STRAVA_CLIENT_ID not configured"
         assert app.config["STRAVA_CLIENT_SECRET"], "STRAVA_CLIENT_SECRET not configured"
 
-        # This extension creates a pool of StravaClient objects
+        # This extension creates a pool of up to STRAVA_CLIENT_POOL_SIZE
+        # StravaClient objects, all of them drawing from the same rate
+        # limit budget, behind the same circuit breaker, counting retries
+        # in the same metrics and sending requests through the same
+        # adapter and so the same kept-alive connections.
+        metrics = Metrics()
+        rate_limiter = RateLimiter.from_env(environ=app.config)
+        circuit_breaker = CircuitBreaker.from_env(environ=app.config, metrics=metrics)
+        adapter = cassette.adapter_from_env(app.config)
+        if adapter is None:
+            adapter = PooledHTTPAdapter.from_env(app.config, metrics=metrics)
+
         def _make_strava_client():
-            return tourmap.utils.strava.StravaClient.from_env(environ=app.config)
+            return tourmap.utils.strava.StravaClient.from_env(
+                environ=app.config,
+                rate_limiter=rate_limiter,
+                circuit_breaker=circuit_breaker,
+                metrics=metrics,
+                adapter=adapter,
+            )
 
-        app.extensions["strava_client"] = StravaState(_make_strava_client)
+        app.extensions["strava_client"] = StravaState(
+            _make_strava_client,
+            maxsize=int(app.config.get("STRAVA_CLIENT_POOL_SIZE", 0)),
+            timeout=float(app.config.get("STRAVA_CLIENT_POOL_TIMEOUT_SECONDS", 5.0)),
+            rate_limiter=rate_limiter,
+            circuit_breaker=circuit_breaker,
+            metrics=metrics,
+            adapter=adapter,
+        )
 
         # Register teardown function
         app.teardown_appcontext(self.teardown)
@@ -45,13 +81,49 @@ class StravaClient(object):
     def client(self):
         """
         Lazily get a StravaClient from the pool and set it on the context.
+
+        Aborts with 503 if all clients stay in use for
+        STRAVA_CLIENT_POOL_TIMEOUT_SECONDS, rather than blocking the
+        worker for good.
         """
         ctx = stack.top
         if ctx is not None:
             if not hasattr(ctx, 'strava_client'):
-                ctx.strava_client = self._pool.get()
+                state = current_app.extensions["strava_client"]
+                try:
+                    ctx.strava_client = self._pool.get(timeout=state.timeout)
+                except Empty:
+                    state.metrics.incr("pool_timeouts")
+                    abort(503)
             return ctx.strava_client
 
+    @property
+    def _rate_limiter(self):
+        """
+        Return a reference to the rate limiter shared by all pooled clients.
+        """
+        assert "strava_client" in current_app.extensions, (
+            "Looks like the flask_strava extension was not initialized.")
+        return current_app.extensions["strava_client"].rate_limiter
+
+    @property
+    def _circuit_breaker(self):
+        """
+        Return a reference to the circuit breaker shared by all pooled clients.
+        """
+        assert "strava_client" in current_app.extensions, (
+            "Looks like the flask_strava extension was not initialized.")
+        return current_app.extensions["strava_client"].circuit_breaker
+
+    @property
+    def _metrics(self):
+        """
+        Return a reference to the metrics of the pooled clients.
+        """
+        assert "strava_client" in current_app.extensions, (
+            "Looks like the flask_strava extension was not initialized.")
+        return current_app.extensions["strava_client"].metrics
+
     @property
     def _pool(self):
         """
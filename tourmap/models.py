@@ -1,36 +1,86 @@
 import datetime
+import functools
 
 import dateutil.parser
 import hashids
 import polyline
 
+from sqlalchemy import event
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.schema import Index, UniqueConstraint
 
 from tourmap.resources import db
-from tourmap.utils import meters_to_distance_str, seconds_to_readable_interval
-from tourmap.utils import json
+from tourmap.utils import (
+    content_hash,
+    meters_to_distance_str,
+    seconds_to_readable_interval,
+)
+from tourmap.utils import geometry, json
+
+
+@functools.lru_cache(maxsize=None)
+def _get_Hashids(salt, min_length):
+    # Creating a Hashids instance shuffles its alphabet by the salt,
+    # which is expensive. Encoding and decoding does not change it.
+    return hashids.Hashids(salt, min_length=min_length)
 
 
 class HashidMixin(object):
+    """
+    Hashids of rows are stored in the hashid column once they were
+    inserted, so building URLs needs no encoding and rows are looked up
+    by its index. Rows stored before that column existed, or inserted
+    without the ORM, are encoded and decoded on the fly
+    (scripts/store_hashids.py fills them in). The stored values depend
+    on HASHIDS_SALT and HASHIDS_MIN_LENGTH.
+    """
+
+    @declared_attr
+    def _hashid(cls):
+        return db.Column("hashid", db.String(32), index=True, unique=True)
 
     @classmethod
-    def __get_Hashids(cls):
+    def get_Hashids(cls):
+        """
+        The Hashids instance for ids of this class. Use it directly
+        to encode many ids at once.
+        """
         from flask import current_app
         salt = current_app.config["HASHIDS_SALT"]
         salt = "{}{}".format(cls.__name__, salt)
         min_length = current_app.config["HASHIDS_MIN_LENGTH"]
-        return hashids.Hashids(salt, min_length=min_length)
+        return _get_Hashids(salt, min_length)
 
     @classmethod
     def get_by_hashid(cls, hashid):
-        id = cls.__get_Hashids().decode(hashid)
+        obj = cls.query.filter(cls._hashid == hashid).one_or_none()
+        if obj is not None:
+            return obj
+        # Not stored yet, or no hashid at all.
+        id = cls.get_Hashids().decode(hashid)
         if len(id) != 1:
             return None
-        return cls.query.get(id[0])
+        obj = cls.query.get(id[0])
+        if obj is None or obj._hashid is not None:
+            return None
+        return obj
 
     @property
     def hashid(self):
-        return self.__get_Hashids().encode(self.id)
+        if self._hashid is not None:
+            return self._hashid
+        return self.get_Hashids().encode(self.id)
+
+
+@event.listens_for(HashidMixin, "after_insert", propagate=True)
+def _store_hashid(mapper, connection, target):
+    hashid = target.get_Hashids().encode(target.id)
+    table = mapper.local_table
+    connection.execute(
+        table.update().where(table.c.id == target.id).values(hashid=hashid)
+    )
+    set_committed_value(target, "_hashid", hashid)
 
 
 class User(db.Model, HashidMixin):
@@ -90,6 +140,36 @@ class Tour(db.Model, HashidMixin):
             query = query.filter(Activity.start_date <= self.end_date)
         return query
 
+    def covers(self, date):
+        """
+        True if activities started at date belong to this tour.
+        """
+        if self.start_date and date < self.start_date:
+            return False
+        if self.end_date and date > self.end_date:
+            return False
+        return True
+
+    def rebuild_stats(self):
+        """
+        Recompute the TourStats of this tour, e.g. after its date range
+        or the activities in it changed.
+
+        The version is incremented by the UPDATE itself, so concurrent
+        rebuilds each count.
+        """
+        values = TourStats.compute(self)
+        values["updated_at"] = datetime.datetime.utcnow()
+        if self.stats is None:
+            self.stats = TourStats(version=1, **values)
+            return self.stats
+        values["version"] = TourStats.version + 1
+        (TourStats.query
+         .filter(TourStats.tour_id == self.id)
+         .update(values, synchronize_session=False))
+        db.session.expire(self.stats)
+        return self.stats
+
     @property
     def start_date_str(self):
         return self.start_date.date().isoformat() if self.start_date is not None else ""
@@ -105,7 +185,8 @@ class Tour(db.Model, HashidMixin):
             name="All Activities",
             marker_positioning="middle",
             marker_enable_clusters=True,
-            description="Automatically created."
+            description="Automatically created.",
+            stats=TourStats(version=1),
         )
 
     @staticmethod
@@ -146,8 +227,22 @@ class Activity(db.Model, HashidMixin):
     end_lng = db.Column(db.Float)
     summary_polyline = db.Column(db.Text)
 
+    # summary_polyline decoded when stored, see tourmap.utils.geometry.
+    packed_latlngs = db.Column(db.LargeBinary)
+    point_count = db.Column(db.Integer)
+    min_lat = db.Column(db.Float)
+    min_lng = db.Column(db.Float)
+    max_lat = db.Column(db.Float)
+    max_lng = db.Column(db.Float)
+
     total_photo_count = db.Column(db.Integer)
 
+    # Hash over the values from values_from_strava() to detect changes.
+    content_hash = db.Column(db.String(40))
+
+    # Set if the photos of this activity still need to be fetched.
+    photos_pending = db.Column(db.Boolean(name="photos_pending"), index=True)
+
     user = db.relationship(User)
 
     @property
@@ -185,7 +280,11 @@ class Activity(db.Model, HashidMixin):
         """
         Hackish...
         """
-        return "https://www.strava.com/activities/{}".format(self.strava_id)
+        return self.strava_link_for(self.strava_id)
+
+    @staticmethod
+    def strava_link_for(strava_id):
+        return "https://www.strava.com/activities/{}".format(strava_id)
 
     def update_from_strava(self, src):
         """
@@ -194,9 +293,30 @@ class Activity(db.Model, HashidMixin):
         assert self.strava_id == src["id"], (
             "Wrong activity?! {} != {}".format(self.strava_id, src["id"])
         )
-        self.external_id = src["external_id"]
-        self.type = src["type"]
-        self.name = src.get("name", "")
+        for k, v in self.values_from_strava(src).items():
+            setattr(self, k, v)
+        self.pack_summary_polyline()
+
+    def pack_summary_polyline(self):
+        """
+        Set packed_latlngs, point_count and the bounding box from
+        summary_polyline.
+        """
+        for k, v in geometry.pack_polyline(self.summary_polyline).items():
+            setattr(self, k, v)
+
+    @staticmethod
+    def values_from_strava(src):
+        """
+        Convert a dict as provided by the Strava API into a dict of
+        column values with condition checks.
+        """
+        values = {
+            "strava_id": src["id"],
+            "external_id": src["external_id"],
+            "type": src["type"],
+            "name": src.get("name", ""),
+        }
 
         # Unify this to a single method!
         start_date = dateutil.parser.parse(src["start_date"])
@@ -204,7 +324,7 @@ class Activity(db.Model, HashidMixin):
             if start_date.utcoffset().seconds != 0:
                 raise Exception("Non UTC date parsed! {!r}".format(src["start_date"]))
         start_date = start_date.replace(tzinfo=None)
-        self.start_date = start_date
+        values["start_date"] = start_date
 
         start_date_local = dateutil.parser.parse(src["start_date_local"])
         if start_date_local.tzinfo is not None:
@@ -213,42 +333,60 @@ class Activity(db.Model, HashidMixin):
                 raise Exception(msg)
 
         start_date_local = start_date_local.replace(tzinfo=None)
-        self.start_date_local = start_date_local
+        values["start_date_local"] = start_date_local
 
-        self.utc_offset = int(src["utc_offset"])
-        self.timezone = src["timezone"]
+        values["utc_offset"] = int(src["utc_offset"])
+        values["timezone"] = src["timezone"]
 
         summary_polyline = src.get("map", {}).get("summary_polyline")
-        self.summary_polyline = summary_polyline
+        values["summary_polyline"] = summary_polyline
 
         # XXX: We should probably just do a loop...
         start_latlng = src.get("start_latlng", [None, None]) or [None, None]
-        self.start_lat, self.start_lng = start_latlng[0], start_latlng[1]
+        values["start_lat"], values["start_lng"] = start_latlng[0], start_latlng[1]
         end_latlng = src.get("end_latlng", [None, None]) or [None, None]
-        self.end_lat, self.end_lng = end_latlng[0], end_latlng[1]
-        self.distance = src.get("distance")
-        self.moving_time = src.get("moving_time")
-        self.elapsed_time = src.get("elapsed_time")
-        self.total_elevation_gain = src.get("total_elevation_gain")
-        self.average_temp = src.get("average_temp")
-        self.total_photo_count = src.get("total_photo_count", 0)
+        values["end_lat"], values["end_lng"] = end_latlng[0], end_latlng[1]
+        values["distance"] = src.get("distance")
+        values["moving_time"] = src.get("moving_time")
+        values["elapsed_time"] = src.get("elapsed_time")
+        values["total_elevation_gain"] = src.get("total_elevation_gain")
+        values["average_temp"] = src.get("average_temp")
+        values["total_photo_count"] = src.get("total_photo_count", 0)
+        values["content_hash"] = content_hash(values)
+        return values
+
+    # Tours and the poller look at the activities of a user by date.
+    __table_args__ = (
+        Index("ix_activities_user_id_start_date", "user_id", "start_date"),
+    )
 
 
 class ActivityPhotos(db.Model):
     __tablename__ = "activity_photos"
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    activity_id = db.Column(db.Integer, db.ForeignKey("activities.id"), nullable=False)
+    # Unique so that the poller can upsert on it.
+    activity_id = db.Column(db.Integer, db.ForeignKey("activities.id"), nullable=False,
+                            unique=True)
 
     # A JSON map with sizes to lists of photos. Each photo is a map with
     # "width", "height", "url", "caption"
     data = db.Column(db.TEXT, nullable=False)
+    # Hash over data to detect changes.
+    content_hash = db.Column(db.String(40))
     user = db.relationship(User)
     activity = db.relationship(Activity)
 
+    def set_data(self, data):
+        self.data = data
+        self.content_hash = content_hash(data)
+
     def get_photos(self):
-        data = json.loads(self.data)
-        return {int(size): photos for (size, photos) in data.items()}
+        return self.parse_data(self.data)
+
+    @staticmethod
+    def parse_data(data):
+        return {int(size): photos for (size, photos) in json.loads(data).items()}
 
 
 Activity.photos = db.relationship(ActivityPhotos, order_by=ActivityPhotos.id,
@@ -257,6 +395,77 @@ User.activities = db.relationship(Activity,
                                   order_by=Activity.start_date_local.desc())
 
 
+class TourStats(db.Model):
+    """
+    Totals and bounds of the activities shown on the map of a tour, so
+    viewing it does not need to add them up. Rebuilt by the poller when
+    activities in the date range of the tour change and when the tour is
+    edited, version counts the rebuilds.
+    """
+    __tablename__ = "tour_stats"
+    tour_id = db.Column(db.Integer, db.ForeignKey("tours.id"), primary_key=True)
+    activity_count = db.Column(db.Integer, nullable=False, default=0)
+    total_distance = db.Column(db.Float, nullable=False, default=0)
+    total_elevation_gain = db.Column(db.Float, nullable=False, default=0)
+    total_moving_time = db.Column(db.Integer, nullable=False, default=0)
+    min_lat = db.Column(db.Float)
+    min_lng = db.Column(db.Float)
+    max_lat = db.Column(db.Float)
+    max_lng = db.Column(db.Float)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+    @property
+    def bounds(self):
+        """
+        [(min_lat, min_lng), (max_lat, max_lng)], None if no activity
+        has a bounding box.
+        """
+        if self.min_lat is None:
+            return None
+        return [(self.min_lat, self.min_lng), (self.max_lat, self.max_lng)]
+
+    @staticmethod
+    def compute(tour):
+        """
+        Aggregate the activities of tour with a single query. Only
+        activities with points count, like on the map. Activities not
+        packed yet have no bounding box and are assumed to have points.
+
+        :returns: dict of column values.
+        """
+        query = (
+            tour.activities
+            .filter(Activity.summary_polyline != "")
+            .filter(db.func.coalesce(Activity.point_count, 1) > 0)
+            .with_entities(
+                db.func.count(Activity.id),
+                db.func.sum(Activity.distance),
+                db.func.sum(Activity.total_elevation_gain),
+                db.func.sum(Activity.moving_time),
+                db.func.min(Activity.min_lat),
+                db.func.min(Activity.min_lng),
+                db.func.max(Activity.max_lat),
+                db.func.max(Activity.max_lng),
+            )
+        )
+        (count, distance, elevation_gain, moving_time,
+         min_lat, min_lng, max_lat, max_lng) = query.one()
+        return {
+            "activity_count": count,
+            "total_distance": distance or 0,
+            "total_elevation_gain": elevation_gain or 0,
+            "total_moving_time": moving_time or 0,
+            "min_lat": min_lat,
+            "min_lng": min_lng,
+            "max_lat": max_lat,
+            "max_lng": max_lng,
+        }
+
+
+Tour.stats = db.relationship(TourStats, uselist=False, cascade="all, delete-orphan")
+
+
 class Token(db.Model):
     __tablename__ = "tokens"
     id = db.Column(db.Integer, primary_key=True)
@@ -268,14 +477,21 @@ class Token(db.Model):
 
     user = db.relationship(User, backref=db.backref("token", uselist=False))
 
-    def should_refresh(self):
+    # Strava tokens are refreshed this long before they expire.
+    REFRESH_MARGIN = datetime.timedelta(seconds=45 * 60)
+    # Strava only hands out a new access token once the old one expires
+    # within this time, else the same one again.
+    REFRESH_WINDOW = datetime.timedelta(hours=1)
+
+    def should_refresh(self, now=None):
         """
         Very strava specific...
         """
         if not self.refresh_token or self.expires_at is None:
             return True
 
-        return datetime.datetime.utcnow() > (self.expires_at - datetime.timedelta(seconds=45 * 60))
+        now = now or datetime.datetime.utcnow()
+        return now > (self.expires_at - self.REFRESH_MARGIN)
 
     def update_from_strava(self, data):
         expires_at = datetime.datetime.utcfromtimestamp(data["expires_at"])
@@ -304,8 +520,13 @@ class PollState(db.Model):
     full_fetch_completed = db.Column(
         db.Boolean(name="full_fetch_completed"), default=False
     )
+    # Cursor of the full fetch: start_date of the oldest activity seen.
+    full_fetch_before = db.Column(db.DateTime)
     last_fetch_completed_at = db.Column(db.DateTime)
 
+    # When to poll next, unset means right away. Computed by the poller.
+    next_poll_at = db.Column(db.DateTime, index=True)
+
     total_fetches = db.Column(db.BigInteger, default=0, nullable=False)
 
     # State if something bad has happened...
@@ -317,11 +538,25 @@ class PollState(db.Model):
     # If set do not pull from this anymore.
     stopped = db.Column(db.Boolean(name="stopped"))
 
+    # Set while a poller process works on this PollState. Other pollers
+    # leave it alone until the lease expired.
+    lease_owner = db.Column(db.String(64))
+    lease_expires_at = db.Column(db.DateTime)
+
+    # Jobs for this PollState that ran past their deadline.
+    overrun_count = db.Column(db.Integer)
+    last_overrun_at = db.Column(db.DateTime)
+
+    # Errors since the last successful job, the poller backs off based
+    # on it.
+    consecutive_failures = db.Column(db.Integer)
+
     def clear_error(self):
         self.error_happened = False
         self.error_happened_at = None
         self.error_message = None
         self._set_error_data({})
+        self.consecutive_failures = 0
 
     def set_error(self, message, error_data):
         """
@@ -330,13 +565,19 @@ class PollState(db.Model):
         This may or may not be clear, but if we do not set it, the poller
         will pick up the failed poll_state again.
 
-        Note, we really should have a log table where all the errors are kept so
-        that we still have them after a clear_error()
+        Every error is also appended to the errors of this PollState, so
+        they are still around after a clear_error().
         """
         now = datetime.datetime.utcnow()
         self.error_happened = True
         self.error_message = message
         self._set_error_data(error_data)
+        self.consecutive_failures = (self.consecutive_failures or 0) + 1
+        self.errors.append(PollStateError(
+            created_at=now,
+            message=message[:255] if message else message,
+            error_data=self.error_data,
+        ))
 
         # Set timestamps
         self.error_happened_at = now
@@ -350,6 +591,10 @@ class PollState(db.Model):
     def _set_error_data(self, error_data):
         self.error_data = json.dumps(error_data)
 
+    def release_lease(self):
+        self.lease_owner = None
+        self.lease_expires_at = None
+
     def stop(self):
         self.stopped = True
 
@@ -363,4 +608,62 @@ class PollState(db.Model):
     __table_args__ = (
         Index("ix_strava_poll_states_full_fetch_completed_at",
               "full_fetch_completed", "last_fetch_completed_at"),
+        # Only PollStates of new users, for the poller to find those due
+        # for a backfill without going through all due ones.
+        Index("ix_strava_poll_states_full_fetch_pending", "next_poll_at",
+              postgresql_where=full_fetch_completed.isnot(True),
+              sqlite_where=full_fetch_completed.isnot(True)),
     )
+
+
+class PollStateError(db.Model):
+    """
+    Append-only history of the errors of PollStates.
+    """
+    __tablename__ = "strava_poll_state_errors"
+
+    id = db.Column(db.Integer, primary_key=True)
+    poll_state_id = db.Column(db.Integer, db.ForeignKey("strava_poll_states.id"),
+                              nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    message = db.Column(db.String(255))
+    error_data = db.Column(db.Text)
+
+    def get_error_data(self):
+        if not self.error_data:
+            return {}
+        return json.loads(self.error_data)
+
+    def __repr__(self):
+        return "<PollStateError {} {}>".format(self.id, self.message)
+
+
+PollState.errors = db.relationship(PollStateError, order_by=PollStateError.id,
+                                   lazy="dynamic", cascade="all, delete-orphan")
+
+
+class WebhookEvent(db.Model):
+    """
+    An event received through Strava's webhook subscription, queued until
+    the poller fetched (or deleted) the activity. An athlete revoking our
+    access is queued as a DEAUTHORIZE event, with the athlete's Strava id
+    as object_id, until the poller confirmed it.
+    """
+    __tablename__ = "strava_webhook_events"
+
+    DEAUTHORIZE = "deauthorize"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False,
+                        index=True)
+    user = db.relationship(User)
+
+    # The Strava id of the activity and one of create, update, delete
+    # or DEAUTHORIZE.
+    object_id = db.Column(db.BigInteger, nullable=False)
+    aspect_type = db.Column(db.String(16), nullable=False)
+    event_time = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return "<WebhookEvent {} {} {}>".format(self.id, self.aspect_type, self.object_id)
@@ -0,0 +1,402 @@
+"""
+Simulate the StravaPoller against a synthetic population of users on a
+virtual clock.
+
+The real StravaPoller runs its master loop with _now() and _sleep() bound
+to a VirtualClock. Jobs run right when submitted, against a SimulatedStrava
+with latency and rate limits, and complete once the virtual clock reached
+the sum of the latencies of their requests. Nothing ever sleeps: The wall
+time is what the poller spends on its own, mostly building and running
+its queries: Expect some 50-100 jobs per wall second.
+
+    simulation = Simulation(db.session, users=10000,
+                            profiles={"daily": 0.3, "weekly": 0.5, "inactive": 0.2})
+    report = simulation.run(datetime.timedelta(days=1))
+
+The report has the API calls made, the lag between the upload of an
+activity and when it was stored, and the statements writing to the DB.
+Tokens are never refreshed and the writer and token refresher threads
+are not used.
+"""
+import collections
+import copy
+import datetime
+import heapq
+import itertools
+import random
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import event
+
+from tourmap.models import PollState, Token, User
+from tourmap.strava_poller import StravaPoller
+from tourmap.utils import dt2ts
+from tourmap.utils.objpool import ObjectPool
+from tourmap.utils.strava import StravaNotFound, StravaRateLimited
+
+# Mean seconds between two uploads of a user, None for never.
+PROFILES = {
+    "commuter": 12 * 60 * 60,
+    "daily": 24 * 60 * 60,
+    "weekly": 7 * 24 * 60 * 60,
+    "inactive": None,
+}
+
+DEFAULT_PROFILES = {"daily": 0.3, "weekly": 0.5, "inactive": 0.2}
+
+# What the Strava API returns for an activity, as far as the poller uses it.
+ACTIVITY_TEMPLATE = {
+    "resource_state": 2,
+    "external_id": "simulated",
+    "type": "Ride",
+    "utc_offset": 0.0,
+    "timezone": "(GMT+00:00) UTC",
+    "map": {"summary_polyline": "_p~iF~ps|U_ulLnnqC_mqNvxq`@"},
+    "start_latlng": [38.5, -120.2],
+    "end_latlng": [43.252, -126.453],
+    "distance": 52306.0,
+    "moving_time": 9144,
+    "elapsed_time": 12338,
+    "total_elevation_gain": 1228.0,
+    "average_temp": 9.0,
+    "total_photo_count": 0,
+}
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of sorted values, None if there are none.
+    """
+    if not values:
+        return None
+    index = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class VirtualClock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def advance(self, seconds):
+        self.now += datetime.timedelta(seconds=max(seconds, 0.0))
+
+    def advance_to(self, dt):
+        self.now = max(self.now, dt)
+
+
+class SimulatedStrava(object):
+    """
+    Stands in for every StravaClient of the pool. Only activities
+    uploaded before the current virtual time are visible.
+    """
+
+    def __init__(self, clock, rng, latency=0.2, limits=(600, 30000)):
+        """
+        :param latency: mean seconds a request takes, exponentially
+            distributed.
+        :param limits: limits of the 15 minute and the daily window.
+        """
+        self.__clock = clock
+        self.__rng = rng
+        self.__latency = latency
+        self.limits = limits
+        self.usage = [0, 0]
+        self.__windows = [None, None]
+
+        # access_token -> list of (uploaded_at, activity), oldest first.
+        self.uploads = {}
+        self.uploaded_at = {}
+        self.calls = collections.Counter()
+        self.rate_limited = 0
+        # Virtual seconds spent in requests since the last reset.
+        self.busy_seconds = 0.0
+
+    def add_upload(self, access_token, uploaded_at, activity):
+        self.uploads.setdefault(access_token, []).append((uploaded_at, activity))
+        self.uploaded_at[activity["id"]] = uploaded_at
+
+    def _window_starts(self, now):
+        quarter = now.replace(minute=now.minute - now.minute % 15, second=0,
+                              microsecond=0)
+        day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return quarter, day
+
+    def _request(self, method):
+        now = self.__clock.now
+        starts = self._window_starts(now)
+        for i, start in enumerate(starts):
+            if self.__windows[i] != start:
+                self.__windows[i] = start
+                self.usage[i] = 0
+        if any(u >= limit for u, limit in zip(self.usage, self.limits)):
+            self.rate_limited += 1
+            ends = [starts[0] + datetime.timedelta(minutes=15),
+                    starts[1] + datetime.timedelta(days=1)]
+            exhausted = [e for e, u, l in zip(ends, self.usage, self.limits) if u >= l]
+            raise StravaRateLimited(dt2ts(max(exhausted)))
+        self.usage = [u + 1 for u in self.usage]
+        self.calls[method] += 1
+        if self.__latency:
+            self.busy_seconds += self.__rng.expovariate(1.0 / self.__latency)
+
+    def _visible(self, token):
+        now = self.__clock.now
+        return [a for uploaded_at, a in self.uploads.get(token, []) if uploaded_at <= now]
+
+    def activities(self, token, before=None, after=None, page=None, per_page=None,
+                   deadline=None):
+        self._request("activities")
+        activities = self._visible(token)
+        start_ts = {a["id"]: dt2ts(StravaPoller._start_date(a)) for a in activities}
+        if before is not None:
+            activities = [a for a in activities if start_ts[a["id"]] < before]
+        if after is not None:
+            activities = [a for a in activities if start_ts[a["id"]] > after]
+        else:
+            activities = list(reversed(activities))
+        per_page = per_page or 30
+        offset = ((page or 1) - 1) * per_page
+        return activities[offset:offset + per_page]
+
+    def activity(self, token, id, deadline=None):
+        self._request("activity")
+        for a in self._visible(token):
+            if a["id"] == id:
+                return a
+        raise StravaNotFound(id)
+
+    def activity_photos(self, token, id, size=None, deadline=None):
+        self._request("activity_photos")
+        return []
+
+
+class SimulatedExecutor(object):
+    """
+    Runs jobs right away and completes their futures once the virtual
+    clock reached the time their requests took.
+
+    Without a job completing, the clock moves in steps of resolution
+    seconds, so PollStates becoming due within the same step are handled
+    by one iteration of the master loop.
+    """
+
+    def __init__(self, clock, strava, resolution=60.0):
+        self.__clock = clock
+        self.__strava = strava
+        self.__origin = clock.now
+        self.__resolution = datetime.timedelta(seconds=resolution)
+        self.__pending = []
+        self.__seq = itertools.count()
+
+    def submit(self, fn, *args, **kwargs):
+        self.__strava.busy_seconds = 0.0
+        future = Future()
+        try:
+            outcome = (fn(*args, **kwargs), None)
+        except Exception as e:
+            outcome = (None, e)
+        busy = datetime.timedelta(seconds=self.__strava.busy_seconds)
+        done_at = self.__clock.now + busy
+        heapq.heappush(self.__pending, (done_at, next(self.__seq), future, outcome))
+        return future
+
+    def advance(self, timeout):
+        """
+        Move the clock by timeout seconds, or less if a job completes
+        earlier, and complete the futures of finished jobs.
+        """
+        now = self.__clock.now
+        until = now + datetime.timedelta(seconds=timeout)
+        if self.__pending and self.__pending[0][0] <= until:
+            self.__clock.advance_to(self.__pending[0][0])
+        else:
+            steps = -((self.__origin - until) // self.__resolution)
+            self.__clock.advance_to(max(self.__origin + steps * self.__resolution,
+                                        now + self.__resolution))
+        while self.__pending and self.__pending[0][0] <= self.__clock.now:
+            _, _, future, (result, exc) = heapq.heappop(self.__pending)
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True):
+        self.__pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        return False
+
+
+class SimulatedPoller(StravaPoller):
+    """
+    The StravaPoller with its clock and waiting replaced. Records when
+    activities got stored.
+    """
+
+    def __init__(self, session, clock, strava, executor, **kwargs):
+        kwargs.setdefault("writer_batch_size", 0)
+        kwargs.setdefault("token_refresh_interval_seconds", 0)
+        super().__init__(session, ObjectPool(lambda: strava), executor=executor,
+                         **kwargs)
+        self.__clock = clock
+        self.__strava = strava
+        self.__executor = executor
+        self.stored_at = {}
+
+    def _now(self):
+        return self.__clock.now
+
+    def _sleep(self, seconds):
+        self.__executor.advance(seconds)
+
+    def _wait(self, timeout):
+        self.__executor.advance(timeout)
+
+    def _random(self):
+        return 0.5
+
+    def _process_result(self, poll_state, result, commit=True):
+        super()._process_result(poll_state, result, commit=commit)
+        for info in result.get("activity_infos", []):
+            self.stored_at.setdefault(info["activity"]["id"], self.__clock.now)
+
+
+class Simulation(object):
+
+    def __init__(self, session, users=1000, profiles=None, latency=0.2,
+                 limits=(600, 30000), resolution=60.0,
+                 start=datetime.datetime(2019, 6, 3), seed=0, **poller_kwargs):
+        """
+        :param profiles: dict mapping names in PROFILES to the fraction
+            of users uploading like that.
+        :param resolution: seconds the clock moves at least while no
+            job completes. Larger is faster, but less exact.
+        :param poller_kwargs: passed to the StravaPoller.
+        """
+        self.__session = session
+        self.__users = users
+        self.__profiles = profiles or DEFAULT_PROFILES
+        if any(p not in PROFILES for p in self.__profiles):
+            raise ValueError("Unknown profiles, known are {}".format(sorted(PROFILES)))
+        self.__rng = random.Random(seed)
+        self.clock = VirtualClock(start)
+        self.strava = SimulatedStrava(self.clock, self.__rng, latency=latency,
+                                      limits=limits)
+        self.executor = SimulatedExecutor(self.clock, self.strava, resolution=resolution)
+        poller_kwargs.setdefault("master_sleep_seconds", 60)
+        self.poller = SimulatedPoller(session, self.clock, self.strava, self.executor,
+                                      **poller_kwargs)
+        self.db_writes = collections.Counter()
+        self.__activity_ids = itertools.count(10 ** 9)
+
+    def _profile_names(self):
+        names = list(self.__profiles)
+        weights = [self.__profiles[n] for n in names]
+        return self.__rng.choices(names, weights=weights, k=self.__users)
+
+    def _make_activity(self, uploaded_at):
+        a = copy.deepcopy(ACTIVITY_TEMPLATE)
+        a["id"] = next(self.__activity_ids)
+        a["name"] = "Simulated activity {}".format(a["id"])
+        start_date = uploaded_at - datetime.timedelta(seconds=a["elapsed_time"])
+        a["start_date"] = start_date.strftime("%Y-%m-%dT%H:%M:%SZ")
+        a["start_date_local"] = a["start_date"]
+        return a
+
+    def setup(self, duration):
+        """
+        Insert the users, with completed full fetches, and plan their
+        uploads.
+        """
+        now = self.clock.now
+        far_future = now + datetime.timedelta(days=365 * 100)
+        users, tokens, poll_states = [], [], []
+        for i, profile in enumerate(self._profile_names(), start=1):
+            access_token = "simulated-{}".format(i)
+            users.append({"id": i, "strava_id": i, "email": "sim{}@strava.com".format(i)})
+            tokens.append({"user_id": i, "access_token": access_token,
+                           "refresh_token": access_token, "expires_at": far_future})
+            poll_states.append({
+                "user_id": i,
+                "full_fetch_completed": True,
+                "last_fetch_completed_at": now,
+                "total_fetches": 1,
+                # Spread the first polls over the first hour.
+                "next_poll_at": now + datetime.timedelta(
+                    seconds=self.__rng.uniform(0, 60 * 60)),
+            })
+
+            gap = PROFILES[profile]
+            uploaded_at = now
+            while gap is not None:
+                uploaded_at += datetime.timedelta(
+                    seconds=self.__rng.expovariate(1.0 / gap))
+                if uploaded_at > now + duration:
+                    break
+                self.strava.add_upload(access_token, uploaded_at,
+                                       self._make_activity(uploaded_at))
+
+        for model, rows in [(User, users), (Token, tokens), (PollState, poll_states)]:
+            self.__session.execute(model.__table__.insert(), rows)
+        # Without statistics, SQLite looks up due PollStates by the index on
+        # full_fetch_completed, which is true for all of them.
+        self.__session.execute("ANALYZE")
+        self.__session.commit()
+
+    def _count_write(self, conn, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb in ("INSERT", "UPDATE", "DELETE"):
+            self.db_writes[verb] += len(parameters) if executemany else 1
+
+    def run(self, duration):
+        """
+        Simulate duration, a timedelta, of polling.
+
+        :returns: dict with the report.
+        """
+        self.setup(duration)
+        engine = self.__session.get_bind()
+        event.listen(engine, "before_cursor_execute", self._count_write)
+        wall_start = time.perf_counter()
+        end = self.clock.now + duration
+        try:
+            with self.executor:
+                while self.clock.now < end:
+                    self.poller._run_once(self.executor)
+        finally:
+            event.remove(engine, "before_cursor_execute", self._count_write)
+        return self.report(end, time.perf_counter() - wall_start)
+
+    def report(self, end, wall_seconds):
+        lags = sorted(
+            (self.poller.stored_at[id] - uploaded_at).total_seconds()
+            for id, uploaded_at in self.strava.uploaded_at.items()
+            if id in self.poller.stored_at
+        )
+        uploaded = sum(1 for t in self.strava.uploaded_at.values() if t <= end)
+        counters = self.poller.metrics.snapshot()["counters"]
+        return {
+            "users": self.__users,
+            "wall_seconds": round(wall_seconds, 2),
+            "jobs_submitted": counters.get("jobs_submitted", 0),
+            "jobs_per_wall_second": round(
+                counters.get("jobs_submitted", 0) / max(wall_seconds, 1e-9), 1),
+            "api_calls": sum(self.strava.calls.values()),
+            "api_calls_by_method": dict(self.strava.calls),
+            "rate_limited": self.strava.rate_limited,
+            "activities_uploaded": uploaded,
+            "activities_stored": len(lags),
+            "lag_seconds": {
+                "p50": percentile(lags, 50),
+                "p90": percentile(lags, 90),
+                "p99": percentile(lags, 99),
+                "max": lags[-1] if lags else None,
+            },
+            "db_writes": dict(self.db_writes),
+        }
@@ -1,11 +1,36 @@
 "use strict";
 
+/*
+ * Unpack a polyline as packed by tourmap.utils.geometry: base64 of
+ * little-endian int32 deltas in 1e-5 degrees, alternating lat and lng.
+ */
+var unpackLatLngs = function(packed) {
+  var raw = atob(packed);
+  var view = new DataView(new ArrayBuffer(raw.length));
+  for (var i = 0; i < raw.length; i++) {
+    view.setUint8(i, raw.charCodeAt(i));
+  }
+
+  var latlngs = [];
+  var lat = 0;
+  var lng = 0;
+  for (var offset = 0; offset + 8 <= raw.length; offset += 8) {
+    lat += view.getInt32(offset, true);
+    lng += view.getInt32(offset + 4, true);
+    latlngs.push([lat / 1e5, lng / 1e5]);
+  }
+  return latlngs;
+};
+
 var mapStateMaker = function(mapId, activities, mapSettings, totals, popupMaker) {
 
   var _zoomDelta = 0.5;
   var _zoomSnap = 0.25;
   var _mapElement = $("#" + mapId);
   var _activities = activities;
+  for (var i = 0; i < _activities.length; i++) {
+    _activities[i]["latlngs"] = unpackLatLngs(_activities[i]["packed_latlngs"]);
+  }
   var _mapSettings = mapSettings;
   var _totals = totals
   var _popupMaker = popupMaker;
@@ -6,39 +6,200 @@ the flask SQLAlchemy setup...
 
 ## Design Notes
 
-The main thread polls the database in regular intervals to find users with:
-
-      a) A non completed full fetch...
-      b) Users with the last fetch time greater than a given delta.
+The main thread queries the database to find users with a next_poll_at
+in the past. After a page of a full fetch, next_poll_at is set to
+full_fetch_interval_seconds in the future. Once the full fetch completed,
+the interval adapts to how often a user uploads activities: A fraction
+of the typical gap between the last activities, or the time since the
+last activity if that is longer, bounded by latest_fetch_interval_seconds
+and latest_fetch_max_interval_seconds.
 
 It then submits the tasks to a ThreadPoolExecutor to work on. The idea is
-that the whole thing is extremly IO bound, so threads are just fine.
+that the whole thing is extremly IO bound, so threads are just fine. With
+engine set to "asyncio", jobs instead run as coroutines on an event loop in
+a single thread, sharing an AsyncStravaClient, so hundreds of them can be
+in flight. Jobs do not make requests themselves: They are generators
+yielding Request objects and the engine makes them, so the code of a job
+is the same for both engines.
+How many jobs run at the same time is decided by a ConcurrencyController
+between min_concurrency and max_concurrency: It grows by one while
+requests to Strava are fast and succeed, and is halved when they become
+slower than concurrency_latency_target_seconds, fail, are throttled, or
+the rate limit budget runs low.
+
+The main thread does not poll the database in fixed intervals. After
+submitting, it computes when the next PollState becomes due and blocks
+until either a submitted job finishes or that point in time is reached.
+The database is only scanned again once something can be submitted, or
+after master_sleep_seconds at the latest to pick up new PollStates. When
+more PollStates were due than claimed, it is scanned again as soon as a
+job finished.
+
+Multiple poller processes can run at the same time. Each one claims a
+batch of due PollStates by setting a lease on them (lease_owner and
+lease_expires_at) before submitting. On Postgres the batch is selected
+with FOR UPDATE SKIP LOCKED, elsewhere every row is claimed with a
+conditional UPDATE. Leases of submitted jobs are renewed while they run
+and released once the result was processed. If a poller dies, its
+leases expire and other pollers pick up the PollStates.
+
+With a Strava webhook subscription, activity events are queued in the
+strava_webhook_events table. A PollState with queued events is due right
+away and its job fetches just these activities instead of listing the
+recent ones. Polling then only serves as reconciliation for missed
+events: With webhook_reconcile_interval_seconds set, users whose full
+fetch completed are polled in that interval instead of the adaptive one.
+Events are not signed, so the job checks that fetched activities belong
+to the user, and confirms an event of an athlete revoking access with a
+request before the PollState is stopped.
+
+Every job has a wall-clock deadline of job_deadline_seconds, passed down
+into each StravaClient request. The master acts as watchdog: It cancels
+the deadline of a job running past it, which makes the job's next request
+fail, and records the overrun on the PollState. Job durations and the
+number of executor slots held by such jobs are kept in self.metrics and
+logged every metrics_log_interval_seconds.
+
+Results of finished jobs are not stored by the main thread. It queues them
+for a writer thread with its own session, which processes up to
+writer_batch_size results (waiting at most writer_max_latency_seconds
+for more) and commits them in one transaction. If the group commit fails,
+they are written one by one. While writer_queue_size results are waiting,
+no more jobs are submitted, so a slow database slows down fetching rather
+than piling up results in memory.
+
+Photos of the activities of a job are fetched concurrently, with up to
+photo_fetch_concurrency clients from the pool. With defer_photos, jobs
+store activities without photos and mark them with photos_pending. A
+PollState with pending photos gets a job that only fetches these photos,
+so activities show up on the map first.
+
+When more PollStates are waiting than there are slots, a FairScheduler
+shares the slots between the job classes: webhook, latest, backfill and
+photos. Each class has a weight (scheduler_weights) and a minimum share
+of the recent slots it gets while it has work (scheduler_min_shares).
+After a wave of signups, backfills of the new users therefore cannot
+crowd out the latest fetches of existing users. The queue depth of every
+class, the time PollStates waited and the jobs claimed per class are in
+the metrics.
+
+Access tokens are refreshed by a TokenRefresher thread ahead of time:
+Every token_refresh_interval_seconds, tokens expiring within
+token_refresh_ahead_seconds are refreshed concurrently and committed in
+batches. PollStates whose token was not refreshed yet are skipped.
+
+A PollState whose job failed is retried with exponential backoff, starting
+at error_backoff_base_seconds and capped at error_backoff_max_seconds,
+with jitter. The count of failures in a row is kept on the PollState and
+reset by the next successful job. All errors are kept in the
+strava_poll_state_errors table.
+
+Failed requests are retried by the StravaClient itself. When Strava is
+degraded, the circuit_breaker shared with the clients of the pool opens
+and no jobs are submitted until it lets requests through again. Jobs that
+run into the open breaker are not counted as failures of their PollState.
 """
+import asyncio
 import collections
+import contextlib
 import datetime
 import logging
 import os
+import queue
+import random
+import socket
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
-
-from tourmap.models import PollState, Activity, ActivityPhotos
-from tourmap.utils import dt2ts, json
-from tourmap.utils.strava import InvalidAthleteAccessToken
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import dateutil.parser
+from flask import current_app
+from sqlalchemy import func, literal_column, true
+from sqlalchemy import select as db_select
+
+from tourmap import database
+from tourmap.models import PollState, Activity, ActivityPhotos, WebhookEvent
+from tourmap.token_refresher import TokenRefresher
+from tourmap.utils import content_hash, dt2ts, geometry, json, objpool, str2bool
+from tourmap.utils.asyncio_executor import AsyncioExecutor
+from tourmap.utils.concurrency import ConcurrencyController
+from tourmap.utils.deadline import Deadline, DeadlineExceeded
+from tourmap.utils.metrics import Metrics
+from tourmap.utils.scheduling import FairScheduler, parse_class_values
+from tourmap.utils.strava import InvalidAthleteAccessToken, StravaError, StravaNotFound
+from tourmap.utils.strava import StravaRateLimited, StravaUnavailable
 
 logger = logging.getLogger(__name__)
 
 
+# Largest per_page Strava supports when listing activities.
+MAX_PER_PAGE = 200
+
+# Photos are fetched in these sizes.
+PHOTO_SIZES = (256, 1024)
+
+# Buckets of the write_batch_size histogram.
+WRITE_BATCH_BUCKETS = (1, 2, 5, 10, 20, 50)
+
 PollStateData = collections.namedtuple("PollStateData", [
     "full_fetch_completed",
     "full_fetch_next_page",
     "full_fetch_per_page",
+    "full_fetch_before",
     "last_fetch_completed_at",
     "total_fetches",
 ])
 
 
+def _bool(value):
+    return value if isinstance(value, bool) else str2bool(value)
+
+
+ENGINE_THREADS = "threads"
+ENGINE_ASYNCIO = "asyncio"
+
+# Classes of jobs the scheduler shares the slots between: Fetching the
+# activities of webhook events, latest fetches of users whose full fetch
+# completed, backfills (full fetches) and fetching deferred photos.
+JOB_WEBHOOK = "webhook"
+JOB_LATEST = "latest"
+JOB_BACKFILL = "backfill"
+JOB_PHOTOS = "photos"
+JOB_CLASSES = (JOB_WEBHOOK, JOB_LATEST, JOB_BACKFILL, JOB_PHOTOS)
+
+# Users with maps already should see them fresh, so fetches for them get
+# most of the slots. Backfills and photos still always get some.
+DEFAULT_SCHEDULER_WEIGHTS = "webhook=4,latest=4,backfill=2,photos=1"
+DEFAULT_SCHEDULER_MIN_SHARES = "webhook=0.1,latest=0.25,backfill=0.1,photos=0.05"
+
+
+class Request(object):
+    """
+    A request a job wants to make: The name of a StravaClient method and
+    its arguments, without the deadline.
+
+    Jobs are generators yielding these, or lists of them to be made
+    concurrently, and are sent back the results. Errors are thrown into
+    them. That way the same job runs on a thread with a StravaClient, or
+    on the event loop of the asyncio engine with an AsyncStravaClient.
+    """
+    __slots__ = ("method", "args", "kwargs")
+
+    def __init__(self, method, *args, **kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return "<Request {} {!r} {!r}>".format(self.method, self.args, self.kwargs)
+
+
 class StravaPoller(object):
 
+    # Number of recent activities used to find a user's upload cadence.
+    CADENCE_ACTIVITIES = 10
+
     @staticmethod
     def config_kwargs_from_env(environ=None, prefix="STRAVA_POLLER"):
         """
@@ -48,9 +209,36 @@ class StravaPoller(object):
         environ = environ or os.environ
         settings = [
             ["latest_fetch_interval_seconds", 5 * 60, int],
+            ["latest_fetch_max_interval_seconds", 6 * 60 * 60, int],
+            ["latest_fetch_interval_factor", 1 / 96.0, float],
             ["latest_fetch_lookback_days", 14, int],
             ["full_fetch_interval_seconds", 30, int],
             ["master_sleep_seconds", 2, float],
+            ["lease_seconds", 10 * 60, int],
+            ["lease_batch_size", 20, int],
+            ["webhook_reconcile_interval_seconds", 0, int],
+            ["photo_fetch_concurrency", 4, int],
+            ["defer_photos", False, _bool],
+            ["job_deadline_seconds", 5 * 60, int],
+            ["metrics_log_interval_seconds", 5 * 60, int],
+            ["queue_depth_interval_seconds", 5 * 60, int],
+            ["min_concurrency", 1, int],
+            ["max_concurrency", 16, int],
+            ["asyncio_max_concurrency", 256, int],
+            ["concurrency_latency_target_seconds", 2.0, float],
+            ["concurrency_error_rate_threshold", 0.1, float],
+            ["writer_batch_size", 10, int],
+            ["writer_max_latency_seconds", 0.5, float],
+            ["writer_queue_size", 20, int],
+            ["engine", ENGINE_THREADS, str],
+            ["scheduler_weights", DEFAULT_SCHEDULER_WEIGHTS, parse_class_values],
+            ["scheduler_min_shares", DEFAULT_SCHEDULER_MIN_SHARES, parse_class_values],
+            ["token_refresh_interval_seconds", 60, int],
+            ["token_refresh_ahead_seconds", 15 * 60, int],
+            ["token_refresh_concurrency", 4, int],
+            ["token_refresh_batch_size", 20, int],
+            ["error_backoff_base_seconds", 60, int],
+            ["error_backoff_max_seconds", 6 * 60 * 60, int],
         ]
         result = {}
         for s, default, cast_fun in settings:
@@ -59,90 +247,697 @@ class StravaPoller(object):
         return result
 
     def __init__(self, session, strava_client_pool,
-                 full_fetch_per_page_default=20,
+                 full_fetch_per_page_default=MAX_PER_PAGE,
                  full_fetch_interval_seconds=30, latest_fetch_interval_seconds=5 * 60,
+                 latest_fetch_max_interval_seconds=6 * 60 * 60,
+                 latest_fetch_interval_factor=1 / 96.0,
                  latest_fetch_lookback_days=14,
-                 latest_fetch_per_page=50,
+                 latest_fetch_per_page=MAX_PER_PAGE,
+                 latest_fetch_max_pages=10,
                  master_sleep_seconds=1,
-                 executor=None):
+                 upsert=True,
+                 rate_limiter=None,
+                 circuit_breaker=None,
+                 lease_seconds=10 * 60,
+                 lease_batch_size=20,
+                 poller_id=None,
+                 executor=None,
+                 webhook_reconcile_interval_seconds=0,
+                 webhook_events_per_job=50,
+                 photo_fetch_concurrency=4,
+                 defer_photos=False,
+                 photo_activities_per_job=20,
+                 job_deadline_seconds=5 * 60,
+                 metrics=None,
+                 metrics_log_interval_seconds=5 * 60,
+                 queue_depth_interval_seconds=5 * 60,
+                 min_concurrency=1,
+                 max_concurrency=16,
+                 asyncio_max_concurrency=256,
+                 concurrency_latency_target_seconds=2.0,
+                 concurrency_error_rate_threshold=0.1,
+                 concurrency_controller=None,
+                 writer_batch_size=10,
+                 writer_max_latency_seconds=0.5,
+                 writer_queue_size=20,
+                 engine=ENGINE_THREADS,
+                 async_strava_client=None,
+                 scheduler_weights=DEFAULT_SCHEDULER_WEIGHTS,
+                 scheduler_min_shares=DEFAULT_SCHEDULER_MIN_SHARES,
+                 token_refresh_interval_seconds=60,
+                 token_refresh_ahead_seconds=15 * 60,
+                 token_refresh_concurrency=4,
+                 token_refresh_batch_size=20,
+                 error_backoff_base_seconds=60,
+                 error_backoff_max_seconds=6 * 60 * 60):
 
         self.__session = session
-        self.__executor = executor or ThreadPoolExecutor(max_workers=4)  # !!!
+
+        # With the threads engine, the executor has a thread for every job
+        # that may run. With the asyncio engine, jobs are coroutines on a
+        # single event loop, making their requests with async_strava_client.
+        # Either way, the controller decides how many are submitted.
+        if engine not in (ENGINE_THREADS, ENGINE_ASYNCIO):
+            raise ValueError("Unknown engine {!r}".format(engine))
+        if engine == ENGINE_ASYNCIO and async_strava_client is None:
+            raise ValueError("The asyncio engine requires async_strava_client")
+        self.__engine = engine
+        self.__async_strava_client = async_strava_client
+        # A job waiting for Strava costs a thread with the threads engine,
+        # but only a coroutine with the asyncio engine, so it allows more.
+        if engine == ENGINE_ASYNCIO:
+            max_concurrency = asyncio_max_concurrency
+        if executor is None:
+            if engine == ENGINE_ASYNCIO:
+                executor = AsyncioExecutor(on_shutdown=async_strava_client.close)
+            else:
+                executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                              thread_name_prefix="Job")
+        self.__executor = executor
+        self.__concurrency = concurrency_controller or ConcurrencyController(
+            min_limit=min_concurrency,
+            max_limit=max_concurrency,
+            initial_limit=min(4, max_concurrency),
+            latency_target_seconds=concurrency_latency_target_seconds,
+            error_rate_threshold=concurrency_error_rate_threshold,
+        )
         self.__result_futures = {}
         self.__strava_client_pool = strava_client_pool
 
         self.__full_fetch_per_page_default = full_fetch_per_page_default
         self.__full_fetch_interval_seconds = full_fetch_interval_seconds
         self.__latest_fetch_interval_seconds = latest_fetch_interval_seconds
+        self.__latest_fetch_max_interval_seconds = latest_fetch_max_interval_seconds
+        self.__latest_fetch_interval_factor = latest_fetch_interval_factor
         self.__latest_fetch_lookback_days = latest_fetch_lookback_days
         self.__latest_fetch_per_page = latest_fetch_per_page
-
+        self.__latest_fetch_max_pages = latest_fetch_max_pages
+        self.__upsert = upsert
+
+        # Shared with the clients of strava_client_pool. If given, only
+        # as many jobs are submitted as there are requests left.
+        self.__rate_limiter = rate_limiter
+        self.__circuit_breaker = circuit_breaker
+        self.__deferred_until = None
+        # More PollStates were waiting than claimed by the last _submit().
+        self.__backlogged = False
+
+        # The master never blocks longer than this. New PollStates
+        # (logins) are picked up after this time at the latest.
         self.__master_sleep_seconds = master_sleep_seconds
+        self.__next_check_at = None
+
+        # Leasing of PollStates, so that multiple pollers can run.
+        self.__poller_id = poller_id or "{}-{}-{}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])[-64:]
+        self.__lease_seconds = lease_seconds
+        self.__lease_batch_size = lease_batch_size
+        self.__leases_renewed_at = None
+
+        # Poll interval for users covered by a webhook subscription, 0 if
+        # there is no subscription.
+        self.__webhook_reconcile_interval_seconds = webhook_reconcile_interval_seconds
+        self.__webhook_events_per_job = webhook_events_per_job
+
+        # Photos are fetched concurrently within a job. With defer_photos,
+        # activities are stored without photos first and the photos are
+        # fetched by separate jobs once nothing else is due.
+        self.__photo_fetch_concurrency = photo_fetch_concurrency
+        self.__defer_photos = defer_photos
+        self.__photo_activities_per_job = photo_activities_per_job
+
+        # Every job gets a Deadline once it runs. The watchdog in the
+        # master cancels the ones of jobs running too long. The deadline
+        # of the job running in a thread is kept in self.__local.
+        self.__job_deadline_seconds = job_deadline_seconds
+        self.__deadlines = {}
+        self.__local = threading.local()
+
+        # With writer_batch_size > 0, run() starts a writer thread. The
+        # master queues results of done jobs for it and the writer commits
+        # them in groups. Results waiting to be written keep their
+        # PollStates leased and count against writer_queue_size: Once
+        # that many are waiting, no more jobs are submitted.
+        self.__writer_batch_size = writer_batch_size
+        self.__writer_max_latency_seconds = writer_max_latency_seconds
+        self.__writer_queue_size = writer_queue_size
+        self.__writer_queue = None
+        self.__writer_thread = None
+        self.__written_futures = {}
+
+        # Which PollStates are claimed when there are more candidates than
+        # slots. Classes without a weight get the smallest one.
+        weights = parse_class_values(scheduler_weights)
+        for job_class in JOB_CLASSES:
+            weights.setdefault(job_class, min(weights.values(), default=1.0))
+        self.__scheduler = FairScheduler(
+            collections.OrderedDict((c, weights[c]) for c in JOB_CLASSES),
+            min_shares=parse_class_values(scheduler_min_shares),
+        )
 
-    def _sleep(self):
-        # XXX: We should either sleep until the executor finished a job,
-        #      or a maximum time has elapesd. Maybe have an event queue
-        #      that the master can sleep on?
-        time.sleep(self.__master_sleep_seconds)
+        self.__metrics = metrics or Metrics()
+        self.__metrics_log_interval_seconds = metrics_log_interval_seconds
+        self.__metrics_logged_at = None
+        # Counting the PollStates of every job class takes a scan over all
+        # of them, so the queue_depth gauges are only updated this often.
+        self.__queue_depth_interval_seconds = queue_depth_interval_seconds
+        self.__queue_depth_sampled_at = None
+
+        # With token_refresh_interval_seconds > 0, run() starts a
+        # TokenRefresher thread and jobs are only submitted for users
+        # with a valid token. Otherwise, tokens are refreshed in _submit().
+        self.__token_refresh_interval_seconds = token_refresh_interval_seconds
+        self.__token_refresh_ahead_seconds = token_refresh_ahead_seconds
+        self.__token_refresh_concurrency = token_refresh_concurrency
+        self.__token_refresh_batch_size = token_refresh_batch_size
+        self.__token_refresher = None
+
+        # After a failed job, a PollState is retried after
+        # error_backoff_base_seconds, doubling with every further failure
+        # in a row up to error_backoff_max_seconds.
+        self.__error_backoff_base_seconds = error_backoff_base_seconds
+        self.__error_backoff_max_seconds = error_backoff_max_seconds
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _wait(self, timeout):
+        """
+        Block until a submitted job finished or timeout seconds elapsed.
+        """
+        if not self._has_submitted_ids():
+            self._sleep(timeout)
+            return
+        futures = list(self.__result_futures.values())
+        futures.extend(self.__written_futures.values())
+        wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
 
     def _now(self):
         return datetime.datetime.utcnow()
 
+    def _random(self):
+        return random.random()
+
+    @property
+    def metrics(self):
+        return self.__metrics
+
+    @property
+    def concurrency(self):
+        return self.__concurrency
+
+    def _request(self, method, *args, **kwargs):
+        """
+        Make a request with a StravaClient method, passing the deadline of
+        the running job.
+        """
+        with self._observe_request():
+            return method(*args, deadline=self._deadline(), **kwargs)
+
+    @contextlib.contextmanager
+    def _observe_request(self):
+        """
+        Tell the concurrency controller how a request went.
+        """
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except StravaRateLimited:
+            self.__concurrency.throttled()
+            raise
+        except (StravaNotFound, StravaUnavailable):
+            raise
+        except StravaError:
+            error = True
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            self.__concurrency.observe(latency, error=error)
+            self.__metrics.observe("request_duration_seconds", latency)
+
+    def _deadline(self):
+        """
+        The Deadline of the job running in the current thread, or None.
+        """
+        return getattr(self.__local, "deadline", None)
+
+    @contextlib.contextmanager
+    def _job(self, deadline):
+        """
+        Run a job in the current thread: Start its deadline and record
+        how long it took.
+        """
+        if deadline is not None:
+            deadline.start()
+        self.__local.deadline = deadline
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.__local.deadline = None
+            self.__metrics.observe("job_duration_seconds", time.perf_counter() - start)
+
     def _has_submitted_ids(self):
-        return len(self.__result_futures) > 0
+        return len(self.__result_futures) > 0 or len(self.__written_futures) > 0
+
+    def _is_submitted(self, poll_state_id):
+        return (poll_state_id in self.__result_futures
+                or poll_state_id in self.__written_futures)
 
     def _get_submitted_ids(self):
-        return list(self.__result_futures.keys())
+        """
+        PollStates with a running job or a result waiting to be written.
+        """
+        return list(self.__result_futures.keys()) + list(self.__written_futures.keys())
+
+    def _candidates_query(self, *entities):
+        """
+        Query over PollStates that are not stopped. Submitted ones are
+        leased by this poller until their result was processed and are
+        filtered by _claimable().
+        """
+        not_stopped = (
+            PollState.stopped.is_(None)
+            | PollState.stopped.is_(False)
+        )
+        return self.__session.query(*(entities or [PollState])).filter(not_stopped)
 
-    def _get_poll_states(self):
+    def _get_poll_states(self, limit=None):
         """
-        Find PollStates in the DB that need to be worked on.
+        Find PollStates in the DB that need to be worked on and claim
+        them for this poller.
+
+          a) Those in one of the JOB_CLASSES: With queued webhook events,
+             due for a backfill (full fetch) or a latest fetch, or with
+             photos to fetch.
+          b) Filter out those leased, by other pollers or by this one
+             for a submitted job.
 
-          a) Those that where full_fetch_completed is False
-          b) Those that havent't been polled since
-             self.__latest_fetch_interval_seconds...
-          c) Filter a) and b) with self.__poll_states_submitted
+        The scheduler decides how many of each class are claimed.
 
+        :param limit: claim at most this many, else lease_batch_size.
         :returns: iterator over all poll states that match above
-            criterias.
+            criterias and were claimed, in the order of the scheduler.
+        """
+        now = self._now()
+        limit = limit if limit is not None else self.__lease_batch_size
+        criteria = self._job_class_criteria(now)
+        self._sample_queue_depths(criteria, now)
+        # Split on next_poll_at for _candidates().
+        never_polled = self._job_class_criteria(now, is_due=true())
+        polled = self._job_class_criteria(now, is_due=PollState.next_poll_at <= now)
+        candidates = {}
+        for job_class in criteria:
+            # One more than can be claimed tells if PollStates are left
+            # waiting. Submitted ones are leased, unless the lease ran out
+            # before the master came around to renew it.
+            candidates[job_class] = collections.deque(
+                (poll_state_id, waiting_since) for poll_state_id, waiting_since in
+                self._candidates(job_class, never_polled[job_class],
+                                 polled[job_class], now, limit + 1)
+                if not self._is_submitted(poll_state_id)
+            )
+
+        backlog = {c: len(ids) for c, ids in candidates.items()}
+        picked = []
+        for job_class in self.__scheduler.order(backlog, limit):
+            poll_state_id, waiting_since = candidates[job_class].popleft()
+            picked.append((poll_state_id, job_class, waiting_since))
+        self.__backlogged = any(candidates.values())
+        if not picked:
+            return
+
+        # Another poller may have claimed some of them since the query
+        # above, so the claim checks again.
+        query = (
+            self._candidates_query()
+            .filter(PollState.id.in_([id for id, _, _ in picked]))
+            .filter(self._claimable(now))
+        )
+        claimed = {state.id: state for state in self._claim(query, now)}
+        for poll_state_id, job_class, waiting_since in picked:
+            if poll_state_id not in claimed:
+                continue
+            self.__metrics.incr("jobs_claimed." + job_class)
+            if waiting_since is not None:
+                self.__metrics.observe("wait_seconds." + job_class,
+                                       max((now - waiting_since).total_seconds(), 0.0))
+            yield claimed[poll_state_id]
+
+    def _candidates(self, job_class, never_polled, polled, now, limit):
+        """
+        Ids and waiting_since of up to limit PollStates in job_class,
+        those never polled first, then by next_poll_at.
+
+        Two queries rather than NULLS FIRST, which SQLite only supports
+        from 3.30. Their criteria have is_due simplified for next_poll_at
+        being NULL or not, so SQLite walks ix_strava_poll_states_next_poll_at
+        in order instead of sorting all due PollStates.
+
+        :param never_polled: criterion of job_class if next_poll_at is NULL.
+        :param polled: criterion of job_class otherwise.
         """
-        dt = self._now() - datetime.timedelta(seconds=self.__full_fetch_interval_seconds)
-        needs_full_fetch = (
-            (PollState.full_fetch_completed.is_(None) | PollState.full_fetch_completed.is_(False))
-            & (PollState.last_fetch_completed_at.is_(None) | (PollState.last_fetch_completed_at < dt))
+        query = (
+            self._candidates_query(PollState.id, self._waiting_since(job_class))
+            .filter(self._claimable(now))
+        )
+        result = (
+            query.filter(PollState.next_poll_at.is_(None))
+            .filter(never_polled)
+            .order_by(PollState.id)
+            .limit(limit)
+            .all()
         )
+        if len(result) < limit:
+            result.extend(
+                query.filter(PollState.next_poll_at.isnot(None))
+                .filter(polled)
+                .order_by(PollState.next_poll_at, PollState.id)
+                .limit(limit - len(result))
+            )
+        return result
 
-        dt = self._now() - datetime.timedelta(seconds=self.__latest_fetch_interval_seconds)
-        needs_latest_fetch = (
-            PollState.full_fetch_completed.is_(True) & (
-                PollState.last_fetch_completed_at.is_(None) | (PollState.last_fetch_completed_at < dt)
+    def _sample_queue_depths(self, criteria, now):
+        """
+        Set the queue_depth gauges to the number of PollStates waiting
+        in each job class, every queue_depth_interval_seconds.
+        """
+        interval = datetime.timedelta(seconds=self.__queue_depth_interval_seconds)
+        sampled_at = self.__queue_depth_sampled_at
+        if sampled_at is not None and now < sampled_at + interval:
+            return
+        self.__queue_depth_sampled_at = now
+        for job_class, criterion in criteria.items():
+            depth = (
+                self._candidates_query(func.count(PollState.id))
+                .filter(criterion)
+                .filter(self._claimable(now))
+                .scalar()
             )
+            self.__metrics.set_gauge("queue_depth." + job_class, depth)
+
+    def _job_class_criteria(self, now, is_due=None):
+        """
+        Filters for the PollStates of every job class. A PollState is in
+        one class at most, the same one _submit() creates a job for.
+
+        :param is_due: replaces _is_due(now) where the caller knows more
+            about next_poll_at.
+        """
+        is_due = self._is_due(now) if is_due is None else is_due
+        has_webhook_events = self._has_webhook_events()
+        full_fetch_completed = PollState.full_fetch_completed.is_(True)
+        # As in the where clause of ix_strava_poll_states_full_fetch_pending,
+        # for the index to be used.
+        full_fetch_pending = PollState.full_fetch_completed.isnot(True)
+        return collections.OrderedDict([
+            (JOB_WEBHOOK, has_webhook_events),
+            (JOB_LATEST, ~has_webhook_events & is_due & full_fetch_completed),
+            (JOB_BACKFILL, ~has_webhook_events & is_due & full_fetch_pending),
+            (JOB_PHOTOS, ~has_webhook_events & ~is_due & self._has_pending_photos()),
+        ])
+
+    @staticmethod
+    def _waiting_since(job_class):
+        """
+        Column expression for when a PollState started waiting in
+        job_class, NULL if unknown.
+        """
+        if job_class == JOB_WEBHOOK:
+            return (
+                db_select([func.min(WebhookEvent.created_at)])
+                .where(WebhookEvent.user_id == PollState.user_id)
+                .as_scalar()
+            )
+        if job_class in (JOB_LATEST, JOB_BACKFILL):
+            return PollState.next_poll_at
+        return literal_column("NULL")
+
+    @staticmethod
+    def _is_due(now):
+        return PollState.next_poll_at.is_(None) | (PollState.next_poll_at <= now)
+
+    @staticmethod
+    def _no_error():
+        """
+        Queued work is not done after an error, it is retried at
+        next_poll_at with a regular fetch.
+        """
+        return (
+            PollState.error_happened.is_(None)
+            | PollState.error_happened.is_(False)
         )
-        not_stopped = (
-            PollState.stopped.is_(None)
-            | PollState.stopped.is_(False)
+
+    def _has_webhook_events(self):
+        """
+        PollStates with queued webhook events. Only once the full fetch
+        completed.
+        """
+        return (
+            PollState.full_fetch_completed.is_(True)
+            & self._no_error()
+            & PollState.user_id.in_(self.__session.query(WebhookEvent.user_id))
         )
+
+    def _has_pending_photos(self):
+        """
+        PollStates with activities whose photos were deferred.
+        """
+        pending_user_ids = (
+            self.__session.query(Activity.user_id)
+            .filter(Activity.photos_pending.is_(True))
+        )
+        return self._no_error() & PollState.user_id.in_(pending_user_ids)
+
+    def _get_pending_photos(self, poll_state):
+        """
+        :returns: list of dicts with id and total_photo_count of activities
+            of poll_state whose photos were deferred.
+        """
+        if poll_state.error_happened:
+            return []
         query = (
+            self.__session.query(Activity.strava_id, Activity.total_photo_count)
+            .filter(Activity.user_id == poll_state.user_id)
+            .filter(Activity.photos_pending.is_(True))
+            .order_by(Activity.start_date.desc())
+            .limit(self.__photo_activities_per_job)
+        )
+        return [
+            {"id": strava_id, "total_photo_count": total_photo_count or 0}
+            for strava_id, total_photo_count in query
+        ]
+
+    def _get_webhook_events(self, poll_state):
+        """
+        :returns: list of (id, object_id, aspect_type) of queued webhook
+            events for poll_state, oldest first.
+        """
+        if not poll_state.full_fetch_completed or poll_state.error_happened:
+            return []
+        query = (
+            self.__session.query(WebhookEvent.id, WebhookEvent.object_id,
+                                 WebhookEvent.aspect_type)
+            .filter(WebhookEvent.user_id == poll_state.user_id)
+            .order_by(WebhookEvent.id)
+            .limit(self.__webhook_events_per_job)
+        )
+        return [tuple(row) for row in query]
+
+    @staticmethod
+    def _claimable(now):
+        """
+        PollStates without a lease or whose lease expired. Leases of this
+        poller are held by its submitted jobs and renewed while they run.
+        """
+        return (
+            PollState.lease_expires_at.is_(None)
+            | (PollState.lease_expires_at < now)
+        )
+
+    def _claim(self, query, now):
+        """
+        Set a lease on the PollStates selected by query, skipping those
+        another poller claimed in the meantime. query needs to filter
+        on _claimable(), with row locks it is evaluated after locking.
+
+        :returns: list of claimed PollStates.
+        """
+        lease_expires_at = now + datetime.timedelta(seconds=self.__lease_seconds)
+        if database.supports_skip_locked(self.__session):
+            # Rows locked by another poller claiming them right now are
+            # skipped, the rest are ours after the commit.
+            poll_states = query.with_for_update(skip_locked=True).all()
+            for poll_state in poll_states:
+                poll_state.lease_owner = self.__poller_id
+                poll_state.lease_expires_at = lease_expires_at
+            self.__session.commit()
+            return poll_states
+
+        # Without row locks, claim row by row. If the UPDATE did not match,
+        # someone else was faster.
+        claimed_ids = []
+        for poll_state_id, in query.with_entities(PollState.id).all():
+            rowcount = (
+                self.__session.query(PollState)
+                .filter(PollState.id == poll_state_id)
+                .filter(self._claimable(now))
+                .update({
+                    PollState.lease_owner: self.__poller_id,
+                    PollState.lease_expires_at: lease_expires_at,
+                }, synchronize_session=False)
+            )
+            if rowcount == 1:
+                claimed_ids.append(poll_state_id)
+        self.__session.commit()
+
+        if not claimed_ids:
+            return []
+        return (
             self.__session.query(PollState)
-            .filter((needs_full_fetch | needs_latest_fetch) & not_stopped)
+            .filter(PollState.id.in_(claimed_ids))
+            .order_by(PollState.id)
+            .all()
         )
-        if self._has_submitted_ids():
-            query = query.filter(PollState.id.notin_(self._get_submitted_ids()))
 
-        for state in query:
-            yield state
+    def _renew_leases(self):
+        """
+        Extend the leases of PollStates with submitted jobs. Done every
+        third of lease_seconds.
+        """
+        now = self._now()
+        renew_after = datetime.timedelta(seconds=self.__lease_seconds / 3.0)
+        renewed_at = self.__leases_renewed_at
+        if renewed_at is not None and now < renewed_at + renew_after:
+            return
+
+        self.__leases_renewed_at = now
+        if not self._has_submitted_ids():
+            return
+
+        lease_expires_at = now + datetime.timedelta(seconds=self.__lease_seconds)
+        (
+            self.__session.query(PollState)
+            .filter(PollState.id.in_(self._get_submitted_ids()))
+            .filter(PollState.lease_owner == self.__poller_id)
+            .update({PollState.lease_expires_at: lease_expires_at},
+                    synchronize_session=False)
+        )
+        self.__session.commit()
+
+    def _get_next_due_at(self):
+        """
+        Find the point in time when the next PollState that is not
+        due yet becomes due.
+
+        PollStates that are due already are ignored: Right after _submit()
+        these are the ones that were skipped (no token, etc.) and would
+        otherwise make the master spin.
+
+        :returns: datetime or None if there is no such PollState.
+        """
+        return (
+            self._candidates_query(func.min(PollState.next_poll_at))
+            .filter(PollState.next_poll_at > self._now())
+            .scalar()
+        )
+
+    def _get_poll_interval_seconds(self, start_dates, now):
+        """
+        How long to wait until the next latest fetch for a user with
+        activities started at start_dates (newest first).
+
+        Users uploading often are polled often, inactive ones rarely.
+        """
+        if not start_dates:
+            return self.__latest_fetch_max_interval_seconds
+
+        gaps = sorted(
+            (a - b).total_seconds() for a, b in zip(start_dates, start_dates[1:]))
+        since_last = (now - start_dates[0]).total_seconds()
+        gap = max(gaps[len(gaps) // 2] if gaps else 0.0, since_last)
+        interval = gap * self.__latest_fetch_interval_factor
+        return min(max(interval, self.__latest_fetch_interval_seconds),
+                   self.__latest_fetch_max_interval_seconds)
+
+    def _get_next_poll_at(self, poll_state):
+        """
+        Compute when poll_state should be polled next.
+        """
+        now = self._now()
+        if not poll_state.full_fetch_completed:
+            return now + datetime.timedelta(seconds=self.__full_fetch_interval_seconds)
+
+        if self.__webhook_reconcile_interval_seconds:
+            interval = self.__webhook_reconcile_interval_seconds
+            return now + datetime.timedelta(seconds=interval)
+
+        start_dates = [
+            start_date for start_date, in
+            self.__session.query(Activity.start_date)
+            .filter(Activity.user_id == poll_state.user_id)
+            .order_by(Activity.start_date.desc())
+            .limit(self.CADENCE_ACTIVITIES)
+        ]
+        interval = self._get_poll_interval_seconds(start_dates, now)
+        return now + datetime.timedelta(seconds=interval)
+
+    def _get_retry_at(self, poll_state):
+        """
+        Compute when to poll a PollState whose job just failed: Not before
+        it would be polled anyway, and then exponentially later with every
+        failure in a row. Half of the delay is random, so that users
+        failing at the same time do not come back all at once.
+        """
+        failures = max(poll_state.consecutive_failures or 0, 1)
+        delay = min(self.__error_backoff_base_seconds * 2 ** min(failures - 1, 32),
+                    self.__error_backoff_max_seconds)
+        delay = delay / 2.0 + self._random() * delay / 2.0
+        retry_at = self._now() + datetime.timedelta(seconds=delay)
+        return max(self._get_next_poll_at(poll_state), retry_at)
 
     def _submit(self, executor):
         """
         Find PollState instances that should be worked on and submit
         them to the executor...
+
+        No more jobs are submitted than the concurrency controller allows
+        to run, and none while writer_queue_size results wait for the
+        writer. Every job makes at least one request, so with a rate
+        limiter no more jobs than requests remaining are submitted.
         """
-        for poll_state in self._get_poll_states():
+        waiting = len(self.__written_futures)
+        if self.__writer_queue is not None and waiting >= self.__writer_queue_size:
+            logger.info("%d results waiting for the writer, not submitting",
+                        len(self.__written_futures))
+            return
+        limit = min(self.__lease_batch_size,
+                    self.__concurrency.limit - len(self.__result_futures))
+        if limit <= 0:
+            logger.debug("All %d slots busy", self.__concurrency.limit)
+            return
+        if self.__rate_limiter is not None:
+            limit = min(limit, self.__rate_limiter.remaining())
+            if limit == 0:
+                logger.info("Rate limit budget used up, deferring jobs")
+                return
+
+        for poll_state in self._get_poll_states(limit=limit):
             token = poll_state.user.token
             if not token:
                 logger.debug("Skipping %s without token", poll_state.user)
                 continue
 
+            if token.should_refresh() and self.__token_refresher is not None:
+                logger.info("Token %s of user %s not refreshed yet, skipping",
+                            token.id, token.user_id)
+                poll_state.release_lease()
+                self.__session.commit()
+                self.__metrics.incr("jobs_waiting_for_token")
+                self.__token_refresher.wake()
+                continue
+
             if token.should_refresh():
                 logger.info("Refreshing token %s of user %s",
                             token.id, token.user_id)
@@ -165,57 +960,408 @@ class StravaPoller(object):
                     full_fetch_completed=poll_state.full_fetch_completed,
                     full_fetch_next_page=poll_state.full_fetch_next_page,
                     full_fetch_per_page=poll_state.full_fetch_per_page,
+                    full_fetch_before=poll_state.full_fetch_before,
                     last_fetch_completed_at=poll_state.last_fetch_completed_at,
                     total_fetches=poll_state.total_fetches
                 )
             }
+            fn = self._job_function(self.fetch_activities)
+            next_poll_at = poll_state.next_poll_at
+            is_due = next_poll_at is None or next_poll_at <= self._now()
+            webhook_events = self._get_webhook_events(poll_state)
+            if webhook_events:
+                submit_kwargs["webhook_events"] = webhook_events
+                submit_kwargs["athlete_id"] = poll_state.user.strava_id
+            elif is_due:
+                known_activities = self._get_known_activities(poll_state)
+                submit_kwargs["known_activities"] = known_activities
+            else:
+                # Claimed for photos only.
+                del submit_kwargs["poll_state"]
+                submit_kwargs["activities"] = self._get_pending_photos(poll_state)
+                if not submit_kwargs["activities"]:
+                    poll_state.release_lease()
+                    self.__session.commit()
+                    continue
+                fn = self._job_function(self.fetch_photos)
+            deadline = Deadline(self.__job_deadline_seconds)
+            submit_kwargs["deadline"] = deadline
             logger.info("Submitting job for %s", poll_state.user)
             assert poll_state.id not in self.__result_futures
-            future = executor.submit(self.fetch_activities, **submit_kwargs)
+            future = executor.submit(fn, **submit_kwargs)
             self.__result_futures[poll_state.id] = future
+            self.__deadlines[poll_state.id] = deadline
+            self.__metrics.incr("jobs_submitted")
 
-    def _process_result(self, poll_state, result):
+    def _job_function(self, fn):
         """
-        Process a result received from a fetch (either latest or full).
+        The coroutine function variant of fn for the asyncio engine.
         """
-        user = poll_state.user
+        if self.__engine == ENGINE_ASYNCIO:
+            return getattr(self, fn.__name__ + "_async")
+        return fn
+
+    def _get_deferred_until(self):
+        """
+        :returns: datetime until which no jobs should be submitted because
+            the rate limit is exhausted, or None.
+        """
+        now = self._now()
+        candidates = []
+        if self.__deferred_until is not None and self.__deferred_until > now:
+            candidates.append(self.__deferred_until)
+        if self.__rate_limiter is not None:
+            retry_at = self.__rate_limiter.retry_at()
+            if retry_at is not None:
+                candidates.append(datetime.datetime.utcfromtimestamp(retry_at))
+        if self.__circuit_breaker is not None:
+            retry_at = self.__circuit_breaker.retry_at()
+            if retry_at is not None:
+                candidates.append(datetime.datetime.utcfromtimestamp(retry_at))
+        return max(candidates) if candidates else None
+
+    def _defer(self, retry_at):
+        """
+        A job was rate limited. Do not submit anything until retry_at
+        (Unix time), or for master_sleep_seconds if unknown.
+        """
+        if retry_at is not None:
+            deferred_until = datetime.datetime.utcfromtimestamp(retry_at)
+        else:
+            deferred_until = self._now() + datetime.timedelta(
+                seconds=self.__master_sleep_seconds)
+        self.__deferred_until = max(filter(None, [self.__deferred_until, deferred_until]))
+
+    def _latest_fetch_after_dt(self, poll_state):
+        last_fetch_completed_at = poll_state.last_fetch_completed_at or self._now()
+        after_td = datetime.timedelta(days=self.__latest_fetch_lookback_days)
+        return last_fetch_completed_at - after_td
+
+    def _get_known_activities(self, poll_state):
+        """
+        Load what we know about the activities a fetch for poll_state will
+        see, so the job can skip unchanged ones: Those within the lookback
+        of a latest fetch, or those in the second of the full fetch cursor,
+        which the next page of the full fetch sees again.
+
+        :returns: dict mapping strava_id to (content_hash, total_photo_count)
+        """
+        query = (
+            self.__session.query(Activity.strava_id, Activity.content_hash,
+                                 Activity.total_photo_count)
+            .filter(Activity.user_id == poll_state.user_id)
+        )
+        if poll_state.full_fetch_completed:
+            after_dt = self._latest_fetch_after_dt(poll_state)
+            query = query.filter(Activity.start_date >= after_dt)
+        elif poll_state.full_fetch_before is not None:
+            before = poll_state.full_fetch_before
+            query = query.filter(Activity.start_date >= before).filter(
+                Activity.start_date < before + datetime.timedelta(seconds=1))
+        else:
+            return {}
+        return {
+            strava_id: (known_hash, total_photo_count)
+            for strava_id, known_hash, total_photo_count in query
+        }
+
+    @staticmethod
+    def _photos_dict(activity_info):
+        """
+        We store all pictures in a single row as a blob. This
+        way we will not bloat the table so much. We use a JSON
+        column to do so...
+        """
+        photos_dict = {}
+        for size, photos in activity_info["photos"].items():
+            photos_dict.setdefault(size, [])
+            photos_list = photos_dict[size]
+            for p in photos:
+                photos_list.append({
+                    "url": list(p["urls"].values())[0],
+                    "caption": p.get("caption"),
+                    "width": p["__tourmap_width"],
+                    "height": p["__tourmap_height"],
+                    "unique_id": p["unique_id"],
+                    "source": p["source"],
+                })
+        return photos_dict
+
+    def _get_activity_hashes(self, user, strava_ids):
+        """
+        Load ids, content hashes and start dates of existing activities
+        with a single query.
+
+        :returns: dict mapping strava_id to (id, content_hash, start_date)
+        """
+        if not strava_ids:
+            return {}
+        query = (
+            self.__session.query(Activity.id, Activity.user_id, Activity.strava_id,
+                                 Activity.content_hash, Activity.start_date)
+            .filter(Activity.strava_id.in_(strava_ids))
+        )
+        result = {}
+        for id, user_id, strava_id, known_hash, start_date in query:
+            assert user_id == user.id
+            result[strava_id] = (id, known_hash, start_date)
+        return result
+
+    def _get_photo_hashes(self, activity_ids):
+        """
+        :returns: dict mapping activity_id to the content_hash of its photos
+        """
+        if not activity_ids:
+            return {}
+        query = (
+            self.__session.query(ActivityPhotos.activity_id, ActivityPhotos.content_hash)
+            .filter(ActivityPhotos.activity_id.in_(activity_ids))
+        )
+        return dict(query)
+
+    def _store_activities_upsert(self, user, activity_infos):
+        """
+        Write all changed activities and photos of a result using two
+        INSERT ... ON CONFLICT DO UPDATE statements.
+
+        :returns: the old and new start dates of changed activities and
+            the start dates of activities with changed photos.
+        """
+        strava_ids = [info["activity"]["id"] for info in activity_infos]
+        existing = self._get_activity_hashes(user, strava_ids)
+
+        activity_rows = []
+        changed_dates = []
+        start_dates = {}
+        for activity_info in activity_infos:
+            values = Activity.values_from_strava(activity_info["activity"])
+            start_dates[values["strava_id"]] = values["start_date"]
+            _, known_hash, known_start_date = existing.get(values["strava_id"],
+                                                           (None, None, None))
+            if known_hash == values["content_hash"]:
+                continue
+            changed_dates.extend(filter(None, [known_start_date, values["start_date"]]))
+            values.update(geometry.pack_polyline(values["summary_polyline"]))
+            values["user_id"] = user.id
+            values["photos_pending"] = activity_info["photos"] is None
+            activity_rows.append(values)
+
+        if activity_rows:
+            database.upsert(self.__session, Activity.__table__, activity_rows,
+                            index_elements=["strava_id"],
+                            update_columns=[c for c in activity_rows[0]
+                                            if c not in ("strava_id", "user_id")])
+
+        # Only new activities need their ids looked up again.
+        activity_ids = {strava_id: id for strava_id, (id, _, _) in existing.items()}
+        new_strava_ids = [i for i in strava_ids if i not in activity_ids]
+        new_activities = self._get_activity_hashes(user, new_strava_ids)
+        activity_ids.update(
+            (strava_id, id) for strava_id, (id, _, _) in new_activities.items()
+        )
+        # No after_insert event stores their hashids on this path.
+        if new_activities:
+            hashids = Activity.get_Hashids()
+            self.__session.bulk_update_mappings(Activity, [
+                {"id": id, "_hashid": hashids.encode(id)}
+                for id, _, _ in new_activities.values()
+            ])
+        photo_hashes = self._get_photo_hashes(
+            [id for strava_id, id in activity_ids.items() if strava_id in existing]
+        )
+
+        photo_rows = []
+        for activity_info in activity_infos:
+            if activity_info["photos"] is None:
+                continue
+            activity_id = activity_ids[activity_info["activity"]["id"]]
+            json_blob = json.dumps(self._photos_dict(activity_info), sort_keys=True)
+            json_blob_hash = content_hash(json_blob)
+            if photo_hashes.get(activity_id) == json_blob_hash:
+                continue
+            changed_dates.append(start_dates[activity_info["activity"]["id"]])
+            photo_rows.append({
+                "user_id": user.id,
+                "activity_id": activity_id,
+                "data": json_blob,
+                "content_hash": json_blob_hash,
+            })
+        database.upsert(self.__session, ActivityPhotos.__table__, photo_rows,
+                        index_elements=["activity_id"],
+                        update_columns=["data", "content_hash"])
+
+        logger.debug("Wrote %d/%d activities and %d/%d photo blobs",
+                     len(activity_rows), len(activity_infos),
+                     len(photo_rows), len(activity_infos))
+        return changed_dates
+
+    def _store_activities_orm(self, user, activity_infos):
+        """
+        Write all changed activities and photos of a result through the
+        ORM. Used for databases without INSERT ... ON CONFLICT support.
+        Existing rows are still loaded with a single query each.
 
-        for activity_info in result["activity_infos"]:
+        :returns: the old and new start dates of changed activities and
+            the start dates of activities with changed photos.
+        """
+        strava_ids = [info["activity"]["id"] for info in activity_infos]
+        activities = {
+            a.strava_id: a
+            for a in Activity.query.filter(Activity.strava_id.in_(strava_ids))
+        }
+        activity_photos = {}
+        if activities:
+            activity_ids = [a.id for a in activities.values()]
+            activity_photos = {
+                p.activity_id: p
+                for p in ActivityPhotos.query.filter(
+                    ActivityPhotos.activity_id.in_(activity_ids))
+            }
+
+        changed_dates = []
+        for activity_info in activity_infos:
             a = activity_info["activity"]
-            activity = Activity.query.filter_by(strava_id=a["id"]).one_or_none()
+            activity = activities.get(a["id"])
             if activity is None:
                 activity = Activity(user=user, strava_id=a["id"])
+                activities[a["id"]] = activity
+                self.__session.add(activity)
             else:
                 assert activity.user_id == user.id
 
-            activity.update_from_strava(a)
-            self.__session.add(activity)
-
-            # We store all pictures in a single row as a blob. This
-            # way we will not bloat the table so much.
-            # table too much. We use a JSON column to do so...
-            photos_dict = {}
-            for size, photos in activity_info["photos"].items():
-                photos_dict.setdefault(size, [])
-                photos_list = photos_dict[size]
-                for p in photos:
-                    photos_list.append({
-                        "url": list(p["urls"].values())[0],
-                        "caption": p.get("caption"),
-                        "width": p["__tourmap_width"],
-                        "height": p["__tourmap_height"],
-                        "unique_id": p["unique_id"],
-                        "source": p["source"],
-                    })
-
-            photo = ActivityPhotos.query.filter_by(activity=activity).one_or_none()
+            values = Activity.values_from_strava(a)
+            if activity.content_hash != values["content_hash"]:
+                changed_dates.extend(filter(None, [activity.start_date,
+                                                   values["start_date"]]))
+                activity.update_from_strava(a)
+                activity.photos_pending = activity_info["photos"] is None
+
+            if activity_info["photos"] is None:
+                continue
+
+            photo = activity_photos.get(activity.id) if activity.id else None
             if photo is None:
                 photo = ActivityPhotos(user=user, activity=activity)
                 self.__session.add(photo)
 
-            # We do this on every poll... It might hurt :-/
-            json_blob = json.dumps(photos_dict, sort_keys=True)
-            photo.data = json_blob
+            json_blob = json.dumps(self._photos_dict(activity_info), sort_keys=True)
+            if photo.content_hash != content_hash(json_blob):
+                changed_dates.append(activity.start_date)
+                photo.set_data(json_blob)
+
+        return changed_dates
+
+    def _delete_activities(self, user, strava_ids):
+        """
+        Remove activities deleted on Strava, including their photos.
+
+        :returns: the start dates of the deleted activities.
+        """
+        activity_ids = (
+            self.__session.query(Activity.id)
+            .filter(Activity.user_id == user.id)
+            .filter(Activity.strava_id.in_(strava_ids))
+            .subquery()
+        )
+        deleted_dates = [
+            start_date for start_date, in
+            self.__session.query(Activity.start_date)
+            .filter(Activity.id.in_(activity_ids))
+        ]
+        (
+            self.__session.query(ActivityPhotos)
+            .filter(ActivityPhotos.activity_id.in_(activity_ids))
+            .delete(synchronize_session=False)
+        )
+        count = (
+            self.__session.query(Activity)
+            .filter(Activity.user_id == user.id)
+            .filter(Activity.strava_id.in_(strava_ids))
+            .delete(synchronize_session=False)
+        )
+        logger.info("Deleted %d activities of %s", count, user)
+        return deleted_dates
+
+    def _update_tour_stats(self, user, changed_dates):
+        """
+        Rebuild the TourStats of the tours of user that cover any of
+        the start dates of changed activities or photos. This bumps
+        their version, which the tour pages are cached by. Tours of
+        other date ranges are left alone.
+        """
+        for tour in user.tours:
+            if any(tour.covers(d) for d in changed_dates):
+                tour.rebuild_stats()
+                self.__metrics.incr("tour_stats_rebuilt")
+
+    def _store_photos(self, user, photo_infos):
+        """
+        Write the photos fetched by a fetch_photos() job and mark them
+        as no longer pending.
+
+        :returns: the start dates of activities with changed photos.
+        """
+        strava_ids = [info["activity"]["id"] for info in photo_infos]
+        activities = {
+            a.strava_id: a
+            for a in Activity.query.filter(Activity.user_id == user.id)
+                                   .filter(Activity.strava_id.in_(strava_ids))
+        }
+        activity_photos = {
+            p.activity_id: p
+            for p in ActivityPhotos.query.filter(
+                ActivityPhotos.activity_id.in_([a.id for a in activities.values()]))
+        }
+        changed_dates = []
+        for photo_info in photo_infos:
+            activity = activities.get(photo_info["activity"]["id"])
+            if activity is None:
+                continue  # Deleted meanwhile
+            photo = activity_photos.get(activity.id)
+            if photo is None:
+                photo = ActivityPhotos(user=user, activity=activity)
+                self.__session.add(photo)
+            json_blob = json.dumps(self._photos_dict(photo_info), sort_keys=True)
+            if photo.content_hash != content_hash(json_blob):
+                changed_dates.append(activity.start_date)
+                photo.set_data(json_blob)
+            activity.photos_pending = False
+
+        return changed_dates
+
+    def _process_result(self, poll_state, result, commit=True):
+        """
+        Process a result received from a fetch (either latest, full,
+        of webhook events or of deferred photos).
+
+        :param commit: if False, the caller commits.
+        """
+        user = poll_state.user
+
+        changed_dates = []
+        activity_infos = result["activity_infos"]
+        if activity_infos:
+            if self.__upsert and database.supports_upsert(self.__session):
+                changed_dates += self._store_activities_upsert(user, activity_infos)
+            else:
+                changed_dates += self._store_activities_orm(user, activity_infos)
+
+        if result.get("photo_infos"):
+            changed_dates += self._store_photos(user, result["photo_infos"])
+
+        if result.get("deleted_strava_ids"):
+            changed_dates += self._delete_activities(user, result["deleted_strava_ids"])
+
+        if changed_dates:
+            self._update_tour_stats(user, changed_dates)
+
+        webhook_event_ids = result.get("webhook_event_ids")
+        if webhook_event_ids:
+            (
+                self.__session.query(WebhookEvent)
+                .filter(WebhookEvent.id.in_(webhook_event_ids))
+                .delete(synchronize_session=False)
+            )
 
         # Updating PollState:
         for k, v in result["state_update"].items():
@@ -224,14 +1370,84 @@ class StravaPoller(object):
 
         # This should be a no-op in most cases.
         poll_state.clear_error()
+        poll_state.release_lease()
+        if "last_fetch_completed_at" in result["state_update"]:
+            # Only a poll schedules the next one, jobs for webhook
+            # events or photos do not replace it.
+            poll_state.next_poll_at = self._get_next_poll_at(poll_state)
 
         # Commit after we worked through one result.
-        self.__session.commit()
+        if commit:
+            self.__session.commit()
+
+    def _process_done_future(self, poll_state_id, future, commit=True):
+        """
+        Store the result of a finished job, or record on its PollState
+        why it failed.
+
+        :param commit: if False, the caller commits. Errors storing the
+            result are raised then instead of being recorded.
+        """
+        poll_state = PollState.query.get(poll_state_id)
+        result = None
+        logger.debug("Processing done future: %s", future)
+        try:
+            result = future.result()
+            self._process_result(poll_state, result, commit=commit)
+
+        except StravaRateLimited as e:
+            # Not the fault of this PollState. It stays due and is
+            # submitted again once there is budget.
+            logger.warning("Job for %s was rate limited (retry_at=%s)",
+                           poll_state.user, e.retry_at)
+            self._defer(e.retry_at)
+            poll_state.release_lease()
+        except StravaUnavailable as e:
+            # Not the fault of this PollState either, Strava is degraded.
+            logger.warning("Job for %s ran into the open circuit breaker (retry_at=%s)",
+                           poll_state.user, e.retry_at)
+            self.__metrics.incr("jobs_circuit_open")
+            self._defer(e.retry_at)
+            poll_state.release_lease()
+        except DeadlineExceeded as e:
+            logger.warning("Job for %s exceeded its deadline: %s", poll_state.user, e)
+            self.__metrics.incr("jobs_deadline_exceeded")
+            poll_state.set_error("Deadline exceeded", {
+                "message": str(e),
+                "deadline_seconds": self.__job_deadline_seconds,
+            })
+            poll_state.release_lease()
+            poll_state.next_poll_at = self._get_retry_at(poll_state)
+        except InvalidAthleteAccessToken as e:
+            # This is an error we can not ignore, the user probably
+            # just removed access to their data for us. We mark their
+            # PollState to have an error...
+            logger.warning("Invalid access token for %s", poll_state.user)
+            poll_state.set_error(str(e.args), e.error_data)
+            poll_state.stop()
+            (
+                self.__session.query(WebhookEvent)
+                .filter(WebhookEvent.user_id == poll_state.user_id)
+                .delete(synchronize_session=False)
+            )
+            poll_state.release_lease()
+            poll_state.next_poll_at = self._get_next_poll_at(poll_state)
+        except Exception as e:
+            if not commit and result is not None:
+                raise
+            logger.exception("Job failed: %s %s", repr(e), json.dumps(result))
+            poll_state.set_error("Unhandled Error", repr(e))
+            poll_state.release_lease()
+            poll_state.next_poll_at = self._get_retry_at(poll_state)
+
+        if commit:
+            self.__session.commit()
 
     def _process_result_futures(self, futures):
         """
         Go through the list of futures we have and check if anything
-        needs to be processed.
+        needs to be processed. With a writer stage, done futures are
+        queued for the writer thread, else processed right here.
 
         :return: True if a future was processed, else False.
         """
@@ -240,79 +1456,328 @@ class StravaPoller(object):
             if not future.done():
                 continue
 
-            poll_state = PollState.query.get(poll_state_id)
             found_done_future = True
-            result = None
-            logger.debug("Processing done future: %s", future)
+            futures.pop(poll_state_id)
+            self.__deadlines.pop(poll_state_id, None)
+            if self.__writer_queue is not None:
+                written = Future()
+                self.__written_futures[poll_state_id] = written
+                # Blocks if the writer is behind by more than the queue.
+                self.__writer_queue.put((poll_state_id, future, written))
+                continue
+
             try:
-                result = future.result()
-                self._process_result(poll_state, result)
-
-            except InvalidAthleteAccessToken as e:
-                # This is an error we can not ignore, the user probably
-                # just removed access to their data for us. We mark their
-                # PollState to have an error...
-                logger.warning("Invalid access token for %s", poll_state.user)
-                poll_state.set_error(str(e.args), e.error_data)
-                poll_state.stop()
-                self.__session.commit()
-            except Exception as e:
-                logger.exception("Job failed: %s %s", repr(e), json.dumps(result))
-                poll_state.set_error("Unhandled Error", repr(e))
-                self.__session.commit()
+                self._process_done_future(poll_state_id, future)
             finally:
-                futures.pop(poll_state_id)
-
                 # Clean slate for the next one...
                 self.__session.rollback()
 
         return found_done_future
 
+    def _process_written_futures(self):
+        """
+        Forget about results the writer thread is done with.
+
+        :return: True if a result was written, else False.
+        """
+        written_ids = [id for id, f in self.__written_futures.items() if f.done()]
+        for poll_state_id in written_ids:
+            self.__written_futures.pop(poll_state_id)
+        return len(written_ids) > 0
+
+    def _write_results(self, items):
+        """
+        Process the results of several jobs and commit them together. If
+        that fails, they are processed and committed one by one, so a bad
+        result does not take the others down with it.
+
+        :param items: list of (poll_state_id, future, written) tuples.
+            written is resolved once the result was processed.
+        """
+        start = time.perf_counter()
+        try:
+            for poll_state_id, future, _ in items:
+                self._process_done_future(poll_state_id, future, commit=False)
+            self.__session.commit()
+        except Exception as e:
+            logger.warning("Writing %d results together failed, "
+                           "writing them one by one: %r", len(items), e)
+            self.__metrics.incr("write_batch_fallbacks")
+            self.__session.rollback()
+            for poll_state_id, future, _ in items:
+                try:
+                    self._process_done_future(poll_state_id, future)
+                except Exception:
+                    logger.exception("Writing result for PollState %s failed",
+                                     poll_state_id)
+                finally:
+                    self.__session.rollback()
+        finally:
+            for poll_state_id, _, written in items:
+                written.set_result(poll_state_id)
+            self.__metrics.observe("write_batch_size", len(items),
+                                   buckets=WRITE_BATCH_BUCKETS)
+            self.__metrics.observe("write_duration_seconds", time.perf_counter() - start)
+
+    def _next_write_batch(self):
+        """
+        Wait for a result to write, then collect more for up to
+        writer_max_latency_seconds or until there are writer_batch_size.
+
+        :returns: (items, stop) tuple. stop is True once _stop_writer()
+            was called.
+        """
+        item = self.__writer_queue.get()
+        if item is None:
+            return [], True
+
+        items = [item]
+        until = time.monotonic() + self.__writer_max_latency_seconds
+        while len(items) < self.__writer_batch_size:
+            timeout = until - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.__writer_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def _writer_loop(self, app):
+        """
+        Body of the writer thread. It has its own session, the one of
+        the master is not touched from here.
+        """
+        with app.app_context():
+            stop = False
+            while not stop:
+                items, stop = self._next_write_batch()
+                if items:
+                    self._write_results(items)
+
+    def _start_writer(self, app):
+        self.__writer_queue = queue.Queue(maxsize=self.__writer_queue_size)
+        self.__writer_thread = threading.Thread(target=self._writer_loop, args=(app,),
+                                                name="Writer", daemon=True)
+        self.__writer_thread.start()
+
+    def _stop_writer(self):
+        """
+        Write what is queued and stop the writer thread.
+        """
+        if self.__writer_thread is None:
+            return
+        self.__writer_queue.put(None)
+        self.__writer_thread.join()
+        self.__writer_thread = None
+        self.__writer_queue = None
+        self._process_written_futures()
+
+    def _start_token_refresher(self, app):
+        self.__token_refresher = TokenRefresher(
+            self.__session, self.__strava_client_pool,
+            interval_seconds=self.__token_refresh_interval_seconds,
+            ahead_seconds=self.__token_refresh_ahead_seconds,
+            concurrency=self.__token_refresh_concurrency,
+            batch_size=self.__token_refresh_batch_size,
+            metrics=self.__metrics,
+        )
+        self.__token_refresher.start(app)
+
+    def _stop_token_refresher(self):
+        if self.__token_refresher is None:
+            return
+        self.__token_refresher.stop()
+        self.__token_refresher = None
+
+    def _check_deadlines(self):
+        """
+        The watchdog: Cancel the deadlines of jobs running past them and
+        record the overrun on their PollStates. The jobs stop with the
+        next request they make, a request in progress is bounded by its
+        timeout being capped to the deadline.
+
+        :returns: number of executor slots taken by jobs past their deadline.
+        """
+        now = self._now()
+        stuck_slots = 0
+        for poll_state_id, deadline in list(self.__deadlines.items()):
+            future = self.__result_futures.get(poll_state_id)
+            if future is None or future.done() or not deadline.expired():
+                continue
+            stuck_slots += 1
+            if deadline.cancelled:
+                continue
+
+            logger.warning("Job for PollState %s overran its deadline of %ss, cancelling",
+                           poll_state_id, deadline.seconds)
+            deadline.cancel()
+            self.__metrics.incr("job_overruns")
+            (
+                self.__session.query(PollState)
+                .filter(PollState.id == poll_state_id)
+                .update({
+                    PollState.overrun_count:
+                        func.coalesce(PollState.overrun_count, 0) + 1,
+                    PollState.last_overrun_at: now,
+                }, synchronize_session=False)
+            )
+            self.__session.commit()
+
+        self.__metrics.set_gauge("stuck_slots", stuck_slots)
+        return stuck_slots
+
+    def _seconds_until_next_deadline(self):
+        """
+        :returns: seconds until the deadline of a running job expires
+            that was not cancelled yet, or None.
+        """
+        remaining = [
+            d.remaining() for d in self.__deadlines.values()
+            if d.started and not d.cancelled
+        ]
+        return min(remaining) if remaining else None
+
+    def _adjust_concurrency(self):
+        """
+        Let the concurrency controller act on the requests made since
+        the last adjustment and the rate limit budget left.
+        """
+        remaining = None
+        if self.__rate_limiter is not None:
+            remaining = self.__rate_limiter.remaining()
+        limit = self.__concurrency.adjust(remaining_budget=remaining)
+        self.__metrics.set_gauge("concurrency_limit", limit)
+        return limit
+
+    def _log_metrics(self):
+        """
+        Log a snapshot of the metrics every metrics_log_interval_seconds.
+        """
+        now = self._now()
+        interval = datetime.timedelta(seconds=self.__metrics_log_interval_seconds)
+        logged_at = self.__metrics_logged_at
+        if logged_at is not None and now < logged_at + interval:
+            return
+        self.__metrics_logged_at = now
+        self.__metrics.set_gauge("running_jobs", len(self.__result_futures))
+        self.__metrics.set_gauge("results_waiting_for_writer",
+                                 len(self.__written_futures))
+        logger.info("Metrics: %s", json.dumps(self.__metrics.snapshot(), sort_keys=True))
+
     def run(self):
         with self.__executor as executor:
-            logger.info("Running...")
-            self._run(executor)
+            logger.info("Running %s engine with concurrency %s...", self.__engine,
+                        self.__concurrency)
+            app = current_app._get_current_object()
+            if self.__writer_batch_size > 0:
+                self._start_writer(app)
+            if self.__token_refresh_interval_seconds > 0:
+                self._start_token_refresher(app)
+            try:
+                self._run(executor)
+            finally:
+                self._stop_token_refresher()
+                self._stop_writer()
 
     def _run(self, executor):
         """
         Run endlessly
         """
         while True:
-            self._submit(executor)
-            # Only if there was no work to be done, sleep a bit, else
-            # kick in another _submit() round...
-            if not self._process_result_futures(self.__result_futures):
-                self._sleep()
+            self._run_once(executor)
+
+    def _run_once(self, executor):
+        """
+        A single iteration of the master loop.
 
-    def _fetch_photos_for_activity(self, client, access_token, activity):
+        Only scan the DB for PollStates when one is known to be due, or
+        master_sleep_seconds have passed. Then block until a job finished
+        or the next PollState becomes due.
+        """
+        now = self._now()
+        if self.__next_check_at is None or self.__next_check_at <= now:
+            deferred_until = self._get_deferred_until()
+            if deferred_until is None:
+                self._submit(executor)
+                now = self._now()
+                next_due_at = self._get_next_due_at()
+            else:
+                logger.info("Rate limited, deferring submissions until %s",
+                            deferred_until.isoformat())
+                next_due_at = deferred_until
+            max_check_at = now + datetime.timedelta(seconds=self.__master_sleep_seconds)
+            self.__next_check_at = min(filter(None, [next_due_at, max_check_at]))
+            logger.debug("Next check at %s", self.__next_check_at.isoformat())
+
+        timeout = max((self.__next_check_at - now).total_seconds(), 0.0)
+        next_deadline = self._seconds_until_next_deadline()
+        if next_deadline is not None:
+            timeout = min(timeout, next_deadline)
+        self._wait(timeout)
+        self._renew_leases()
+        self._check_deadlines()
+        processed = self._process_result_futures(self.__result_futures)
+        processed = self._process_written_futures() or processed
+        self._adjust_concurrency()
+        self._log_metrics()
+        if processed and self.__backlogged:
+            # Slots became free and PollStates are waiting for them.
+            self.__next_check_at = self._now()
+        elif processed:
+            # The processed PollStates become due again after the
+            # shorter of both intervals at the earliest.
+            min_interval = datetime.timedelta(seconds=min(
+                self.__full_fetch_interval_seconds,
+                self.__latest_fetch_interval_seconds,
+            ))
+            self.__next_check_at = min(self.__next_check_at, self._now() + min_interval)
+
+    def _check_photos(self, photos, requested_size):
         """
-        Fetch photos for two sizes with some error checking.
+        Some error checking of the photos of an activity for one size.
         """
-        requested_sizes = [256, 1024]
-        result_photos = {}
+        logger.debug("Got %d photos for size %d", len(photos), requested_size)
+        for p in photos:
+            sizes = list(p["sizes"].values())
+            if len(sizes) != 1:
+                raise Exception("Bad sizes {}".format(repr(sizes)))
+            width, height = sizes[0]
 
-        if activity["total_photo_count"] == 0:
-            logger.debug("Skipping photo fetch...")
-            return result_photos
+            if width != requested_size and height != requested_size:
+                logger.info("Requested %s, got %s", requested_size, repr(sizes))
 
-        for requested_size in requested_sizes:
-            photos = client.activity_photos(access_token, activity["id"],
-                                            size=requested_size)
-            logger.debug("Got %d photos for size %d", len(photos), requested_size)
-            for p in photos:
-                sizes = list(p["sizes"].values())
-                if len(sizes) != 1:
-                    raise Exception("Bad sizes {}".format(repr(sizes)))
-                width, height = sizes[0]
+            p["__tourmap_width"] = width
+            p["__tourmap_height"] = height
+        return photos
 
-                if width != requested_size and height != requested_size:
-                    logger.info("Requested %s, got %s", requested_size, repr(sizes))
+    def _fetch_photos_for_activities(self, access_token, activities):
+        """
+        Fetch the photos of all activities in two sizes. The requests are
+        yielded together, so they are made concurrently.
 
-                p["__tourmap_width"] = width
-                p["__tourmap_height"] = height
+        :returns: dict mapping activity id to the photos by size.
+        """
+        result = {a["id"]: {} for a in activities}
+        keys = [
+            (a["id"], requested_size)
+            for a in activities if a["total_photo_count"] > 0
+            for requested_size in PHOTO_SIZES
+        ]
+        if not keys:
+            logger.debug("Skipping photo fetch...")
+            return result
 
-            result_photos[requested_size] = photos
-        return result_photos
+        photos = yield [
+            Request("activity_photos", access_token, activity_id, size=requested_size)
+            for activity_id, requested_size in keys
+        ]
+        for (activity_id, requested_size), p in zip(keys, photos):
+            result[activity_id][requested_size] = self._check_photos(p, requested_size)
+        return result
 
     @staticmethod
     def _activity_resource_state_filter(activities):
@@ -323,56 +1788,117 @@ class StravaPoller(object):
                 continue
             yield a
 
-    def _full_fetch(self, client, user_id, access_token, poll_state):
+    def _activity_infos(self, access_token, activities, known_activities=None):
         """
-        Do a single page based fetch iteration.
+        Fetch photos for the given activities and put them together
+        into a list of activity infos.
 
-        XXX: This sucks, we should have just used before iteration and
-             then iterate with a <= before value over intervals of 10
-             days? But then we do not know when to stop, I guess...
-        """
-        result_activities = []
-        # Pages start at!
-        page = poll_state.full_fetch_next_page or 1
-        per_page = poll_state.full_fetch_per_page or self.__full_fetch_per_page_default
-        logger.info("Full fetch: for user_id=%s / page=%d", user_id, page)
+        With defer_photos, photos are not fetched here. The photos of
+        activities having some are None and hydrated by a later job.
 
-        activities = list(client.activities(
-            token=access_token,
-            page=page,
-            per_page=per_page
-        ))
+        :param known_activities: as returned by _get_known_activities().
+            Activities found in there unchanged are skipped, including
+            fetching their photos.
+        """
+        known_activities = known_activities or {}
+        changed_activities = []
         for a in self._activity_resource_state_filter(activities):
-            result_photos = self._fetch_photos_for_activity(client, access_token, a)
-            result_activities.append({
-                "activity": a,
-                "photos": result_photos,
-            })
+            if a["id"] in known_activities:
+                values = Activity.values_from_strava(a)
+                known = (values["content_hash"], values["total_photo_count"])
+                if known_activities[a["id"]] == known:
+                    continue
+            changed_activities.append(a)
+
+        if self.__defer_photos:
+            photos = {
+                a["id"]: None if a["total_photo_count"] > 0 else {}
+                for a in changed_activities
+            }
+        else:
+            photos = yield from self._fetch_photos_for_activities(access_token,
+                                                                  changed_activities)
+        return [
+            {"activity": a, "photos": photos[a["id"]]}
+            for a in changed_activities
+        ]
+
+    @staticmethod
+    def _start_date(activity):
+        """
+        The start_date of an activity from Strava as naive UTC datetime.
+        """
+        return dateutil.parser.parse(activity["start_date"]).replace(tzinfo=None)
 
-        if len(result_activities) == 0:
+    def _full_fetch(self, user_id, access_token, poll_state, known_activities=None):
+        """
+        Fetch a single page of activities not newer than the cursor in
+        full_fetch_before, newest first.
+
+        The cursor is the start_date of the oldest activity seen so far.
+        Unlike page numbers, it does not shift when activities are added
+        or deleted while the full fetch is running, and an interrupted
+        full fetch resumes where it stopped. A page with less than
+        per_page activities is the last one.
+
+        Strava's before is exclusive, so the page overlaps the previous one
+        by a second: Activities starting in the same second as the oldest
+        of the previous page, but not on it, are not skipped. Those that
+        were on it are in known_activities and skipped here.
+        """
+        before = poll_state.full_fetch_before
+        per_page = self.__full_fetch_per_page_default
+        logger.info("Full fetch: for user_id=%s / before=%s", user_id,
+                    before.isoformat() if before else None)
+
+        kwargs = {}
+        if before is not None:
+            kwargs["before"] = dt2ts(before) + 1
+        activities = list((yield Request(
+            "activities",
+            token=access_token,
+            per_page=per_page,
+            **kwargs
+        )))
+        result_activities = yield from self._activity_infos(
+            access_token, activities, known_activities=known_activities)
+
+        completed = len(activities) < per_page
+        if activities:
+            oldest = min(self._start_date(a) for a in activities)
+            if before is not None and oldest >= before and not completed:
+                # A whole page in one second, move past it.
+                logger.warning("More than %d activities in one second for user_id=%s",
+                               per_page, user_id)
+                oldest = before - datetime.timedelta(seconds=1)
+            before = oldest
+        if completed:
             logger.info("Full fetch for user_id=%s completed!", user_id)
 
         return {
             "activity_infos": result_activities,
             "state_update": {
-                "full_fetch_next_page": page + 1,
+                "full_fetch_next_page": (poll_state.full_fetch_next_page or 1) + 1,
                 "full_fetch_per_page": per_page,
-                "full_fetch_completed": len(result_activities) == 0,
+                "full_fetch_before": before,
+                "full_fetch_completed": completed,
                 "total_fetches": poll_state.total_fetches + 1,
                 "last_fetch_completed_at": self._now(),
             },
         }
 
-    def _latest_fetch(self, client, user_id, access_token, poll_state):
+    def _latest_fetch(self, user_id, access_token, poll_state, known_activities=None):
         """
-        Fetch the past X days and update everything.
+        Fetch the past X days and update everything that changed.
+
+        Activities after a timestamp come oldest first, so a full page
+        is followed by fetching the ones after its newest activity, up
+        to latest_fetch_max_pages pages.
         """
         logger.info("Latest fetch: user_id=%s", user_id)
-        result_activities = []
         now = self._now()
-        last_fetch_completed_at = poll_state.last_fetch_completed_at or now
         after_td = datetime.timedelta(days=self.__latest_fetch_lookback_days)
-        after_dt = last_fetch_completed_at - after_td
+        after_dt = self._latest_fetch_after_dt(poll_state)
 
         # This can trigger if the poller hasn't completed this user in
         # one day or so...
@@ -381,30 +1907,44 @@ class StravaPoller(object):
                            "a full fetch for user_id=%s %s now=%s after_dt=%s",
                            user_id, poll_state, now.isoformat(), after_dt.isoformat())
 
+        # Strava's after is exclusive, so pages overlap by a second to not
+        # skip activities starting in the same second as the newest of the
+        # previous page. Those on both pages are only kept once.
+        activities = collections.OrderedDict()
         after_ts = dt2ts(after_dt)
-
-        logger.debug("Fetching activities after %s (%s)", after_dt.isoformat(), after_ts)
-        activities = list(client.activities(
-            token=access_token,
-            after=after_ts,
-            per_page=self.__latest_fetch_per_page,
-        ))
-
-        if len(activities) >= self.__latest_fetch_per_page:
-            logger.warning("Latest fetch got per_page or more results. "
-                           "This means we may have missed some activities. "
-                           "per_page=%s len(activities)=%s",
-                           self.__latest_fetch_per_page, len(activities))
-
+        for _ in range(self.__latest_fetch_max_pages):
+            logger.debug("Fetching activities after %s", after_ts)
+            page_activities = list((yield Request(
+                "activities",
+                token=access_token,
+                after=after_ts,
+                per_page=self.__latest_fetch_per_page,
+            )))
+            activities.update((a["id"], a) for a in page_activities)
+            if len(page_activities) < self.__latest_fetch_per_page:
+                break
+            newest_ts = max(dt2ts(self._start_date(a)) for a in page_activities)
+            if newest_ts - 1 > after_ts:
+                after_ts = newest_ts - 1
+            else:
+                # A whole page in one second, move past it.
+                logger.warning("More than %d activities in one second for user_id=%s",
+                               self.__latest_fetch_per_page, user_id)
+                after_ts = newest_ts
+        else:
+            logger.warning("Latest fetch stopped after %d pages for user_id=%s, "
+                           "there may be more activities.",
+                           self.__latest_fetch_max_pages, user_id)
+
+        activities = list(activities.values())
         if len(activities) > 0:
             logger.info("Got %s new activities for %s", len(activities), user_id)
 
-        for a in self._activity_resource_state_filter(activities):
-            result_photos = self._fetch_photos_for_activity(client, access_token, a)
-            result_activities.append({
-                "activity": a,
-                "photos": result_photos,
-            })
+        result_activities = yield from self._activity_infos(
+            access_token, activities, known_activities=known_activities)
+        if len(result_activities) < len(activities):
+            logger.debug("Skipped %d unchanged activities for %s",
+                         len(activities) - len(result_activities), user_id)
         return {
             "activity_infos": result_activities,
             "state_update": {
@@ -413,18 +1953,226 @@ class StravaPoller(object):
             },
         }
 
-    def _fetch_activities(self, client, user_id, access_token, poll_state):
+    def _webhook_fetch(self, user_id, access_token, poll_state, webhook_events,
+                       athlete_id):
         """
-        Dispatch between doing a full fetch or a latest fetch depending
-        on the poll_state.
+        Fetch the activities of queued webhook events one by one, once
+        for every activity. Events are not trusted: Only activities Strava
+        does not know are deleted, and only those of athlete_id (the
+        user's Strava id) are stored. A revoked access is confirmed by
+        a request with the access token first. If Strava refuses it, the
+        InvalidAthleteAccessToken raised stops the PollState.
         """
+        logger.info("Webhook fetch: user_id=%s events=%d", user_id, len(webhook_events))
+        if any(a == WebhookEvent.DEAUTHORIZE for _, _, a in webhook_events):
+            yield Request("athlete", access_token)
+            logger.warning("Access of user_id=%s was not revoked, ignoring event",
+                           user_id)
+
+        object_ids = collections.OrderedDict.fromkeys(
+            object_id for _, object_id, aspect_type in webhook_events
+            if aspect_type != WebhookEvent.DEAUTHORIZE
+        )
+
+        activities = []
+        deleted_strava_ids = []
+        for object_id in object_ids:
+            try:
+                activity = yield Request("activity", access_token, object_id)
+            except StravaNotFound:
+                logger.info("Activity %s of user_id=%s is gone", object_id, user_id)
+                deleted_strava_ids.append(object_id)
+                continue
+            if (activity.get("athlete") or {}).get("id") != athlete_id:
+                logger.warning("Activity %s is not one of athlete %s, dropping",
+                               object_id, athlete_id)
+                continue
+            activities.append(activity)
+
+        activity_infos = yield from self._activity_infos(access_token, activities)
+        return {
+            "activity_infos": activity_infos,
+            "deleted_strava_ids": deleted_strava_ids,
+            "webhook_event_ids": [id for id, _, _ in webhook_events],
+            "state_update": {
+                "total_fetches": poll_state.total_fetches + 1,
+            },
+        }
+
+    def _fetch_activities(self, user_id, access_token, poll_state,
+                          known_activities=None, webhook_events=None, athlete_id=None):
+        """
+        Dispatch between doing a full fetch, a latest fetch or fetching
+        the activities of webhook events depending on the poll_state.
+        """
+        if webhook_events:
+            return (yield from self._webhook_fetch(user_id, access_token, poll_state,
+                                                   webhook_events, athlete_id))
         if not poll_state.full_fetch_completed:
-            return self._full_fetch(client, user_id, access_token, poll_state)
-        return self._latest_fetch(client, user_id, access_token, poll_state)
+            return (yield from self._full_fetch(user_id, access_token, poll_state,
+                                                known_activities=known_activities))
+        return (yield from self._latest_fetch(user_id, access_token, poll_state,
+                                              known_activities=known_activities))
+
+    def _fetch_photos_job(self, user_id, access_token, activities):
+        logger.info("Photo fetch: user_id=%s activities=%d", user_id, len(activities))
+        photos = yield from self._fetch_photos_for_activities(access_token, activities)
+        return {
+            "activity_infos": [],
+            "photo_infos": [
+                {"activity": a, "photos": photos[a["id"]]}
+                for a in activities
+            ],
+            "state_update": {},
+        }
+
+    def _make_request(self, client, request):
+        return self._request(getattr(client, request.method), *request.args,
+                             **request.kwargs)
+
+    def _make_requests(self, client, requests):
+        """
+        Make a list of requests yielded by a job. They are spread over up
+        to photo_fetch_concurrency threads, each using its own client from
+        the pool and so the shared rate limiter. Without concurrency, the
+        job's client makes them one after another.
+        """
+        if self.__photo_fetch_concurrency <= 1 or len(requests) <= 1:
+            return [self._make_request(client, r) for r in requests]
+
+        deadline = self._deadline()
+
+        def make_request(request):
+            self.__local.deadline = deadline
+            try:
+                request_client = self.__strava_client_pool.get(block=False)
+            except objpool.Empty:
+                # A bounded pool ran dry. Waiting while the job holds a
+                # client could deadlock, so share the job's client.
+                request_client = None
+            try:
+                return self._make_request(request_client or client, request)
+            finally:
+                self.__local.deadline = None
+                if request_client is not None:
+                    self.__strava_client_pool.put(request_client)
+
+        max_workers = min(self.__photo_fetch_concurrency, len(requests))
+        with ThreadPoolExecutor(max_workers=max_workers,
+                                thread_name_prefix="PhotoFetch") as executor:
+            futures = [executor.submit(make_request, r) for r in requests]
+        return [f.result() for f in futures]
+
+    def _run_job(self, client, job):
+        """
+        Run a job in the current thread: Make the requests it yields and
+        send it the results, or throw the errors into it.
+
+        :returns: whatever the job returns.
+        """
+        send, value = job.send, None
+        while True:
+            try:
+                request = send(value)
+            except StopIteration as e:
+                return e.value
+            try:
+                if isinstance(request, list):
+                    value = self._make_requests(client, request)
+                else:
+                    value = self._make_request(client, request)
+                send = job.send
+            except Exception as e:
+                send, value = job.throw, e
+
+    async def _make_request_async(self, request, deadline):
+        method = getattr(self.__async_strava_client, request.method)
+        with self._observe_request():
+            return await method(*request.args, deadline=deadline, **request.kwargs)
 
-    def fetch_activities(self, user_id, access_token, poll_state):
+    async def _make_requests_async(self, requests, deadline):
+        """
+        Make a list of requests yielded by a job, photo_fetch_concurrency
+        at a time. If one fails, the others are cancelled.
+        """
+        semaphore = asyncio.Semaphore(max(self.__photo_fetch_concurrency, 1))
+
+        async def make_request(request):
+            async with semaphore:
+                return await self._make_request_async(request, deadline)
+
+        tasks = [asyncio.ensure_future(make_request(r)) for r in requests]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def _run_job_async(self, job, deadline):
+        """
+        Like _run_job(), but on the event loop of the asyncio engine,
+        using the shared AsyncStravaClient.
         """
+        if deadline is not None:
+            deadline.start()
+        start = time.perf_counter()
+        try:
+            send, value = job.send, None
+            while True:
+                try:
+                    request = send(value)
+                except StopIteration as e:
+                    return e.value
+                try:
+                    if isinstance(request, list):
+                        value = await self._make_requests_async(request, deadline)
+                    else:
+                        value = await self._make_request_async(request, deadline)
+                    send = job.send
+                except Exception as e:
+                    send, value = job.throw, e
+        finally:
+            self.__metrics.observe("job_duration_seconds", time.perf_counter() - start)
+
+    def fetch_photos(self, user_id, access_token, activities, deadline=None):
+        """
+        Fetch the deferred photos of activities.
+
+        :param activities: as returned by _get_pending_photos().
+        :param deadline: Deadline for the whole job.
+        """
+        with self._job(deadline), self.__strava_client_pool.use() as client:
+            return self._run_job(client, self._fetch_photos_job(user_id, access_token,
+                                                                activities))
+
+    def fetch_activities(self, user_id, access_token, poll_state, known_activities=None,
+                         webhook_events=None, athlete_id=None, deadline=None):
+        """
+        :param athlete_id: Strava id of the user, required with webhook_events.
+        :param deadline: Deadline for the whole job.
         :returns: list results with { "activity": {strava}, "activity_photos": {strava}
         """
-        with self.__strava_client_pool.use() as client:
-            return self._fetch_activities(client, user_id, access_token, poll_state)
+        with self._job(deadline), self.__strava_client_pool.use() as client:
+            return self._run_job(client, self._fetch_activities(
+                user_id, access_token, poll_state,
+                known_activities=known_activities,
+                webhook_events=webhook_events, athlete_id=athlete_id))
+
+    async def fetch_photos_async(self, user_id, access_token, activities, deadline=None):
+        """
+        fetch_photos() for the asyncio engine.
+        """
+        return await self._run_job_async(
+            self._fetch_photos_job(user_id, access_token, activities), deadline)
+
+    async def fetch_activities_async(self, user_id, access_token, poll_state,
+                                     known_activities=None, webhook_events=None,
+                                     athlete_id=None, deadline=None):
+        """
+        fetch_activities() for the asyncio engine.
+        """
+        return await self._run_job_async(self._fetch_activities(
+            user_id, access_token, poll_state,
+            known_activities=known_activities,
+            webhook_events=webhook_events, athlete_id=athlete_id), deadline)
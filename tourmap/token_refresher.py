@@ -0,0 +1,201 @@
+"""
+Refresh Strava access tokens in the background, before they are needed.
+
+Strava access tokens expire after 6 hours. Without a refresher, the
+poller refreshes a token right before submitting a job for its user,
+one request and one commit at a time on the master thread.
+
+The TokenRefresher runs in its own thread with its own session. Every
+interval_seconds it looks for tokens of PollStates that are not stopped
+which Token.should_refresh() within ahead_seconds, refreshes up to
+batch_size of them concurrently with clients from the pool and commits
+them in one transaction. The poller then only gets to see tokens that
+are valid.
+
+A refresh Strava rejects (the user revoked access, the refresh token is
+invalid) puts the PollState into an error and stops it, the same as an
+InvalidAthleteAccessToken does in the poller. Other errors are retried
+in the next round.
+
+    refresher = TokenRefresher(db.session, strava_client_pool)
+    refresher.start(current_app._get_current_object())
+    ...
+    refresher.stop()
+"""
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tourmap.models import PollState, Token
+from tourmap.utils.metrics import Metrics
+from tourmap.utils.strava import StravaBadRequest, StravaError
+
+logger = logging.getLogger(__name__)
+
+# Status codes of a refresh Strava will not accept when retried.
+REJECTED_STATUS_CODES = (400, 401, 403)
+
+
+class TokenRefresher(object):
+
+    def __init__(self, session, strava_client_pool, interval_seconds=60,
+                 ahead_seconds=15 * 60, concurrency=4, batch_size=20, metrics=None):
+        """
+        :param interval_seconds: time between two rounds.
+        :param ahead_seconds: refresh tokens this long before
+            Token.should_refresh() would say so. Capped, so that tokens
+            are not refreshed before Strava hands out new ones.
+        :param concurrency: refresh requests in flight at most.
+        :param batch_size: tokens committed in one transaction.
+        :param metrics: tourmap.utils.metrics.Metrics, can be shared with
+            the poller.
+        """
+        self.__session = session
+        self.__strava_client_pool = strava_client_pool
+        self.__interval_seconds = interval_seconds
+        self.__ahead = datetime.timedelta(seconds=ahead_seconds)
+        max_ahead = Token.REFRESH_WINDOW - Token.REFRESH_MARGIN
+        if self.__ahead > max_ahead:
+            # Strava would answer with the same token and it would stay
+            # due, being refreshed in every round.
+            logger.warning("ahead_seconds=%s too large, using %s",
+                           ahead_seconds, max_ahead.total_seconds())
+            self.__ahead = max_ahead
+        self.__concurrency = concurrency
+        self.__batch_size = batch_size
+        self.metrics = metrics or Metrics()
+
+        self.__thread = None
+        self.__wakeup = threading.Event()
+        self.__stopping = False
+
+    def _now(self):
+        return datetime.datetime.utcnow()
+
+    def _get_due(self, now, after_id):
+        """
+        :returns: list of (Token, PollState) tuples with a Token.id larger
+            than after_id, ordered by it.
+        """
+        not_stopped = PollState.stopped.is_(None) | PollState.stopped.is_(False)
+        due = (
+            Token.refresh_token.is_(None)
+            | Token.expires_at.is_(None)
+            | (Token.expires_at < now + Token.REFRESH_MARGIN + self.__ahead)
+        )
+        return (
+            self.__session.query(Token, PollState)
+            .join(PollState, PollState.user_id == Token.user_id)
+            .filter(not_stopped, due, Token.id > after_id)
+            .order_by(Token.id)
+            .limit(self.__batch_size)
+            .all()
+        )
+
+    def _refresh_token(self, refresh_token):
+        """
+        Runs in the threads of the executor, without touching the session.
+        """
+        with self.__strava_client_pool.use() as client:
+            return client.refresh_token(refresh_token)
+
+    def _refresh_batch(self, executor, rows):
+        """
+        Refresh the tokens of rows concurrently and commit them.
+
+        :returns: number of tokens refreshed.
+        """
+        futures = []
+        for token, _ in rows:
+            refresh_token = token.refresh_token
+            if not refresh_token:
+                logger.info("First fetch for refresh_token of user %s", token.user_id)
+                refresh_token = token.access_token
+            futures.append(executor.submit(self._refresh_token, refresh_token))
+
+        refreshed = 0
+        for (token, poll_state), future in zip(rows, futures):
+            try:
+                token.update_from_strava(future.result())
+                refreshed += 1
+            except StravaBadRequest as e:
+                if e.status_code not in REJECTED_STATUS_CODES:
+                    logger.warning("Refreshing token %s failed: %r", token.id, e)
+                    self.metrics.incr("token_refresh_errors")
+                    continue
+                logger.warning("Refreshing token %s of user %s rejected: %r",
+                               token.id, token.user_id, e)
+                poll_state.set_error(str(e.args), {
+                    "status_code": e.status_code,
+                    "message": e.message,
+                    "errors": e.errors,
+                })
+                poll_state.stop()
+                self.metrics.incr("token_refresh_rejected")
+            except (StravaError, ValueError) as e:
+                logger.warning("Refreshing token %s failed: %r", token.id, e)
+                self.metrics.incr("token_refresh_errors")
+
+        self.__session.commit()
+        self.metrics.incr("tokens_refreshed", refreshed)
+        return refreshed
+
+    def refresh_due(self):
+        """
+        Refresh all tokens that are due, batch by batch. Tokens failing
+        are not retried within the same round.
+
+        :returns: number of tokens refreshed.
+        """
+        now = self._now()
+        after_id = 0
+        refreshed = 0
+        with ThreadPoolExecutor(max_workers=self.__concurrency,
+                                thread_name_prefix="TokenRefresh") as executor:
+            while True:
+                rows = self._get_due(now, after_id)
+                if not rows:
+                    break
+                after_id = rows[-1][0].id
+                refreshed += self._refresh_batch(executor, rows)
+                if len(rows) < self.__batch_size:
+                    break
+        if refreshed:
+            logger.info("Refreshed %d tokens", refreshed)
+        return refreshed
+
+    def wake(self):
+        """
+        Start the next round right away, e.g. because the poller came
+        across a token that should have been refreshed.
+        """
+        self.__wakeup.set()
+
+    def _loop(self, app):
+        with app.app_context():
+            while not self.__stopping:
+                self.__wakeup.clear()
+                try:
+                    self.refresh_due()
+                except Exception:
+                    logger.exception("Refreshing tokens failed")
+                    self.__session.rollback()
+                self.__wakeup.wait(self.__interval_seconds)
+
+    def start(self, app):
+        self.__stopping = False
+        self.__thread = threading.Thread(target=self._loop, args=(app,),
+                                         name="TokenRefresher", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the thread after the round in progress.
+        """
+        if self.__thread is None:
+            return
+        self.__stopping = True
+        self.__wakeup.set()
+        self.__thread.join()
+        self.__thread = None
@@ -2,6 +2,7 @@
 Utils.
 """
 import calendar
+import hashlib
 from urllib.parse import urlparse, urljoin
 
 import gpxpy.gpx
@@ -98,6 +99,17 @@ def dt2ts(dt):
     return calendar.timegm(dt.utctimetuple())
 
 
+def content_hash(data):
+    """
+    A stable hash over JSON serializable data (or a str) for change
+    detection. Not meant for anything security related.
+    """
+    from tourmap.utils import json
+    if not isinstance(data, str):
+        data = json.dumps(data, sort_keys=True)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
 def seconds_to_readable_interval(seconds):
     rd = relativedelta(seconds=seconds)
 
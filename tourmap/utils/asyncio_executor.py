@@ -0,0 +1,83 @@
+"""
+An executor running coroutine functions on an event loop in a background
+thread.
+
+It has the parts of the concurrent.futures.Executor interface the poller
+uses: submit() returns a concurrent.futures.Future, so the master thread
+can wait for jobs of either kind the same way, and it can be used as
+context manager.
+
+    with AsyncioExecutor() as executor:
+        future = executor.submit(fetch, user_id=1)
+        future.result()
+"""
+import asyncio
+import threading
+
+# asyncio.all_tasks() and asyncio.current_task() are new in Python 3.7,
+# the methods of Task they replace are gone since 3.9.
+_all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
+_current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+
+
+class AsyncioExecutor(object):
+
+    def __init__(self, on_shutdown=None):
+        """
+        :param on_shutdown: coroutine function awaited on the loop before
+            it stops, e.g. to close a shared client.
+        """
+        self.__on_shutdown = on_shutdown
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self._run_loop, name="AsyncioExecutor",
+                                         daemon=True)
+        self.__thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.__loop)
+        try:
+            self.__loop.run_forever()
+        finally:
+            self.__loop.close()
+
+    @property
+    def loop(self):
+        return self.__loop
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs), a coroutine function, on the loop.
+
+        :returns: concurrent.futures.Future
+        """
+        if not self.__thread.is_alive():
+            raise RuntimeError("cannot schedule new futures after shutdown")
+        return asyncio.run_coroutine_threadsafe(fn(*args, **kwargs), self.__loop)
+
+    def shutdown(self, wait=True):
+        """
+        Cancel what is still running and stop the loop.
+        """
+        if not self.__thread.is_alive():
+            return
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.__loop)
+        if wait:
+            future.result()
+            self.__thread.join()
+
+    async def _shutdown(self):
+        current_task = _current_task(self.__loop)
+        tasks = [t for t in _all_tasks(self.__loop) if t is not current_task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.__on_shutdown is not None:
+            await self.__on_shutdown()
+        self.__loop.call_soon(self.__loop.stop)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=True)
+        return False
@@ -0,0 +1,231 @@
+"""
+Record the HTTP traffic of a StravaClient to a cassette and replay it.
+
+Both are transport adapters mounted on the client's requests session, so
+everything above, the poller and the OAuth flow included, runs unchanged.
+They are configured like the other StravaClient settings:
+
+    STRAVA_CLIENT_CASSETTE=strava.jsonl.gz
+    STRAVA_CLIENT_CASSETTE_MODE=record      # or replay, the default
+    STRAVA_CLIENT_CASSETTE_LATENCY=0.05     # seconds per replayed request
+
+A cassette is a gzipped file with one JSON object per response: The key
+of the request, status, headers and body. Recording appends to it.
+
+Requests are keyed by method, path, sorted query and a hash of the
+Authorization header and the body, so the responses of different users
+are told apart without storing their tokens in the keys. A replayed key
+returns its responses in the order they were recorded, repeating the
+last one. Requests without a recorded key fall back to the responses
+recorded for the same method, path and query (e.g. exchanging a new
+OAuth code), else get a 404.
+
+Responses are stored as Strava sent them, access tokens of the OAuth
+endpoints included. Keep cassettes private.
+"""
+import atexit
+import base64
+import collections
+import functools
+import gzip
+import hashlib
+import http.client
+import json
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from requests import Response
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+_NOT_FOUND = json.dumps({"message": "Record Not Found", "errors": []}).encode("utf-8")
+
+
+@functools.lru_cache(maxsize=4096)
+def _loose_key(method, url):
+    url = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(url.query, keep_blank_values=True)))
+    return "{} {}?{}".format(method, url.path, query)
+
+
+def request_keys(request):
+    """
+    :param request: requests.PreparedRequest
+    :returns: (key, loose_key) tuple.
+    """
+    loose_key = _loose_key(request.method, request.url)
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    digest = hashlib.sha1(request.headers.get("Authorization", "").encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(body)
+    return "{} {}".format(loose_key, digest.hexdigest()[:16]), loose_key
+
+
+class Cassette(object):
+
+    def __init__(self, path, mode=MODE_REPLAY):
+        if mode not in (MODE_RECORD, MODE_REPLAY):
+            raise ValueError("Unknown cassette mode {!r}".format(mode))
+        self.path = path
+        self.mode = mode
+        self.__lock = threading.Lock()
+        self.__responses = collections.defaultdict(list)
+        self.__loose_responses = collections.defaultdict(list)
+        self.__positions = collections.Counter()
+        self.__file = None
+        if mode == MODE_REPLAY:
+            self._load()
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    entry = json.loads(line)
+                    if "body_b64" in entry:
+                        body = base64.b64decode(entry["body_b64"])
+                    else:
+                        body = entry["body"].encode("utf-8")
+                    response = (entry["status"], entry["headers"], body)
+                    self.__responses[entry["key"]].append(response)
+                    loose_key = entry["key"].rsplit(" ", 1)[0]
+                    self.__loose_responses[loose_key].append(response)
+            except EOFError:
+                # Recording was interrupted, the last lines are lost.
+                pass
+
+    def __len__(self):
+        return sum(len(r) for r in self.__responses.values())
+
+    def record(self, request, response):
+        key, _ = request_keys(request)
+        entry = {
+            "key": key,
+            "status": response.status_code,
+            "headers": dict(response.headers),
+        }
+        try:
+            entry["body"] = response.content.decode("utf-8")
+        except UnicodeDecodeError:
+            entry["body_b64"] = base64.b64encode(response.content).decode("ascii")
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self.__lock:
+            if self.__file is None:
+                self.__file = gzip.open(self.path, "at", encoding="utf-8")
+                atexit.register(self.close)
+            self.__file.write(line)
+
+    def replay(self, request):
+        """
+        :returns: (status, headers, body) tuple, or None.
+        """
+        key, loose_key = request_keys(request)
+        with self.__lock:
+            if key not in self.__responses:
+                key = loose_key
+                responses = self.__loose_responses.get(key)
+            else:
+                responses = self.__responses[key]
+            if not responses:
+                return None
+            position = self.__positions[key]
+            self.__positions[key] = position + 1
+        return responses[min(position, len(responses) - 1)]
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Makes requests as usual and records the responses.
+    """
+
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.__cassette = cassette
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.__cassette.record(request, response)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answers requests from a cassette, without any network access.
+    """
+
+    def __init__(self, cassette, latency=0.0):
+        """
+        :param latency: seconds every request takes.
+        """
+        super().__init__()
+        self.__cassette = cassette
+        self.__latency = latency
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None):
+        if self.__latency:
+            time.sleep(self.__latency)
+
+        replayed = self.__cassette.replay(request)
+        if replayed is None:
+            status, headers, body = 404, {"Content-Type": "application/json"}, _NOT_FOUND
+        else:
+            status, headers, body = replayed
+
+        response = Response()
+        response.status_code = status
+        response.reason = http.client.responses.get(status, "")
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = "utf-8"
+        response._content = body
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def get_cassette(path, mode=MODE_REPLAY):
+    """
+    The Cassette for path, shared by all clients of a process.
+    """
+    with _cassettes_lock:
+        cassette = _cassettes.get((path, mode))
+        if cassette is None:
+            cassette = _cassettes[(path, mode)] = Cassette(path, mode=mode)
+        return cassette
+
+
+def adapter_from_env(environ):
+    """
+    Create the adapter configured by STRAVA_CLIENT_CASSETTE,
+    STRAVA_CLIENT_CASSETTE_MODE and STRAVA_CLIENT_CASSETTE_LATENCY.
+
+    :returns: transport adapter or None if no cassette is configured.
+    """
+    path = environ.get("STRAVA_CLIENT_CASSETTE")
+    if not path:
+        return None
+    mode = environ.get("STRAVA_CLIENT_CASSETTE_MODE") or MODE_REPLAY
+    cassette = get_cassette(path, mode=mode)
+    if mode == MODE_RECORD:
+        return RecordingAdapter(cassette)
+    latency = float(environ.get("STRAVA_CLIENT_CASSETTE_LATENCY") or 0.0)
+    return ReplayAdapter(cassette, latency=latency)
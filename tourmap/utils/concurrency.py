@@ -0,0 +1,123 @@
+"""
+AIMD control of the number of jobs running concurrently.
+
+Like TCP's congestion control: The limit grows by one after a window of
+healthy requests and is cut by a factor once requests become slow, fail,
+or the rate limit budget runs low. Being throttled by Strava cuts it right
+away, without waiting for the window to fill.
+
+    controller = ConcurrencyController(min_limit=1, max_limit=16)
+    controller.observe(0.3)
+    controller.observe(5.0, error=True)
+    controller.adjust(remaining_budget=100)
+    controller.limit
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyController(object):
+
+    def __init__(self, min_limit=1, max_limit=16, initial_limit=None,
+                 latency_target_seconds=2.0, error_rate_threshold=0.1,
+                 decrease_factor=0.5, window=20):
+        """
+        :param latency_target_seconds: mean request latency above which
+            Strava is considered to be struggling.
+        :param error_rate_threshold: fraction of failed requests in a
+            window above which the limit is decreased.
+        :param window: number of requests observed before the limit is
+            changed again.
+        """
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError("Need 1 <= min_limit <= max_limit")
+        if not 0.0 < decrease_factor < 1.0:
+            raise ValueError("decrease_factor needs to be in (0.0, 1.0)")
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.__latency_target_seconds = latency_target_seconds
+        self.__error_rate_threshold = error_rate_threshold
+        self.__decrease_factor = decrease_factor
+        self.__window = window
+
+        self.__lock = threading.Lock()
+        self.__limit = self._clamp(initial_limit or min_limit)
+        self.__reset()
+
+    def __reset(self):
+        self.__requests = 0
+        self.__errors = 0
+        self.__latency_sum = 0.0
+        self.__throttled = False
+
+    def _clamp(self, limit):
+        return max(self.min_limit, min(self.max_limit, int(limit)))
+
+    @property
+    def limit(self):
+        with self.__lock:
+            return self.__limit
+
+    def observe(self, latency, error=False):
+        """
+        Record a request that took latency seconds.
+        """
+        with self.__lock:
+            self.__requests += 1
+            self.__latency_sum += latency
+            if error:
+                self.__errors += 1
+
+    def throttled(self):
+        """
+        A request was rate limited.
+        """
+        with self.__lock:
+            self.__throttled = True
+
+    def adjust(self, remaining_budget=None):
+        """
+        Change the limit based on what was observed since the last change.
+
+        :param remaining_budget: requests left in the rate limit, if known.
+        :returns: the new limit.
+        """
+        with self.__lock:
+            limit = self.__limit
+            reason = None
+            if self.__throttled:
+                reason = "throttled"
+            elif remaining_budget is not None and remaining_budget < limit:
+                reason = "budget of {} requests left".format(remaining_budget)
+            elif self.__requests >= self.__window:
+                error_rate = self.__errors / self.__requests
+                mean_latency = self.__latency_sum / self.__requests
+                if error_rate > self.__error_rate_threshold:
+                    reason = "error rate {:.2f}".format(error_rate)
+                elif mean_latency > self.__latency_target_seconds:
+                    reason = "mean latency {:.2f}s".format(mean_latency)
+                elif remaining_budget is None or remaining_budget >= 2 * limit:
+                    limit += 1
+                else:
+                    # Healthy, but not enough budget to grow.
+                    self.__reset()
+                    return limit
+            else:
+                return limit
+
+            if reason is not None:
+                limit = limit * self.__decrease_factor
+            limit = self._clamp(limit)
+            if limit != self.__limit:
+                logger.info("Concurrency %d -> %d%s", self.__limit, limit,
+                            " ({})".format(reason) if reason else "")
+            self.__limit = limit
+            self.__reset()
+            return limit
+
+    def __repr__(self):
+        return "<ConcurrencyController limit={} min={} max={}>".format(
+            self.__limit, self.min_limit, self.max_limit)
@@ -0,0 +1,95 @@
+"""
+Wall-clock deadlines for jobs making many requests.
+
+Request timeouts only bound a single socket operation. A Deadline bounds
+a whole job: It is started when the job starts running, checked before
+every request and caps the request timeouts to the time left. A watchdog
+can also cancel it, which makes the next check fail.
+"""
+import threading
+import time
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request is attempted after the deadline expired or the
+    deadline was cancelled.
+    """
+    pass
+
+
+class Deadline(object):
+
+    def __init__(self, seconds, clock=time.monotonic):
+        """
+        :param seconds: time a job has once started.
+        :param clock: returns monotonic seconds.
+        """
+        self.seconds = seconds
+        self.__clock = clock
+        self.__started_at = None
+        self.__cancelled = threading.Event()
+
+    def start(self):
+        if self.__started_at is None:
+            self.__started_at = self.__clock()
+        return self
+
+    @property
+    def started(self):
+        return self.__started_at is not None
+
+    @property
+    def expires_at(self):
+        """
+        Clock value when the deadline expires, None if not started.
+        """
+        if self.__started_at is None:
+            return None
+        return self.__started_at + self.seconds
+
+    def elapsed(self):
+        if self.__started_at is None:
+            return 0.0
+        return self.__clock() - self.__started_at
+
+    def remaining(self):
+        """
+        Seconds left, never negative. A deadline not started yet has all
+        its time left.
+        """
+        return max(self.seconds - self.elapsed(), 0.0)
+
+    def expired(self):
+        return self.started and self.remaining() <= 0.0
+
+    def cancel(self):
+        self.__cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self.__cancelled.is_set()
+
+    def check(self):
+        """
+        :raises DeadlineExceeded: if expired or cancelled.
+        """
+        if self.cancelled:
+            raise DeadlineExceeded(
+                "Cancelled after {:.1f} seconds".format(self.elapsed()))
+        if self.expired():
+            raise DeadlineExceeded("Expired after {:.1f} seconds".format(self.elapsed()))
+
+    def cap_timeout(self, timeout):
+        """
+        Cap a requests timeout, a number or a (connect, read) tuple, to
+        the time left.
+        """
+        remaining = self.remaining()
+        if isinstance(timeout, tuple):
+            return tuple(min(t, remaining) for t in timeout)
+        return min(timeout, remaining)
+
+    def __repr__(self):
+        return "<Deadline seconds={} remaining={:.1f}{}>".format(
+            self.seconds, self.remaining(), " cancelled" if self.cancelled else "")
@@ -0,0 +1,117 @@
+"""
+Compact storage of the summary polylines of activities.
+
+Strava's summary polylines are Google encoded polylines: The deltas of
+consecutive points in units of 1e-5 degrees, written as base64-like
+variable length integers. Decoding them takes a lot of Python work per
+point, too much to be done for every activity of a tour on every view.
+
+When an activity is stored, the deltas are unpacked once into an array
+of little-endian int32, alternating latitude and longitude, along with
+the point count and bounding box. The browser sums the deltas up itself
+(tourmap-leaflet-map.js), so serving a tour only base64-encodes bytes.
+"""
+import array
+import base64
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Units of the deltas in degrees.
+PRECISION = 1e-5
+
+
+def polyline_deltas(encoded):
+    """
+    Decode an encoded polyline into its deltas, without summing them up.
+
+    :returns: array.array("i") of latitude and longitude deltas.
+    :raises ValueError: if the polyline is truncated.
+    """
+    deltas = array.array("i")
+    value, shift = 0, 0
+    for c in encoded:
+        b = ord(c) - 63
+        value |= (b & 0x1f) << shift
+        if b >= 0x20:
+            shift += 5
+            continue
+        deltas.append(~(value >> 1) if value & 1 else value >> 1)
+        value, shift = 0, 0
+    if shift or len(deltas) % 2:
+        raise ValueError("Truncated polyline")
+    return deltas
+
+
+def pack_polyline(encoded):
+    """
+    :returns: dict with the values of the packed_latlngs, point_count,
+        min_lat, min_lng, max_lat and max_lng columns of an Activity,
+        all None if there is no polyline. A broken polyline has no
+        points and no bounding box.
+    """
+    result = {
+        "packed_latlngs": None,
+        "point_count": None,
+        "min_lat": None,
+        "min_lng": None,
+        "max_lat": None,
+        "max_lng": None,
+    }
+    if not encoded:
+        return result
+
+    try:
+        deltas = polyline_deltas(encoded)
+    except ValueError as e:
+        logger.warning("Not packing polyline: %s", e)
+        deltas = array.array("i")
+    if not deltas:
+        result.update({"packed_latlngs": b"", "point_count": 0})
+        return result
+
+    lat, lng = 0, 0
+    min_lat = min_lng = sys.maxsize
+    max_lat = max_lng = -sys.maxsize
+    for i in range(0, len(deltas), 2):
+        lat += deltas[i]
+        lng += deltas[i + 1]
+        min_lat, max_lat = min(min_lat, lat), max(max_lat, lat)
+        min_lng, max_lng = min(min_lng, lng), max(max_lng, lng)
+
+    if sys.byteorder != "little":
+        deltas.byteswap()
+
+    result.update({
+        "packed_latlngs": deltas.tobytes(),
+        "point_count": len(deltas) // 2,
+        "min_lat": round(min_lat * PRECISION, 5),
+        "min_lng": round(min_lng * PRECISION, 5),
+        "max_lat": round(max_lat * PRECISION, 5),
+        "max_lng": round(max_lng * PRECISION, 5),
+    })
+    return result
+
+
+def unpack_latlngs(packed):
+    """
+    The inverse of pack_polyline(): A list of (lat, lng) tuples like
+    polyline.decode() returns them.
+    """
+    deltas = array.array("i")
+    deltas.frombytes(packed)
+    if sys.byteorder != "little":
+        deltas.byteswap()
+
+    result = []
+    lat, lng = 0, 0
+    for i in range(0, len(deltas), 2):
+        lat += deltas[i]
+        lng += deltas[i + 1]
+        result.append((round(lat * PRECISION, 5), round(lng * PRECISION, 5)))
+    return result
+
+
+def packed_to_base64(packed):
+    return base64.b64encode(packed).decode("ascii")
@@ -0,0 +1,87 @@
+"""
+In-process counters, gauges and histograms.
+
+There is no metrics backend, the poller logs a snapshot every now and
+then. All methods are thread safe.
+
+    metrics = Metrics()
+    metrics.incr("jobs_submitted")
+    metrics.observe("job_duration_seconds", 1.3)
+    metrics.snapshot()
+"""
+import bisect
+import threading
+
+# Upper bounds of the default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Histogram(object):
+    """
+    Counts of observed values per bucket. The last bucket catches
+    everything above the largest bound.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip(bounds, self.counts)),
+        }
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+
+    def incr(self, name, value=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.__lock:
+            self.__gauges[name] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS):
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def counter(self, name):
+        with self.__lock:
+            return self.__counters.get(name, 0)
+
+    def gauge(self, name):
+        with self.__lock:
+            return self.__gauges.get(name)
+
+    def snapshot(self):
+        """
+        :returns: dict with counters, gauges and histograms.
+        """
+        with self.__lock:
+            return {
+                "counters": dict(self.__counters),
+                "gauges": dict(self.__gauges),
+                "histograms": {
+                    name: h.snapshot() for name, h in self.__histograms.items()
+                },
+            }
@@ -0,0 +1,161 @@
+"""
+Client side bookkeeping of Strava's rate limits.
+
+Strava limits the requests of an application in two fixed windows: 15
+minutes (starting at 0, 15, 30 and 45 minutes after the hour) and one
+day (starting at midnight UTC). Every API response reports the limits
+and the current usage in the X-RateLimit-Limit and X-RateLimit-Usage
+headers, formatted as "15min,daily".
+
+A single RateLimiter is shared by all StravaClient instances of a pool.
+Each window is a bucket of tokens that is refilled at the start of the
+next window. Requests take a token before they are sent and responses
+correct the buckets with Strava's view through the headers. Once a
+bucket is empty, requests are refused locally until the window resets,
+rather than being sent and answered with a 429.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Length of Strava's windows in seconds: 15 minutes and a day.
+WINDOWS = (15 * 60, 24 * 60 * 60)
+
+
+def _parse_header_pair(value):
+    """
+    Parse "600,30000" into (600, 30000). Returns None for garbage.
+    """
+    try:
+        result = tuple(int(v) for v in value.split(","))
+    except (AttributeError, ValueError):
+        return None
+    return result if len(result) == len(WINDOWS) else None
+
+
+class RateLimiter(object):
+
+    @staticmethod
+    def from_env(environ):
+        """
+        Create a RateLimiter from STRAVA_CLIENT_RATE_LIMITS ("15min,daily")
+        and STRAVA_CLIENT_RATE_LIMIT_RESERVE settings.
+        """
+        limits = environ.get("STRAVA_CLIENT_RATE_LIMITS", "100,1000")
+        if isinstance(limits, str):
+            limits = _parse_header_pair(limits)
+            if limits is None:
+                raise ValueError("Bad STRAVA_CLIENT_RATE_LIMITS")
+        reserve = float(environ.get("STRAVA_CLIENT_RATE_LIMIT_RESERVE", 0.05))
+        return RateLimiter(limits=limits, reserve=reserve)
+
+    def __init__(self, limits=(100, 1000), reserve=0.0, clock=time.time):
+        """
+        :param limits: initial limits for the 15 minute and the daily
+            window. Updated from response headers.
+        :param reserve: fraction of each window that is not handed out,
+            leaving room for other users of the same application.
+        :param clock: returns the current Unix time.
+        """
+        if not 0.0 <= reserve < 1.0:
+            raise ValueError("reserve needs to be in [0.0, 1.0)")
+
+        self.__lock = threading.Lock()
+        self.__clock = clock
+        self.__reserve = reserve
+        self.__limits = list(limits)
+        self.__used = [0] * len(WINDOWS)
+        self.__window_starts = self._window_starts(self.__clock())
+
+    @staticmethod
+    def _window_starts(now):
+        return [now - now % seconds for seconds in WINDOWS]
+
+    def _roll(self, now):
+        """
+        Refill the buckets of windows that have passed.
+        """
+        window_starts = self._window_starts(now)
+        for i, start in enumerate(window_starts):
+            if start != self.__window_starts[i]:
+                self.__used[i] = 0
+        self.__window_starts = window_starts
+
+    def _budgets(self):
+        return [int(limit * (1.0 - self.__reserve)) for limit in self.__limits]
+
+    def _retry_at(self):
+        """
+        The reset of the longest exhausted window, or None.
+        """
+        result = None
+        for i, budget in enumerate(self._budgets()):
+            if self.__used[i] >= budget:
+                result = self.__window_starts[i] + WINDOWS[i]
+        return result
+
+    def remaining(self):
+        """
+        Number of requests that can be made right now.
+        """
+        with self.__lock:
+            self._roll(self.__clock())
+            return max(min(b - u for b, u in zip(self._budgets(), self.__used)), 0)
+
+    def retry_at(self):
+        """
+        :returns: Unix time when requests can be made again or None if
+            there is budget left.
+        """
+        with self.__lock:
+            self._roll(self.__clock())
+            return self._retry_at()
+
+    def try_acquire(self):
+        """
+        Take a token for one request.
+
+        :returns: None if the request can be made, else the Unix time
+            when to try again.
+        """
+        with self.__lock:
+            self._roll(self.__clock())
+            retry_at = self._retry_at()
+            if retry_at is not None:
+                return retry_at
+            for i in range(len(self.__used)):
+                self.__used[i] += 1
+            return None
+
+    def update_from_headers(self, headers):
+        """
+        Correct the buckets with the X-RateLimit-Limit and X-RateLimit-Usage
+        headers of a response. Usage reported by Strava includes requests
+        made by other processes with the same application, so it wins if
+        it is higher than what we counted ourselves.
+        """
+        limits = _parse_header_pair(headers.get("X-RateLimit-Limit"))
+        usage = _parse_header_pair(headers.get("X-RateLimit-Usage"))
+        with self.__lock:
+            self._roll(self.__clock())
+            if limits is not None:
+                self.__limits = list(limits)
+            if usage is not None:
+                self.__used = [
+                    max(u, reported) for u, reported in zip(self.__used, usage)
+                ]
+
+    def exhaust(self):
+        """
+        Strava answered with a 429 anyhow. Mark the short window as
+        used up, the headers of that response tell about the daily one.
+        """
+        with self.__lock:
+            self._roll(self.__clock())
+            self.__used[0] = max(self.__used[0], self.__limits[0])
+            return self._retry_at()
+
+    def __repr__(self):
+        return "<RateLimiter limits={} used={}>".format(self.__limits, self.__used)
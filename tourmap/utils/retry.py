@@ -0,0 +1,194 @@
+"""
+Retrying failed requests to Strava and a circuit breaker.
+
+A RetryPolicy decides how often and after how long a StravaClient repeats
+an idempotent request that failed with a timeout, a reset connection or
+a 5xx response. Delays grow exponentially with full jitter, so clients
+that failed together do not retry together.
+
+A single CircuitBreaker is shared by all StravaClient instances of a pool,
+like the RateLimiter. After failure_threshold consecutive failed requests
+it opens and requests are refused locally for open_seconds, rather than
+being sent to a Strava that is down. Then a single probe request is let
+through (half open): If it succeeds, the breaker closes, else it opens
+again.
+"""
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# Exported as gauge, in the order of severity.
+STATE_VALUES = {
+    STATE_CLOSED: 0,
+    STATE_HALF_OPEN: 1,
+    STATE_OPEN: 2,
+}
+
+# Responses worth trying again.
+RETRY_STATUS_CODES = frozenset([500, 502, 503, 504])
+
+
+class RetryPolicy(object):
+
+    @staticmethod
+    def from_env(environ):
+        """
+        Create a RetryPolicy from STRAVA_CLIENT_RETRIES,
+        STRAVA_CLIENT_RETRY_BACKOFF_SECONDS and
+        STRAVA_CLIENT_RETRY_BACKOFF_MAX_SECONDS.
+        """
+        return RetryPolicy(
+            retries=int(environ.get("STRAVA_CLIENT_RETRIES", 2)),
+            backoff_seconds=float(
+                environ.get("STRAVA_CLIENT_RETRY_BACKOFF_SECONDS", 0.5)),
+            backoff_max_seconds=float(
+                environ.get("STRAVA_CLIENT_RETRY_BACKOFF_MAX_SECONDS", 8.0)),
+        )
+
+    def __init__(self, retries=2, backoff_seconds=0.5, backoff_max_seconds=8.0,
+                 random=random.random, sleep=time.sleep):
+        """
+        :param retries: how often a request is repeated at most.
+        :param backoff_seconds: upper bound of the delay before the
+            first retry, doubled for every further one.
+        :param backoff_max_seconds: cap of the upper bound.
+        :param random: returns a float in [0.0, 1.0).
+        """
+        if retries < 0:
+            raise ValueError("retries needs to be >= 0")
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.__random = random
+        self.__sleep = sleep
+
+    def delay(self, attempt):
+        """
+        :param attempt: number of the failed attempt, starting at 0.
+        :returns: seconds to wait before the next one.
+        """
+        bound = min(self.backoff_seconds * 2 ** attempt, self.backoff_max_seconds)
+        return bound * self.__random()
+
+    def sleep(self, seconds):
+        self.__sleep(seconds)
+
+
+class CircuitBreaker(object):
+
+    @staticmethod
+    def from_env(environ, metrics=None):
+        """
+        Create a CircuitBreaker from STRAVA_CLIENT_BREAKER_FAILURE_THRESHOLD
+        and STRAVA_CLIENT_BREAKER_OPEN_SECONDS.
+        """
+        return CircuitBreaker(
+            failure_threshold=int(
+                environ.get("STRAVA_CLIENT_BREAKER_FAILURE_THRESHOLD", 10)),
+            open_seconds=float(environ.get("STRAVA_CLIENT_BREAKER_OPEN_SECONDS", 60.0)),
+            metrics=metrics,
+        )
+
+    def __init__(self, failure_threshold=10, open_seconds=60.0, metrics=None,
+                 clock=time.time):
+        """
+        :param failure_threshold: consecutive failures that open the
+            breaker. 0 disables it.
+        :param open_seconds: how long requests are refused when open.
+        :param metrics: a tourmap.utils.metrics.Metrics for the state
+            and the number of trips and refused requests.
+        :param clock: returns the current Unix time.
+        """
+        self.__lock = threading.Lock()
+        self.__clock = clock
+        self.__metrics = metrics
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+
+        self.__state = STATE_CLOSED
+        self.__failures = 0
+        self.__opened_at = None
+        self.__probing = False
+        self._set_state(STATE_CLOSED)
+
+    def _set_state(self, state):
+        if state != self.__state:
+            logger.warning("Circuit breaker %s -> %s", self.__state, state)
+        self.__state = state
+        if self.__metrics is not None:
+            self.__metrics.set_gauge("circuit_breaker_state", STATE_VALUES[state])
+
+    def _incr(self, name):
+        if self.__metrics is not None:
+            self.__metrics.incr(name)
+
+    @property
+    def state(self):
+        with self.__lock:
+            return self.__state
+
+    def retry_at(self):
+        """
+        :returns: Unix time when requests are let through again, or None
+            if they are now.
+        """
+        with self.__lock:
+            if self.__state != STATE_OPEN:
+                return None
+            retry_at = self.__opened_at + self.open_seconds
+            return retry_at if retry_at > self.__clock() else None
+
+    def allow(self):
+        """
+        Called before a request is sent.
+
+        :returns: None if the request may be sent, else the Unix time
+            when to try again.
+        """
+        with self.__lock:
+            if self.__state == STATE_OPEN:
+                retry_at = self.__opened_at + self.open_seconds
+                if retry_at > self.__clock():
+                    self._incr("circuit_breaker_refused")
+                    return retry_at
+                self._set_state(STATE_HALF_OPEN)
+
+            if self.__state == STATE_HALF_OPEN:
+                if self.__probing:
+                    # Somebody else's request decides.
+                    self._incr("circuit_breaker_refused")
+                    return self.__clock() + self.open_seconds
+                self.__probing = True
+            return None
+
+    def cancel(self):
+        """
+        A request that allow() let through was not sent after all.
+        """
+        with self.__lock:
+            self.__probing = False
+
+    def record_success(self):
+        with self.__lock:
+            self.__failures = 0
+            self.__probing = False
+            if self.__state != STATE_CLOSED:
+                self._set_state(STATE_CLOSED)
+
+    def record_failure(self):
+        with self.__lock:
+            self.__failures += 1
+            probe_failed = self.__state == STATE_HALF_OPEN
+            self.__probing = False
+            if probe_failed or (self.__state == STATE_CLOSED and
+                                0 < self.failure_threshold <= self.__failures):
+                self.__opened_at = self.__clock()
+                self._incr("circuit_breaker_trips")
+                self._set_state(STATE_OPEN)
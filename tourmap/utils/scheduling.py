@@ -0,0 +1,111 @@
+"""
+Weighted fair choice between classes of jobs.
+
+Stride scheduling: Every class has a pass value that advances by
+1 / weight whenever a job of it is picked, and the class with the lowest
+pass goes next. Classes with jobs waiting get slots in proportion to their
+weights. A class coming back after being idle starts at the current pass
+of the others, so it cannot bank credit while it had nothing to do.
+
+On top, a class can have a guaranteed minimum share: If it got less than
+that among the last window picks while having jobs waiting, it goes next.
+
+    scheduler = FairScheduler({"latest": 4, "backfill": 1},
+                              min_shares={"latest": 0.5})
+    scheduler.order({"latest": 10, "backfill": 100}, slots=5)
+"""
+import collections
+
+
+def parse_class_values(value, cast=float):
+    """
+    Parse "latest=4,backfill=1" into {"latest": 4.0, "backfill": 1.0}.
+    Dicts are passed through.
+    """
+    if isinstance(value, dict):
+        return {k: cast(v) for k, v in value.items()}
+    result = {}
+    for item in filter(None, (i.strip() for i in value.split(","))):
+        name, sep, v = item.partition("=")
+        if not sep:
+            raise ValueError("Expected name=value, got {!r}".format(item))
+        result[name.strip()] = cast(v)
+    return result
+
+
+class FairScheduler(object):
+
+    def __init__(self, weights, min_shares=None, window=100):
+        """
+        :param weights: dict mapping class name to a positive weight.
+            Ties are broken in the order of this dict.
+        :param min_shares: dict mapping class name to the fraction of
+            slots it gets at least while it has jobs waiting.
+        :param window: number of recent picks min_shares refer to.
+        """
+        min_shares = min_shares or {}
+        if any(w <= 0 for w in weights.values()):
+            raise ValueError("Weights need to be positive")
+        if any(c not in weights for c in min_shares):
+            raise ValueError("min_shares for unknown classes")
+        if sum(min_shares.values()) > 1.0 or any(s < 0 for s in min_shares.values()):
+            raise ValueError("min_shares need to be positive and add up to 1 at most")
+
+        self.weights = dict(weights)
+        self.min_shares = {c: min_shares.get(c, 0.0) for c in weights}
+        self.__classes = list(weights)
+        self.__pass = {c: 0.0 for c in weights}
+        self.__vtime = 0.0
+        self.__recent = collections.deque(maxlen=window)
+
+    def _share(self, job_class):
+        if not self.__recent:
+            return 0.0
+        return self.__recent.count(job_class) / len(self.__recent)
+
+    def pick(self, backlog):
+        """
+        :param backlog: dict mapping class name to the number of jobs
+            waiting.
+        :returns: the class to run a job of next, or None.
+        """
+        active = [c for c in self.__classes if backlog.get(c, 0) > 0]
+        if not active:
+            return None
+
+        for c in active:
+            self.__pass[c] = max(self.__pass[c], self.__vtime)
+
+        deficits = [
+            (self.min_shares[c] - self._share(c), c) for c in active
+            if self._share(c) < self.min_shares[c]
+        ]
+        if deficits:
+            job_class = max(deficits, key=lambda d: d[0])[1]
+        else:
+            job_class = min(active, key=lambda c: self.__pass[c])
+
+        self.__vtime = self.__pass[job_class]
+        self.__pass[job_class] += 1.0 / self.weights[job_class]
+        self.__recent.append(job_class)
+        return job_class
+
+    def order(self, backlog, slots):
+        """
+        Pick up to slots jobs.
+
+        :returns: list of class names, one entry per job.
+        """
+        backlog = dict(backlog)
+        result = []
+        while len(result) < slots:
+            job_class = self.pick(backlog)
+            if job_class is None:
+                break
+            backlog[job_class] -= 1
+            result.append(job_class)
+        return result
+
+    def __repr__(self):
+        return "<FairScheduler weights={} min_shares={}>".format(self.weights,
+                                                                 self.min_shares)
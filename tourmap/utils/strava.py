@@ -3,10 +3,13 @@ Very basic wrapper around the Strava API V3.
 """
 import logging
 import os
-from urllib.parse import urljoin, urlencode
+from urllib.parse import urljoin, urlencode, urlsplit
 
 import requests
 
+from tourmap.utils import cassette
+from tourmap.utils.retry import RETRY_STATUS_CODES, RetryPolicy
+
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +31,37 @@ class StravaTimeout(StravaError):
     pass
 
 
+class StravaNotFound(StravaError):
+    """
+    Raised on a 404, e.g. for an activity that was deleted.
+    """
+    pass
+
+
+class StravaRateLimited(StravaError):
+    """
+    Raised when a request was not made because the rate limit was
+    exhausted, or when Strava answered with a 429.
+
+    :ivar retry_at: Unix time when to try again, if known.
+    """
+    def __init__(self, retry_at=None):
+        super().__init__(retry_at)
+        self.retry_at = retry_at
+
+
+class StravaUnavailable(StravaError):
+    """
+    Raised when a request was not made because the circuit breaker is
+    open after too many failed requests.
+
+    :ivar retry_at: Unix time when to try again.
+    """
+    def __init__(self, retry_at=None):
+        super().__init__(retry_at)
+        self.retry_at = retry_at
+
+
 class InvalidAccessToken(StravaError):
     """Issues with the provided access token."""
     def __init__(self, message, error_data):
@@ -41,6 +75,133 @@ class InvalidAthleteAccessToken(InvalidAccessToken):
     pass
 
 
+def raise_access_token_errors(data, headers):
+    """
+    Raise InvalidAccessToken or InvalidAthleteAccessToken if the body of
+    a 4xx response says so. Shared with the async client.
+    """
+    msg = data.get("message")
+    error_data = {
+        "response_data": data,
+        "response_headers": dict(headers),
+    }
+    errors = data.get("errors", [])
+    for e in errors:
+        if e.get("code") == "invalid" and e.get("field") == "access_token":
+            if e.get("resource") == "Athlete":
+                raise InvalidAthleteAccessToken(msg, error_data)
+
+            raise InvalidAccessToken(msg, error_data)
+
+
+class RequestAttempts(object):
+    """
+    The attempts of sending a single request, shared by StravaClient and
+    AsyncStravaClient so both treat deadlines, the rate limiter, retries
+    and the circuit breaker the same. Sending and sleeping is left to
+    the client:
+
+        attempts = RequestAttempts(...)
+        while True:
+            timeout = attempts.begin()
+            ...send the request with timeout, catching retriable errors...
+            delay = attempts.end(status, headers, error)
+            if delay is None:
+                break
+            sleep(delay)
+
+    A request is retried according to retry_policy if retry is True and
+    it failed with a timeout, a connection error or a 5xx response.
+    """
+
+    def __init__(self, method, url, timeout, retry=False, rate_limited=False,
+                 deadline=None, rate_limiter=None, retry_policy=None,
+                 circuit_breaker=None, metrics=None):
+        self.__method = method
+        self.__url = url
+        self.__timeout = timeout
+        self.__rate_limited = rate_limited and rate_limiter is not None
+        self.__deadline = deadline
+        self.__rate_limiter = rate_limiter
+        self.__retry_policy = retry_policy
+        self.__circuit_breaker = circuit_breaker
+        self.__metrics = metrics
+        self.__retries = retry_policy.retries if retry and retry_policy else 0
+        self.__attempt = 0
+
+    def _incr(self, name):
+        if self.__metrics is not None:
+            self.__metrics.incr(name)
+
+    def begin(self):
+        """
+        Called before every attempt. Checks the deadline and asks the
+        circuit breaker and the rate limiter whether it may be sent.
+
+        :returns: the timeout for the attempt, capped by the deadline.
+        :raises: DeadlineExceeded, StravaUnavailable, StravaRateLimited
+        """
+        timeout = self.__timeout
+        if self.__deadline is not None:
+            self.__deadline.check()
+            timeout = self.__deadline.cap_timeout(timeout)
+
+        if self.__circuit_breaker is not None:
+            retry_at = self.__circuit_breaker.allow()
+            if retry_at is not None:
+                raise StravaUnavailable(retry_at)
+
+        if self.__rate_limited:
+            retry_at = self.__rate_limiter.try_acquire()
+            if retry_at is not None:
+                self.abort()
+                raise StravaRateLimited(retry_at)
+        return timeout
+
+    def abort(self):
+        """
+        The attempt failed in a way that tells nothing about Strava.
+        """
+        if self.__circuit_breaker is not None:
+            self.__circuit_breaker.cancel()
+
+    def end(self, status, headers, error=None):
+        """
+        Called after every attempt with the response, or the timeout or
+        connection error it failed with.
+
+        :returns: seconds to sleep before the next attempt, or None if
+            there is none: The caller returns the response or raises the
+            error then.
+        """
+        if error is None and self.__rate_limited:
+            self.__rate_limiter.update_from_headers(headers)
+
+        failed = error is not None or status in RETRY_STATUS_CODES
+        if self.__circuit_breaker is not None:
+            if failed:
+                self.__circuit_breaker.record_failure()
+            else:
+                self.__circuit_breaker.record_success()
+        if not failed:
+            return None
+
+        if self.__attempt >= self.__retries:
+            if self.__attempt > 0:
+                self._incr("strava_retries_exhausted")
+            return None
+        delay = self.__retry_policy.delay(self.__attempt)
+        if self.__deadline is not None and self.__deadline.remaining() <= delay:
+            return None
+
+        self.__attempt += 1
+        self._incr("strava_retries")
+        logger.info("Retrying %s %s (attempt %s) in %.2fs after %s", self.__method,
+                    urlsplit(self.__url).path, self.__attempt, delay,
+                    repr(error) if error is not None else status)
+        return delay
+
+
 class StravaClient(object):
 
     BASE_URL = "https://www.strava.com"
@@ -56,32 +217,103 @@ class StravaClient(object):
     }
 
     @staticmethod
-    def from_env(environ=None):
+    def from_env(environ=None, **kwargs):
         """
         Use some well known environment variables to initialize the client.
+
+        :param kwargs: passed through to the constructor.
         """
         environ = environ or os.environ
         client_id = environ["STRAVA_CLIENT_ID"]
         client_secret = environ["STRAVA_CLIENT_SECRET"]
         base_url = environ.get("STRAVA_CLIENT_BASE_URL", StravaClient.BASE_URL)
-        return StravaClient(client_id, client_secret, base_url=base_url)
+        kwargs.setdefault("adapter", cassette.adapter_from_env(environ))
+        kwargs.setdefault("retry_policy", RetryPolicy.from_env(environ))
+        return StravaClient(client_id, client_secret, base_url=base_url, **kwargs)
 
     def __init__(self, client_id, client_secret, base_url=BASE_URL,
-                 timeout=DEFAULT_TIMEOUT):
+                 timeout=DEFAULT_TIMEOUT, rate_limiter=None, adapter=None,
+                 retry_policy=None, circuit_breaker=None, metrics=None):
+        """
+        :param rate_limiter: A tourmap.utils.ratelimit.RateLimiter, usually
+            shared by all clients of a pool, consulted before each API
+            request.
+        :param adapter: A requests transport adapter used for all requests,
+            e.g. to record or replay them (tourmap.utils.cassette).
+        :param retry_policy: A tourmap.utils.retry.RetryPolicy for API
+            requests failing with timeouts, connection errors or 5xx
+            responses. Not retried if None.
+        :param circuit_breaker: A tourmap.utils.retry.CircuitBreaker,
+            usually shared by all clients of a pool, consulted before
+            each request.
+        :param metrics: A tourmap.utils.metrics.Metrics counting retries.
+        """
         self.__client_id = client_id
         self.__client_secret = client_secret
+        self.__rate_limiter = rate_limiter
+        self.__retry_policy = retry_policy
+        self.__circuit_breaker = circuit_breaker
+        self.__metrics = metrics
 
         self.__base_url = base_url
         self.__api_base_url = urljoin(self.__base_url, "/api/v3/")
         self.__timeout = timeout
         self.__session = requests.Session()
+        if adapter is not None:
+            self.__session.mount("https://", adapter)
+            self.__session.mount("http://", adapter)
+            if isinstance(adapter, cassette.ReplayAdapter):
+                # Looking up proxies in the environment costs more than a replay.
+                self.__session.trust_env = False
+
+    def _send(self, method, url, retry=False, rate_limited=False, deadline=None,
+              **kwargs):
+        """
+        Send a request, with RequestAttempts deciding about retries.
 
-    def _post(self, url, *args, **kwargs):
+        :returns: the last requests.Response.
+        :raises requests.exceptions.RequestException: of the last attempt.
+        """
+        attempts = RequestAttempts(
+            method, url, kwargs.pop("timeout", self.__timeout), retry=retry,
+            rate_limited=rate_limited, deadline=deadline,
+            rate_limiter=self.__rate_limiter, retry_policy=self.__retry_policy,
+            circuit_breaker=self.__circuit_breaker, metrics=self.__metrics)
+        while True:
+            kwargs["timeout"] = attempts.begin()
+            response, error = None, None
+            try:
+                response = self.__session.request(method, url, **kwargs)
+            except (requests.exceptions.Timeout,
+                    requests.exceptions.ConnectionError) as e:
+                error = e
+            except requests.exceptions.RequestException:
+                attempts.abort()
+                raise
+            if error is not None:
+                delay = attempts.end(None, None, error)
+            else:
+                delay = attempts.end(response.status_code, response.headers)
+            if delay is None:
+                break
+            self.__retry_policy.sleep(delay)
+
+        if error is not None:
+            raise error
+        return response
+
+    def _post(self, url, **kwargs):
+        """
+        POSTs are not retried: Authorization codes can be exchanged only
+        once and refresh tokens may be replaced by the first request.
+        """
         url = urljoin(self.__base_url, url)
 
-        if "timeout" not in kwargs:
-            kwargs["timeout"] = self.__timeout
-        response = self.__session.post(url, *args, **kwargs)
+        try:
+            response = self._send("POST", url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            logger.exception("Error doing request...")
+            raise StravaError(repr(e))
         try:
             response.raise_for_status()
             return response
@@ -153,44 +385,44 @@ class StravaClient(object):
         return response.json()
 
     def _handle_4xx(self, response):
-        data = response.json()
-        msg = data.get("message")
-        error_data = {
-            "response_data": data,
-            "response_headers": dict(response.headers),
-        }
-        errors = data.get("errors", [])
-        for e in errors:
-            if e.get("code") == "invalid" and e.get("field") == "access_token":
-                if e.get("resource") == "Athlete":
-                    raise InvalidAthleteAccessToken(msg, error_data)
+        raise_access_token_errors(response.json(), response.headers)
 
-                raise InvalidAccessToken(msg, error_data)
-
-    def _api_v3_get_auth(self, token, url, **kwargs):
+    def _api_v3_get_auth(self, token, url, deadline=None, **kwargs):
         """
         Helper for an API v3 request.
+
+        :param deadline: a tourmap.utils.deadline.Deadline of the job
+            making the request. Checked before the request is made and
+            caps its timeout.
         """
         url = urljoin(self.__api_base_url, url)
         headers = {
             "Authorization": "Bearer {}".format(token),
         }
 
-        if "timeout" not in kwargs:
-            kwargs["timeout"] = self.__timeout
-
         try:
-            response = self.__session.get(
-                url=url,
-                headers=headers,
-                **kwargs
-            )
+            response = self._send("GET", url, retry=True, rate_limited=True,
+                                  deadline=deadline, headers=headers, **kwargs)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.Timeout:
+            if deadline is not None:
+                # The timeout was capped by the deadline.
+                deadline.check()
             raise StravaTimeout()
         except requests.exceptions.HTTPError as e:
             status_code = e.response.status_code
+            if status_code == 429:
+                logger.warning("Strava rate limit hit: %s",
+                               e.response.headers.get("X-RateLimit-Usage"))
+                retry_at = None
+                if self.__rate_limiter is not None:
+                    retry_at = self.__rate_limiter.exhaust()
+                raise StravaRateLimited(retry_at)
+
+            if status_code == 404:
+                raise StravaNotFound(url)
+
             if 400 <= status_code <= 499:
                 self._handle_4xx(e.response)
                 logger.warning("_handle_4xx() fall through...")
@@ -200,21 +432,23 @@ class StravaClient(object):
             raise StravaError(repr(e) + " --- " + response.text)
 
         except requests.exceptions.RequestException as e:
-            raise StravaError(repr(e) + " --- " + response.text)
+            raise StravaError(repr(e))
 
-    def athlete(self, token):
+    def athlete(self, token, deadline=None):
         """
         Retrieve the with this token.
         """
-        return self._api_v3_get_auth(token, "athlete")
+        return self._api_v3_get_auth(token, "athlete", deadline=deadline)
 
-    def stats(self, token, id):
+    def stats(self, token, id, deadline=None):
         """
         Retrieve the stats of the given athlete.
         """
-        return self._api_v3_get_auth(token, "athletes/{}/stats".format(id))
+        return self._api_v3_get_auth(token, "athletes/{}/stats".format(id),
+                                     deadline=deadline)
 
-    def activities(self, token, before=None, after=None, page=None, per_page=None):
+    def activities(self, token, before=None, after=None, page=None, per_page=None,
+                   deadline=None):
         """
         List activities of authenticated user
         """
@@ -228,19 +462,20 @@ class StravaClient(object):
         if before is not None:
             params["before"] = before
 
-        return self._api_v3_get_auth(token, "athlete/activities", params=params)
+        return self._api_v3_get_auth(token, "athlete/activities", params=params,
+                                     deadline=deadline)
 
-    def activity(self, token, id):
+    def activity(self, token, id, deadline=None):
         """
-        List activities of authenticated user
+        Retrieve a single activity of the authenticated user.
         """
-        return self._api_v3_get_auth(token, "activities/{}".format(id))
+        return self._api_v3_get_auth(token, "activities/{}".format(id), deadline=deadline)
 
-    def activity_photos(self, token, id, size=None):
+    def activity_photos(self, token, id, size=None, deadline=None):
         params = {
             "photo_sources": True,
         }
         if size is not None:
             params["size"] = size
         url = "activities/{}/photos".format(id)
-        return self._api_v3_get_auth(token, url, params=params)
+        return self._api_v3_get_auth(token, url, params=params, deadline=deadline)
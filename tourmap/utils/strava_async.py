@@ -0,0 +1,280 @@
+"""
+The StravaClient for asyncio, based on aiohttp.
+
+Same methods, arguments and exceptions as tourmap.utils.strava.StravaClient,
+but coroutines. A single instance is meant to be shared by all tasks of an
+event loop: Its aiohttp session keeps a pool of up to connection_limit
+connections and is created on first use, within the running loop.
+
+Like the synchronous clients of a pool, it retries API requests according
+to a RetryPolicy and consults the RateLimiter and CircuitBreaker shared
+with them, so both engines see the same budget and the same breaker state.
+
+aiohttp is only required when using this client.
+"""
+import asyncio
+import json
+import logging
+import os
+from urllib.parse import urljoin
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from tourmap.utils.strava import (
+    StravaClient,
+    StravaError,
+    StravaBadRequest,
+    StravaNotFound,
+    StravaRateLimited,
+    StravaTimeout,
+    RequestAttempts,
+    raise_access_token_errors,
+)
+from tourmap.utils.retry import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+
+def _params(params):
+    """
+    aiohttp only takes strings and numbers, requests sends True as "True".
+    """
+    return {k: str(v) if isinstance(v, bool) else v for k, v in params.items()}
+
+
+def _json(body):
+    return json.loads(body.decode("utf-8"))
+
+
+class AsyncStravaClient(object):
+
+    @staticmethod
+    def from_env(environ=None, **kwargs):
+        """
+        Same environment variables as StravaClient.from_env().
+        """
+        environ = environ or os.environ
+        client_id = environ["STRAVA_CLIENT_ID"]
+        client_secret = environ["STRAVA_CLIENT_SECRET"]
+        base_url = environ.get("STRAVA_CLIENT_BASE_URL", StravaClient.BASE_URL)
+        kwargs.setdefault("retry_policy", RetryPolicy.from_env(environ))
+        return AsyncStravaClient(client_id, client_secret, base_url=base_url, **kwargs)
+
+    def __init__(self, client_id, client_secret, base_url=StravaClient.BASE_URL,
+                 timeout=StravaClient.DEFAULT_TIMEOUT, rate_limiter=None,
+                 connection_limit=100, retry_policy=None, circuit_breaker=None,
+                 metrics=None):
+        """
+        :param rate_limiter: A tourmap.utils.ratelimit.RateLimiter, can be
+            shared with synchronous clients.
+        :param connection_limit: open connections at most.
+        :param retry_policy: A tourmap.utils.retry.RetryPolicy for API
+            requests, see StravaClient. Retries wait with asyncio.sleep().
+        :param circuit_breaker: A tourmap.utils.retry.CircuitBreaker, can
+            be shared with synchronous clients.
+        :param metrics: A tourmap.utils.metrics.Metrics counting retries.
+        """
+        if aiohttp is None:
+            raise RuntimeError("AsyncStravaClient requires aiohttp")
+
+        self.__client_id = client_id
+        self.__client_secret = client_secret
+        self.__rate_limiter = rate_limiter
+        self.__retry_policy = retry_policy
+        self.__circuit_breaker = circuit_breaker
+        self.__metrics = metrics
+
+        self.__base_url = base_url
+        self.__api_base_url = urljoin(self.__base_url, "/api/v3/")
+        self.__timeout = timeout
+        self.__connection_limit = connection_limit
+        self.__session = None
+
+    def _get_session(self):
+        if self.__session is None:
+            connector = aiohttp.TCPConnector(limit=self.__connection_limit)
+            self.__session = aiohttp.ClientSession(connector=connector)
+        return self.__session
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @staticmethod
+    def _client_timeout(timeout):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    async def _send(self, method, url, retry=False, rate_limited=False, deadline=None,
+                    **kwargs):
+        """
+        Send a request like StravaClient._send(), with the same
+        RequestAttempts deciding about retries.
+
+        :returns: tuple of status, headers and body of the last response.
+        :raises asyncio.TimeoutError, aiohttp.ClientError: of the last
+            attempt.
+        """
+        attempts = RequestAttempts(
+            method, url, self.__timeout, retry=retry, rate_limited=rate_limited,
+            deadline=deadline, rate_limiter=self.__rate_limiter,
+            retry_policy=self.__retry_policy, circuit_breaker=self.__circuit_breaker,
+            metrics=self.__metrics)
+        while True:
+            timeout = attempts.begin()
+            response, error = None, None
+            try:
+                request = self._get_session().request(
+                    method, url, timeout=self._client_timeout(timeout), **kwargs)
+                async with request as r:
+                    response = r.status, r.headers, await r.read()
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                error = e
+            except aiohttp.ClientError:
+                attempts.abort()
+                raise
+
+            if error is not None:
+                delay = attempts.end(None, None, error)
+            else:
+                delay = attempts.end(response[0], response[1])
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+
+        if error is not None:
+            raise error
+        return response
+
+    async def _post(self, url, data):
+        """
+        Not retried, see StravaClient._post().
+        """
+        url = urljoin(self.__base_url, url)
+        try:
+            status, _, body = await self._send("POST", url, data=data)
+        except asyncio.TimeoutError:
+            raise StravaTimeout()
+        except aiohttp.ClientError as e:
+            logger.exception("Error doing request...")
+            raise StravaError(repr(e))
+
+        if 400 <= status <= 499:
+            try:
+                data = _json(body)
+            except ValueError:
+                data = None
+            if data is not None:
+                raise StravaBadRequest(status, data.get("message"),
+                                       data.get("errors", []))
+        if status >= 400:
+            raise StravaError("HTTP {} --- {}".format(
+                status, body.decode("utf-8", "replace")))
+        return _json(body)
+
+    async def exchange_token(self, code):
+        return await self._post("oauth/token", data={
+            "client_id": self.__client_id,
+            "client_secret": self.__client_secret,
+            "grant_type": "authorization_code",
+            "code": code,
+        })
+
+    async def refresh_token(self, refresh_token):
+        return await self._post("oauth/token", data={
+            "client_id": self.__client_id,
+            "client_secret": self.__client_secret,
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+        })
+
+    async def _api_v3_get_auth(self, token, url, params=None, deadline=None):
+        """
+        Helper for an API v3 request, see StravaClient._api_v3_get_auth().
+        """
+        url = urljoin(self.__api_base_url, url)
+        headers = {
+            "Authorization": "Bearer {}".format(token),
+        }
+
+        try:
+            status, response_headers, body = await self._send(
+                "GET", url, retry=True, rate_limited=True, deadline=deadline,
+                headers=headers, params=_params(params or {}))
+        except asyncio.TimeoutError:
+            if deadline is not None:
+                # The timeout was capped by the deadline.
+                deadline.check()
+            raise StravaTimeout()
+        except aiohttp.ClientError as e:
+            raise StravaError(repr(e))
+
+        if status < 400:
+            return _json(body)
+
+        if status == 429:
+            logger.warning("Strava rate limit hit: %s",
+                           response_headers.get("X-RateLimit-Usage"))
+            retry_at = None
+            if self.__rate_limiter is not None:
+                retry_at = self.__rate_limiter.exhaust()
+            raise StravaRateLimited(retry_at)
+
+        if status == 404:
+            raise StravaNotFound(url)
+
+        text = body.decode("utf-8", "replace")
+        if 400 <= status <= 499:
+            try:
+                data = _json(body)
+            except ValueError:
+                data = {}
+            raise_access_token_errors(data, response_headers)
+            logger.warning("raise_access_token_errors() fall through...")
+
+        raise StravaError("HTTP {} --- {}".format(status, text))
+
+    async def athlete(self, token, deadline=None):
+        return await self._api_v3_get_auth(token, "athlete", deadline=deadline)
+
+    async def stats(self, token, id, deadline=None):
+        return await self._api_v3_get_auth(token, "athletes/{}/stats".format(id),
+                                           deadline=deadline)
+
+    async def activities(self, token, before=None, after=None, page=None, per_page=None,
+                         deadline=None):
+        params = {}
+        if page is not None:
+            params["page"] = page
+        if per_page is not None:
+            params["per_page"] = per_page
+        if after is not None:
+            params["after"] = after
+        if before is not None:
+            params["before"] = before
+
+        return await self._api_v3_get_auth(token, "athlete/activities", params=params,
+                                           deadline=deadline)
+
+    async def activity(self, token, id, deadline=None):
+        return await self._api_v3_get_auth(token, "activities/{}".format(id),
+                                           deadline=deadline)
+
+    async def activity_photos(self, token, id, size=None, deadline=None):
+        params = {
+            "photo_sources": True,
+        }
+        if size is not None:
+            params["size"] = size
+        url = "activities/{}/photos".format(id)
+        return await self._api_v3_get_auth(token, url, params=params, deadline=deadline)
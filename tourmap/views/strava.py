@@ -77,9 +77,11 @@ class LoginController(object):
             )
 
         # Clear the error on a new login, assuming it was related to a
-        # token issue which should be solved by a re-login!
+        # token issue which should be solved by a re-login! Also poll
+        # right away, the user is probably waiting for something.
         poll_state.clear_error()
         poll_state.start()
+        poll_state.next_poll_at = None
 
         # Ok, go figure it out for us...
         self.__session.add_all([token, poll_state])
@@ -0,0 +1,139 @@
+"""
+Receive events of a Strava webhook push subscription.
+
+Strava only tells us that something happened, not what. Events are
+queued as WebhookEvent rows and the poller fetches the activity with
+a single request. An athlete revoking access stops their PollState.
+
+Events are not signed. Only those for STRAVA_WEBHOOK_SUBSCRIPTION_ID are
+accepted, but that id is not a secret. So no event is acted on here: The
+poller asks Strava before deleting an activity, and before stopping the
+PollState of an athlete who revoked access.
+
+https://developers.strava.com/docs/webhooks/
+"""
+import datetime
+
+from flask import Blueprint, abort, current_app, jsonify, request
+
+from tourmap import resources
+from tourmap.models import User, WebhookEvent
+
+ASPECT_TYPES = {"create", "update", "delete"}
+
+
+class WebhookController(object):
+    """
+    Handle a single event posted by Strava.
+    """
+    def __init__(self, session=None):
+        self.__session = session or resources.db.session
+
+    def handle_event(self, event):
+        """
+        :param event: the JSON body of an event.
+        :returns: True if the event was for a known user, else False.
+        :raises: KeyError, ValueError for malformed events.
+        """
+        object_type = event["object_type"]
+        aspect_type = event["aspect_type"]
+        if aspect_type not in ASPECT_TYPES:
+            raise ValueError("Unknown aspect_type {!r}".format(aspect_type))
+
+        user = User.query.filter_by(strava_id=int(event["owner_id"])).one_or_none()
+        if user is None:
+            current_app.logger.info("Event for unknown athlete %s", event["owner_id"])
+            return False
+
+        event_time = None
+        if event.get("event_time") is not None:
+            event_time = datetime.datetime.utcfromtimestamp(int(event["event_time"]))
+
+        if object_type == "athlete":
+            updates = event.get("updates") or {}
+            if str(updates.get("authorized")).lower() == "false":
+                self._deauthorize(user, event_time)
+            return True
+
+        if object_type != "activity":
+            raise ValueError("Unknown object_type {!r}".format(object_type))
+
+        self.__session.add(WebhookEvent(
+            user=user,
+            object_id=int(event["object_id"]),
+            aspect_type=aspect_type,
+            event_time=event_time,
+        ))
+        self.__session.commit()
+        return True
+
+    def _deauthorize(self, user, event_time):
+        """
+        The athlete revoked our access, or someone claims so. Queue the
+        event, the poller stops the PollState once Strava confirmed it.
+        """
+        current_app.logger.info("%s revoked access", user)
+        self.__session.add(WebhookEvent(
+            user=user,
+            object_id=user.strava_id,
+            aspect_type=WebhookEvent.DEAUTHORIZE,
+            event_time=event_time,
+        ))
+        self.__session.commit()
+
+
+def create_blueprint(app):
+    bp = Blueprint("strava_webhook", __name__)
+
+    @bp.before_request
+    def check_enabled():
+        """
+        Without a verify token there is no subscription.
+        """
+        if not current_app.config.get("STRAVA_WEBHOOK_VERIFY_TOKEN"):
+            abort(404)
+
+    @bp.route("", methods=["GET"])
+    def validate():
+        """
+        The validation handshake when creating the subscription: Echo
+        the challenge if the verify token matches.
+        """
+        verify_token = current_app.config["STRAVA_WEBHOOK_VERIFY_TOKEN"]
+        if request.args.get("hub.mode") != "subscribe":
+            abort(400)
+        if request.args.get("hub.verify_token") != verify_token:
+            current_app.logger.warning("Webhook validation with bad verify token")
+            abort(403)
+        if "hub.challenge" not in request.args:
+            abort(400)
+        return jsonify({"hub.challenge": request.args["hub.challenge"]})
+
+    @bp.route("", methods=["POST"])
+    def event():
+        """
+        Strava expects an answer within two seconds and retries on
+        anything but a 200, so only queue the event here. Until the id
+        of the subscription is configured, no events are accepted.
+        """
+        subscription_id = current_app.config.get("STRAVA_WEBHOOK_SUBSCRIPTION_ID")
+        if not subscription_id:
+            abort(404)
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400)
+
+        if str(data.get("subscription_id")) != str(subscription_id):
+            current_app.logger.warning("Event for unknown subscription %r",
+                                       data.get("subscription_id"))
+            abort(403)
+
+        try:
+            WebhookController().handle_event(data)
+        except (KeyError, TypeError, ValueError) as e:
+            current_app.logger.warning("Bad webhook event %r: %r", data, e)
+            abort(400)
+        return jsonify({})
+
+    return bp
@@ -1,4 +1,7 @@
+import datetime
+
 from flask import Blueprint, render_template, abort, request, redirect, url_for, flash, escape
+from flask import current_app, jsonify, make_response
 from flask_login import current_user, login_required
 
 from tourmap import database
@@ -9,6 +12,37 @@ from tourmap.resources import db
 from tourmap.controllers import TourController
 
 
+def _get_tour_version(tour):
+    """
+    The version of the TourStats of a tour. Tour pages are cached by it.
+
+    Tours get their stats when created or by pack_activity_polylines.py.
+    Those still without are built here, if a concurrent request built
+    them first, its stats are used.
+    """
+    if tour.stats is None:
+        try:
+            tour.rebuild_stats()
+            db.session.commit()
+        except database.IntegrityError:
+            db.session.rollback()
+    return tour.stats.version
+
+
+def _set_tour_cache_control(response, tour, max_age=None):
+    """
+    Let browsers, and shared caches for public tours, keep the data of
+    a tour for max_age seconds, or revalidate it with its ETag every time.
+    """
+    response.cache_control.public = bool(tour.public)
+    response.cache_control.private = not tour.public
+    if max_age is None:
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.max_age = max_age
+    return response
+
+
 def create_user_tours_blueprint(app):
     """
     A blueprint designated to handle /users/<user_hashid>/tours/ stuff
@@ -59,6 +93,7 @@ def create_user_tours_blueprint(app):
             form.populate_obj(tour)
             db.session.add(tour)
             try:
+                tour.rebuild_stats()
                 db.session.commit()
                 flash("Created tour '{}'".format(escape(tour.name)), category="success")
                 return redirect(url_for("user_tours.tour", user_hashid=user_hashid,
@@ -96,6 +131,7 @@ def create_user_tours_blueprint(app):
             if form.validate_on_submit():
                 form.populate_obj(tour)
                 try:
+                    tour.rebuild_stats()
                     db.session.commit()
                     flash("Updated tour '{}'".format(escape(tour.name)), category="success")
                     return redirect(url_for("users.user", user_hashid=user_hashid))
@@ -106,14 +142,48 @@ def create_user_tours_blueprint(app):
             # Something went wrong with the tour...
             return render_template("tours/edit.html", tour=tour, form=form)
 
-        # Default: Just show the map...
-        data = ctrl.prepare_activities_for_map(tour)
-        map_settings = ctrl.get_map_settings(tour, data["activities"])
-        return render_template("tours/tour.html",
-                               user=user, tour=tour,
-                               activities=data["activities"],
-                               totals=data["totals"],
-                               map_settings=map_settings)
+        # Default: Just show the map, its activities are loaded from
+        # tour_data() by the browser.
+        version = _get_tour_version(tour)
+        map_settings = ctrl.get_map_settings(tour, [])
+        data_url = url_for("user_tours.tour_data", user_hashid=user_hashid,
+                           tour_hashid=tour_hashid, v=version)
+        response = make_response(render_template("tours/tour.html",
+                                                 user=user, tour=tour,
+                                                 data_url=data_url,
+                                                 map_settings=map_settings))
+        # The page shows who is logged in, keep it out of shared caches.
+        response.add_etag()
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    @bp.route("/tours/<tour_hashid>/data.json")
+    def tour_data(user_hashid, tour_hashid):
+        """
+        The activities and totals of a tour. Its ETag is the version of
+        the tour, so unchanged tours are answered with a 304 without
+        loading any activities. The tour page requests this with the
+        version in the URL, which can then be cached for long.
+        """
+        user = User.get_by_hashid(user_hashid)
+        tour = Tour.get_by_hashid(tour_hashid)
+        if user is None or tour is None or tour.user.id != user.id:
+            abort(404)
+
+        version = _get_tour_version(tour)
+        etag = "{}-{}".format(tour_hashid, version)
+        max_age = None
+        if request.args.get("v") == str(version):
+            max_age = int(datetime.timedelta(days=365).total_seconds())
+
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            data = TourController().prepare_activities_for_map(tour)
+            response = jsonify(version=version, **data)
+        response.set_etag(etag)
+        return _set_tour_cache_control(response, tour, max_age=max_age)
 
     @bp.route("/tours/<tour_hashid>/delete", methods=["POST"])
     @login_required
@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 import json
 import logging
@@ -7,6 +8,7 @@ import unittest
 
 import flask
 import flask.wrappers
+import sqlalchemy
 
 import tourmap
 from tourmap.models import User, Activity, ActivityPhotos, Tour
@@ -167,12 +169,31 @@ class TestCase(unittest.TestCase):
             summary_polyline="ui}qBwhwtQc]gOcGuP{HaEsXvHsXaP{n@oFygAcW"
         )
 
+    @contextlib.contextmanager
+    def count_queries(self):
+        """
+        Collect the SQL statements executed within the block.
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(db.engine, "before_cursor_execute",
+                                    before_cursor_execute)
+
     def tearDown(self):
         super().setUp()
         try:
             db.session.rollback()
         except Exception as e:
             logger.warning("rollback in tearDown failed: %s", repr(e))
+        # Do not carry instances over into the next test, ids are reused.
+        db.session.remove()
 
     def load_test_data(self, basename, ext):
         filename = os.path.extsep.join([basename, ext])
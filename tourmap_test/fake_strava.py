@@ -0,0 +1,301 @@
+"""
+A fake Strava API server on localhost for tests and benchmarks.
+
+It serves the few endpoints tourmap uses with synthetic activities
+and enforces rate limits the way Strava does: requests above the limit
+of the 15 minute or the daily window are answered with a 429, and every
+response carries X-RateLimit-Limit and X-RateLimit-Usage headers.
+
+    with FakeStrava(limits=(10, 100)) as fake:
+        client = StravaClient("id", "secret", base_url=fake.base_url)
+"""
+import copy
+import datetime
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from tourmap.utils import dt2ts
+from tourmap_test.data import activity1_dict
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        fake = self.server.fake
+        status, data, headers = fake.handle_get(self.path, self.headers)
+        self._send_json(status, data, headers)
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        status, data = fake.handle_post(self.path, parse_qs(body))
+        self._send_json(status, data)
+
+
+class FakeStrava(object):
+
+    def __init__(self, limits=(600, 30000), activity_count=50, photo_count=0,
+                 latency=0.0, athlete_id=1):
+        """
+        :param limits: limits of the 15 minute and the daily window.
+        :param activity_count: number of activities every athlete has.
+        :param photo_count: photos for each activity.
+        :param latency: seconds to sleep before answering.
+        :param athlete_id: id of the athlete and owner of the activities.
+        """
+        self.limits = list(limits)
+        self.usage = [0, 0]
+        self.latency = latency
+        self.photo_count = photo_count
+        self.athlete_id = athlete_id
+        self.activities = self._make_activities(activity_count)
+        # Access tokens the athlete revoked.
+        self.revoked_tokens = set()
+        self.failures = 0
+        self.failure_status = 503
+
+        # Statistics
+        self.served = 0
+        self.rejected = 0
+        self.paths = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.__thread = None
+
+    def _make_activities(self, count):
+        """
+        Activities one day apart, newest first, as Strava returns them.
+        """
+        result = []
+        start = datetime.datetime(2019, 1, 1)
+        for i in range(count):
+            a = copy.deepcopy(activity1_dict)
+            start_date = start - datetime.timedelta(days=i)
+            a["id"] = 1000000 + i
+            a["name"] = "Fake activity {}".format(i)
+            a["start_date"] = start_date.strftime("%Y-%m-%dT%H:%M:%SZ")
+            a["start_date_local"] = a["start_date"]
+            a["total_photo_count"] = self.photo_count
+            a["athlete"] = {"id": self.athlete_id, "resource_state": 1}
+            result.append(a)
+        return result
+
+    @property
+    def base_url(self):
+        host, port = self.__server.server_address
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self.__server = _ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.__server.fake = self
+        self.__thread = threading.Thread(target=self.__server.serve_forever,
+                                         name="FakeStrava", daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def fail_next(self, count, status=503):
+        """
+        Answer the next count GET requests with status, as if Strava
+        had an outage.
+        """
+        with self.__lock:
+            self.failures = count
+            self.failure_status = status
+
+    def reset_short_window(self):
+        """
+        Simulate the start of the next 15 minute window.
+        """
+        with self.__lock:
+            self.usage[0] = 0
+
+    def _rate_limit_headers(self):
+        return {
+            "X-RateLimit-Limit": "{},{}".format(*self.limits),
+            "X-RateLimit-Usage": "{},{}".format(*self.usage),
+        }
+
+    def handle_get(self, path, headers):
+        with self.__lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            return self._handle_get(path, headers)
+        finally:
+            with self.__lock:
+                self.in_flight -= 1
+
+    def _handle_get(self, path, headers):
+        with self.__lock:
+            self.paths.append(path)
+            if self.failures > 0:
+                self.failures -= 1
+                return self.failure_status, {"message": "Service Unavailable"}, {}
+            if any(u >= limit for u, limit in zip(self.usage, self.limits)):
+                self.rejected += 1
+                data = {"message": "Rate Limit Exceeded", "errors": [
+                    {"resource": "Application", "field": "rate limit",
+                     "code": "exceeded"},
+                ]}
+                return 429, data, self._rate_limit_headers()
+            self.usage = [u + 1 for u in self.usage]
+            self.served += 1
+            rate_limit_headers = self._rate_limit_headers()
+
+        authorization = headers.get("Authorization", "")
+        if not authorization.startswith("Bearer ") or \
+                authorization[len("Bearer "):] in self.revoked_tokens:
+            return 401, {"message": "Authorization Error", "errors": [
+                {"resource": "Athlete", "field": "access_token", "code": "invalid"},
+            ]}, rate_limit_headers
+
+        url = urlparse(path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/api/v3/athlete":
+            return 200, {"id": self.athlete_id, "resource_state": 3}, rate_limit_headers
+        if url.path == "/api/v3/athlete/activities":
+            return 200, self._list_activities(params), rate_limit_headers
+
+        m = re.match(r"^/api/v3/activities/(\d+)(/photos)?$", url.path)
+        if m:
+            activity = self._get_activity(int(m.group(1)))
+            if activity is None:
+                data = {"message": "Record Not Found", "errors": []}
+                return 404, data, rate_limit_headers
+            if m.group(2):
+                return 200, self._photos(activity, int(params.get("size", 256))), \
+                    rate_limit_headers
+            return 200, activity, rate_limit_headers
+
+        return 404, {"message": "Not Found", "errors": []}, rate_limit_headers
+
+    def handle_post(self, path, form):
+        if urlparse(path).path != "/oauth/token":
+            return 404, {"message": "Not Found"}
+        expires_at = dt2ts(datetime.datetime.utcnow() + datetime.timedelta(hours=6))
+        return 200, {
+            "token_type": "Bearer",
+            "access_token": "access-{}".format(time.time()),
+            "refresh_token": "refresh-{}".format(time.time()),
+            "expires_at": expires_at,
+            "athlete": {"id": 1, "firstname": "Fake", "lastname": "Athlete"},
+        }
+
+    def _get_activity(self, id):
+        for a in self.activities:
+            if a["id"] == id:
+                return a
+        return None
+
+    def _list_activities(self, params):
+        page = int(params.get("page", 1))
+        per_page = int(params.get("per_page", 30))
+        activities = self.activities
+        if "before" in params:
+            before = int(params["before"])
+            activities = [a for a in activities if self._ts(a) < before]
+        if "after" in params:
+            # Strava returns these in ascending order.
+            after = int(params["after"])
+            activities = [a for a in reversed(activities) if self._ts(a) > after]
+        start = (page - 1) * per_page
+        return activities[start:start + per_page]
+
+    @staticmethod
+    def _ts(activity):
+        dt = datetime.datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ")
+        return dt2ts(dt)
+
+    def _photos(self, activity, size):
+        result = []
+        for i in range(activity["total_photo_count"]):
+            unique_id = "{}-{}".format(activity["id"], i)
+            result.append({
+                "unique_id": unique_id,
+                "source": 1,
+                "caption": "",
+                "sizes": {str(size): [size, size * 3 // 4]},
+                "urls": {
+                    str(size): "https://photos.invalid/{}-{}.jpg".format(unique_id, size),
+                },
+            })
+        return result
+
+
+class WebhookEventGenerator(object):
+    """
+    Generate events as Strava posts them to a webhook subscription.
+
+        events = WebhookEventGenerator(owner_id=123)
+        client.post("/strava/webhook", json=events.create(1000000))
+    """
+
+    def __init__(self, owner_id, subscription_id=4711, event_time=1569931200):
+        self.owner_id = owner_id
+        self.subscription_id = subscription_id
+        self.event_time = event_time
+
+    def _event(self, object_type, object_id, aspect_type, updates=None):
+        self.event_time += 1
+        return {
+            "object_type": object_type,
+            "object_id": object_id,
+            "aspect_type": aspect_type,
+            "updates": updates or {},
+            "owner_id": self.owner_id,
+            "subscription_id": self.subscription_id,
+            "event_time": self.event_time,
+        }
+
+    def create(self, activity_id):
+        return self._event("activity", activity_id, "create")
+
+    def update(self, activity_id, **updates):
+        return self._event("activity", activity_id, "update", updates)
+
+    def delete(self, activity_id):
+        return self._event("activity", activity_id, "delete")
+
+    def deauthorize(self):
+        return self._event("athlete", self.owner_id, "update", {"authorized": "false"})
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tourmap.utils import cassette
+from tourmap.utils.strava import StravaClient, StravaNotFound, StravaRateLimited
+
+from tourmap_test.fake_strava import FakeStrava
+
+
+class TestCassette(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "strava.jsonl.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _environ(self, **kwargs):
+        environ = {
+            "STRAVA_CLIENT_ID": "-1",
+            "STRAVA_CLIENT_SECRET": "TEST",
+            "STRAVA_CLIENT_CASSETTE": self.path,
+        }
+        environ.update(kwargs)
+        return environ
+
+    def _record(self, fn, **fake_kwargs):
+        with FakeStrava(**fake_kwargs) as fake_strava:
+            environ = self._environ(STRAVA_CLIENT_BASE_URL=fake_strava.base_url,
+                                    STRAVA_CLIENT_CASSETTE_MODE="record")
+            result = fn(StravaClient.from_env(environ=environ))
+        cassette.get_cassette(self.path, mode="record").close()
+        return result
+
+    def _replay_client(self, **kwargs):
+        return StravaClient(
+            "-1", "TEST", adapter=cassette.ReplayAdapter(
+                cassette.Cassette(self.path), **kwargs))
+
+    def test_record_replay(self):
+        def requests(client):
+            return [
+                client.activities("TOKEN1", per_page=3),
+                client.activities("TOKEN2", per_page=2),
+                client.activity("TOKEN1", 1000001),
+                client.refresh_token("REFRESH"),
+            ]
+        recorded = self._record(requests, activity_count=5)
+        self.assertEqual(4, len(cassette.Cassette(self.path)))
+
+        # Nothing listens on the default base url of the replaying client.
+        self.assertEqual(recorded, requests(self._replay_client()))
+
+    def test_replay_errors(self):
+        def requests(client):
+            client.athlete("TOKEN")
+            with self.assertRaises(StravaNotFound):
+                client.activity("TOKEN", 1)
+            with self.assertRaises(StravaRateLimited):
+                client.athlete("TOKEN")
+        self._record(requests, limits=(2, 1000))
+
+        client = self._replay_client()
+        requests(client)
+        # The last recorded response is repeated.
+        with self.assertRaises(StravaRateLimited):
+            client.athlete("TOKEN")
+        # Not recorded at all.
+        with self.assertRaises(StravaNotFound):
+            client.stats("TOKEN", 1)
+
+    def test_replay_loose_match(self):
+        self._record(lambda client: client.exchange_token("CODE1"))
+        result = self._replay_client().exchange_token("CODE2")
+        self.assertEqual("Bearer", result["token_type"])
+
+    def test_replay_latency(self):
+        self._record(lambda client: client.athlete("TOKEN"))
+        client = self._replay_client(latency=0.05)
+        start = time.monotonic()
+        client.athlete("TOKEN")
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_from_env(self):
+        self.assertIsNone(cassette.adapter_from_env({}))
+        self._record(lambda client: client.athlete("TOKEN"))
+        adapter = cassette.adapter_from_env(self._environ())
+        self.assertIsInstance(adapter, cassette.ReplayAdapter)
+        # Shared by all clients.
+        self.assertIs(cassette.get_cassette(self.path),
+                      cassette.get_cassette(self.path))
+
+        with self.assertRaises(ValueError):
+            cassette.Cassette(self.path, mode="rewind")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+from tourmap.utils.concurrency import ConcurrencyController
+
+
+class TestConcurrencyController(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = ConcurrencyController(min_limit=2, max_limit=8, initial_limit=4,
+                                                latency_target_seconds=1.0, window=5)
+
+    def _observe(self, n, latency=0.1, errors=0):
+        for i in range(n):
+            self.controller.observe(latency, error=i < errors)
+
+    def test_additive_increase(self):
+        self._observe(4)
+        self.assertEqual(4, self.controller.adjust())
+        self._observe(1)
+        self.assertEqual(5, self.controller.adjust())
+
+        # Capped by max_limit
+        for _ in range(10):
+            self._observe(5)
+            self.controller.adjust()
+        self.assertEqual(8, self.controller.limit)
+
+    def test_multiplicative_decrease__latency(self):
+        self._observe(5, latency=3.0)
+        self.assertEqual(2, self.controller.adjust())
+        self._observe(5, latency=3.0)
+        self.assertEqual(2, self.controller.adjust())
+
+    def test_multiplicative_decrease__errors(self):
+        self._observe(5, errors=1)
+        self.assertEqual(2, self.controller.adjust())
+
+    def test_throttled(self):
+        self.controller.throttled()
+        self.assertEqual(2, self.controller.adjust())
+
+    def test_budget(self):
+        self._observe(5)
+        self.assertEqual(2, self.controller.adjust(remaining_budget=3))
+
+        # Healthy, but not enough budget to grow.
+        self._observe(5)
+        self.assertEqual(2, self.controller.adjust(remaining_budget=3))
+        self._observe(5)
+        self.assertEqual(3, self.controller.adjust(remaining_budget=100))
+
+    def test_bad_limits(self):
+        with self.assertRaises(ValueError):
+            ConcurrencyController(min_limit=4, max_limit=2)
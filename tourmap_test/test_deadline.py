@@ -0,0 +1,50 @@
+import unittest
+
+from tourmap.utils.deadline import Deadline, DeadlineExceeded
+
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeadline(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(100.0)
+        self.deadline = Deadline(30, clock=self.clock)
+
+    def test_not_started(self):
+        self.clock.now += 60
+        self.assertFalse(self.deadline.expired())
+        self.assertEqual(30, self.deadline.remaining())
+        self.assertIsNone(self.deadline.expires_at)
+        self.deadline.check()
+
+    def test_expires(self):
+        self.deadline.start()
+        self.assertEqual(130.0, self.deadline.expires_at)
+        self.clock.now += 20
+        self.assertEqual(10.0, self.deadline.remaining())
+        self.deadline.check()
+
+        self.clock.now += 10
+        self.assertTrue(self.deadline.expired())
+        with self.assertRaises(DeadlineExceeded):
+            self.deadline.check()
+
+    def test_cancel(self):
+        self.deadline.start().cancel()
+        self.assertFalse(self.deadline.expired())
+        with self.assertRaises(DeadlineExceeded):
+            self.deadline.check()
+
+    def test_cap_timeout(self):
+        self.deadline.start()
+        self.clock.now += 25
+        self.assertEqual((5.0, 5.0), self.deadline.cap_timeout((10, 10)))
+        self.assertEqual(3, self.deadline.cap_timeout(3))
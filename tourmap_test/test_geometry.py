@@ -0,0 +1,54 @@
+import unittest
+
+import polyline
+
+from tourmap.utils import geometry
+
+from tourmap_test.data import activity1_dict
+
+
+class TestGeometry(unittest.TestCase):
+
+    def test_pack_polyline(self):
+        encoded = polyline.encode([(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)])
+        result = geometry.pack_polyline(encoded)
+        self.assertEqual(3, result["point_count"])
+        self.assertEqual(3 * 2 * 4, len(result["packed_latlngs"]))
+        self.assertEqual((38.5, -126.453), (result["min_lat"], result["min_lng"]))
+        self.assertEqual((43.252, -120.2), (result["max_lat"], result["max_lng"]))
+        self.assertEqual(polyline.decode(encoded),
+                         geometry.unpack_latlngs(result["packed_latlngs"]))
+
+    def test_pack_polyline__long(self):
+        latlngs = [(47.0 + i * 0.00123, 8.0 - i * 0.00071) for i in range(1000)]
+        encoded = polyline.encode(latlngs)
+        packed = geometry.pack_polyline(encoded)["packed_latlngs"]
+        self.assertEqual(polyline.decode(encoded), geometry.unpack_latlngs(packed))
+
+    def test_pack_polyline__broken(self):
+        # Truncated, polyline.decode() fails on it.
+        encoded = activity1_dict["map"]["summary_polyline"]
+        result = geometry.pack_polyline(encoded)
+        self.assertEqual(b"", result["packed_latlngs"])
+        self.assertEqual(0, result["point_count"])
+        self.assertIsNone(result["min_lat"])
+
+    def test_pack_polyline__empty(self):
+        for encoded in [None, ""]:
+            result = geometry.pack_polyline(encoded)
+            self.assertIsNone(result["packed_latlngs"])
+            self.assertIsNone(result["point_count"])
+
+    def test_polyline_deltas__broken(self):
+        encoded = polyline.encode([(38.5, -120.2), (40.7, -120.95)])
+        for truncated in [encoded[:-1], encoded[:-2]]:
+            with self.assertRaises(ValueError):
+                geometry.polyline_deltas(truncated)
+
+    def test_packed_to_base64(self):
+        self.assertEqual("AQAAAP////8=",
+                         geometry.packed_to_base64(b"\x01\x00\x00\x00\xff\xff\xff\xff"))
+
+
+if __name__ == "__main__":
+    unittest.main()
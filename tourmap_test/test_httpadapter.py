@@ -0,0 +1,103 @@
+import threading
+import unittest
+
+from werkzeug.exceptions import ServiceUnavailable
+
+import tourmap_test
+
+from tourmap.resources import strava
+from tourmap.utils.httpadapter import PooledHTTPAdapter
+from tourmap.utils.metrics import Metrics
+from tourmap.utils.objpool import Empty, ObjectPool
+from tourmap.utils.strava import StravaClient
+
+from tourmap_test.fake_strava import FakeStrava
+
+
+class TestPooledHTTPAdapter(unittest.TestCase):
+
+    def _clients(self, fake_strava, count, adapter):
+        return [StravaClient("-1", "TEST", base_url=fake_strava.base_url, adapter=adapter)
+                for _ in range(count)]
+
+    def test_connections_shared(self):
+        metrics = Metrics()
+        adapter = PooledHTTPAdapter(pool_maxsize=2, metrics=metrics)
+        with FakeStrava() as fake_strava:
+            for client in self._clients(fake_strava, 5, adapter):
+                client.athlete("TOKEN")
+                client.athlete("TOKEN")
+
+        self.assertEqual({
+            "requests": 10,
+            "connections_opened": 1,
+            "connections_reused": 9,
+        }, adapter.stats())
+        self.assertEqual(10, metrics.counter("http_requests"))
+        self.assertEqual(1, metrics.counter("http_connections_opened"))
+
+    def test_concurrent(self):
+        adapter = PooledHTTPAdapter(pool_maxsize=4)
+        with FakeStrava(latency=0.05) as fake_strava:
+            clients = self._clients(fake_strava, 4, adapter)
+            for _ in range(3):
+                threads = [threading.Thread(target=c.athlete, args=("TOKEN",))
+                           for c in clients]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+
+        stats = adapter.stats()
+        self.assertEqual(12, stats["requests"])
+        # Opened by the first round at most.
+        self.assertLessEqual(stats["connections_opened"], 4)
+
+    def test_close(self):
+        adapter = PooledHTTPAdapter()
+        with FakeStrava() as fake_strava:
+            client, other_client = self._clients(fake_strava, 2, adapter)
+            client.athlete("TOKEN")
+            # As done by Session.close()
+            adapter.close()
+            other_client.athlete("TOKEN")
+            self.assertEqual(1, adapter.stats()["connections_opened"])
+            adapter.close_connections()
+            other_client.athlete("TOKEN")
+            self.assertEqual(2, adapter.stats()["connections_opened"])
+
+    def test_from_env(self):
+        adapter = PooledHTTPAdapter.from_env({"STRAVA_CLIENT_HTTP_POOL_MAXSIZE": "8"})
+        self.assertEqual(8, adapter._pool_maxsize)
+
+
+class TestFlaskStravaPool(tourmap_test.TestCase):
+
+    def test_pool(self):
+        self.assertIsInstance(strava._pool, ObjectPool)
+        clients = [strava._pool.get() for _ in range(32)]
+        with self.assertRaises(Empty):
+            strava._pool.get(timeout=0.01)
+        for client in clients:
+            strava._pool.put(client)
+        self.assertIsInstance(self.app.extensions["strava_client"].adapter,
+                              PooledHTTPAdapter)
+
+    def test_pool_timeout(self):
+        state = self.app.extensions["strava_client"]
+        state.timeout = 0.01
+        clients = [strava._pool.get() for _ in range(32)]
+        with self.app.app_context():
+            with self.assertRaises(ServiceUnavailable):
+                strava.client
+        self.assertEqual(1, state.metrics.counter("pool_timeouts"))
+
+        strava._pool.put(clients.pop())
+        with self.app.app_context():
+            self.assertIsInstance(strava.client, StravaClient)
+        for client in clients:
+            strava._pool.put(client)
+
+
+if __name__ == "__main__":
+    unittest.main()
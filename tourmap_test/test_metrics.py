@@ -0,0 +1,29 @@
+import unittest
+
+from tourmap.utils.metrics import Histogram, Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 10))
+        for value in [0.5, 1, 5, 50]:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(4, snapshot["count"])
+        self.assertEqual(56.5, snapshot["sum"])
+        self.assertEqual({"1": 2, "10": 1, "+Inf": 1}, snapshot["buckets"])
+
+    def test_metrics(self):
+        metrics = Metrics()
+        metrics.incr("jobs")
+        metrics.incr("jobs", 2)
+        metrics.set_gauge("stuck_slots", 1)
+        metrics.observe("job_duration_seconds", 0.2)
+
+        self.assertEqual(3, metrics.counter("jobs"))
+        self.assertEqual(0, metrics.counter("unknown"))
+        self.assertEqual(1, metrics.gauge("stuck_slots"))
+        snapshot = metrics.snapshot()
+        self.assertEqual({"jobs": 3}, snapshot["counters"])
+        self.assertEqual(1, snapshot["histograms"]["job_duration_seconds"]["count"])
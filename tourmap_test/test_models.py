@@ -1,6 +1,8 @@
+import datetime
+
 import tourmap_test
 
-from tourmap.models import Activity
+from tourmap.models import Activity, Tour, TourStats, User
 from tourmap.resources import db
 
 class TestModels(tourmap_test.TestCase):
@@ -20,6 +22,9 @@ class TestModels(tourmap_test.TestCase):
         db.session.add(activity)
         db.session.commit()
         self.assertEqual(1, Activity.query.count())
+        self.assertEqual(len(activity.latlngs), activity.point_count)
+        self.assertLessEqual(activity.min_lat, activity.max_lat)
+        self.assertLessEqual(activity.min_lng, activity.max_lng)
 
     def test_activity_update_twice(self):
         activity_dict = self.get_test_data_from_json_file("test_activity1")
@@ -40,3 +45,63 @@ class TestModels(tourmap_test.TestCase):
 
         activity = Activity.query.first()
         self.assertEqual("updated name", activity.name)
+
+    def test_tour_rebuild_stats(self):
+        activity_dict = self.get_test_data_from_json_file("test_activity1")
+        activity = Activity(user=self.user1, strava_id=activity_dict["id"])
+        activity.update_from_strava(activity_dict)
+        db.session.add(activity)
+        db.session.commit()
+        self.assertTrue(self.tour1.covers(activity.start_date))
+
+        stats = self.tour1.rebuild_stats()
+        db.session.commit()
+        self.assertEqual(1, stats.version)
+        self.assertEqual(1, stats.activity_count)
+        self.assertEqual(activity.distance, stats.total_distance)
+        self.assertEqual(activity.moving_time, stats.total_moving_time)
+        self.assertEqual([(activity.min_lat, activity.min_lng),
+                          (activity.max_lat, activity.max_lng)], stats.bounds)
+
+        self.tour1.start_date = activity.start_date + datetime.timedelta(days=1)
+        self.assertFalse(self.tour1.covers(activity.start_date))
+        stats = self.tour1.rebuild_stats()
+        db.session.commit()
+        self.assertEqual(2, stats.version)
+        self.assertEqual(0, stats.activity_count)
+        self.assertEqual(0, stats.total_distance)
+        self.assertIsNone(stats.bounds)
+
+    def test_tour_rebuild_stats__version_incremented_by_db(self):
+        self.tour1.rebuild_stats()
+        db.session.commit()
+        # Rebuilt by another process meanwhile.
+        db.session.query(TourStats).update({TourStats.version: 5},
+                                           synchronize_session=False)
+        stats = self.tour1.rebuild_stats()
+        db.session.commit()
+        self.assertEqual(6, stats.version)
+
+    def test_hashid_stored(self):
+        self.assertEqual(User.get_Hashids().encode(self.user1.id), self.user1._hashid)
+        self.assertEqual(Tour.get_Hashids().encode(self.tour1.id), self.tour1._hashid)
+        self.assertIs(User.get_Hashids(), User.get_Hashids())
+        self.assertIsNot(User.get_Hashids(), Tour.get_Hashids())
+
+        hashid = self.user1.hashid
+        self.assertIs(self.user1, User.get_by_hashid(hashid))
+        self.assertIsNone(Tour.get_by_hashid(hashid + "x"))
+
+    def test_get_by_hashid__stored(self):
+        # As if stored with another HASHIDS_SALT: The stored one is used.
+        db.session.query(User).update({User._hashid: "stored"})
+        db.session.commit()
+        self.assertIs(self.user1, User.get_by_hashid("stored"))
+        self.assertIsNone(User.get_by_hashid(User.get_Hashids().encode(self.user1.id)))
+
+    def test_hashid_not_stored(self):
+        db.session.query(User).update({User._hashid: None})
+        db.session.commit()
+        self.assertIsNone(self.user1._hashid)
+        self.assertEqual(User.get_Hashids().encode(self.user1.id), self.user1.hashid)
+        self.assertIs(self.user1, User.get_by_hashid(self.user1.hashid))
@@ -0,0 +1,44 @@
+import datetime
+
+import tourmap_test
+
+from tourmap.models import Activity, PollState
+from tourmap.resources import db
+
+from tourmap.poller_simulation import Simulation, percentile
+
+
+class TestPollerSimulation(tourmap_test.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(100, percentile(values, 100))
+        self.assertIsNone(percentile([], 50))
+
+    def test_run(self):
+        simulation = Simulation(db.session, users=10, profiles={"commuter": 1.0},
+                                resolution=120, latest_fetch_max_interval_seconds=3600)
+        start = simulation.clock.now
+        report = simulation.run(datetime.timedelta(hours=4))
+
+        self.assertGreaterEqual(simulation.clock.now, start + datetime.timedelta(hours=4))
+        self.assertEqual(10, report["users"])
+        self.assertEqual(10, PollState.query.count())
+        self.assertGreater(report["activities_uploaded"], 0)
+        self.assertEqual(report["activities_stored"], Activity.query.count())
+        self.assertGreater(report["activities_stored"], 0)
+        self.assertEqual(report["jobs_submitted"], report["api_calls"])
+        self.assertLessEqual(report["lag_seconds"]["p50"], report["lag_seconds"]["max"])
+        self.assertEqual(0, report["rate_limited"])
+
+    def test_run__rate_limited(self):
+        simulation = Simulation(db.session, users=20, profiles={"inactive": 1.0},
+                                limits=(5, 30000))
+        report = simulation.run(datetime.timedelta(hours=1))
+
+        self.assertGreater(report["rate_limited"], 0)
+        # Not more than 5 requests in each of the four 15 minute windows.
+        self.assertLessEqual(report["api_calls"], 4 * 5)
+        self.assertEqual(0, report["activities_uploaded"])
@@ -0,0 +1,146 @@
+import threading
+import time
+import unittest
+
+from tourmap.utils.objpool import ObjectPool
+from tourmap.utils.ratelimit import RateLimiter
+from tourmap.utils.strava import StravaClient, StravaRateLimited
+
+from tourmap_test.fake_strava import FakeStrava
+
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        # 2019-10-01 12:05:00 UTC, 5 minutes into a 15 minute window.
+        self.clock = FakeClock(1569931500.0)
+        self.rate_limiter = RateLimiter(limits=(3, 5), clock=self.clock)
+
+    def test_try_acquire_until_exhausted(self):
+        for _ in range(3):
+            self.assertIsNone(self.rate_limiter.try_acquire())
+        self.assertEqual(0, self.rate_limiter.remaining())
+
+        # Refused until the next 15 minute window
+        self.assertEqual(1569931200.0 + 900, self.rate_limiter.try_acquire())
+        self.assertEqual(1569931200.0 + 900, self.rate_limiter.retry_at())
+
+    def test_window_reset(self):
+        for _ in range(3):
+            self.rate_limiter.try_acquire()
+        self.clock.now += 600
+        self.assertEqual(2, self.rate_limiter.remaining())
+        self.assertIsNone(self.rate_limiter.try_acquire())
+        self.assertIsNone(self.rate_limiter.try_acquire())
+
+        # Daily window is exhausted now, that resets at midnight.
+        self.assertEqual(1569974400.0, self.rate_limiter.retry_at())
+
+    def test_update_from_headers(self):
+        self.rate_limiter.update_from_headers({
+            "X-RateLimit-Limit": "600,30000",
+            "X-RateLimit-Usage": "590,1000",
+        })
+        self.assertEqual(10, self.rate_limiter.remaining())
+
+        # Garbage is ignored
+        self.rate_limiter.update_from_headers({
+            "X-RateLimit-Limit": "600",
+            "X-RateLimit-Usage": "a,b",
+        })
+        self.assertEqual(10, self.rate_limiter.remaining())
+
+    def test_reserve(self):
+        rate_limiter = RateLimiter(limits=(100, 1000), reserve=0.1, clock=self.clock)
+        self.assertEqual(90, rate_limiter.remaining())
+
+    def test_exhaust(self):
+        retry_at = self.rate_limiter.exhaust()
+        self.assertEqual(1569931200.0 + 900, retry_at)
+        self.assertEqual(0, self.rate_limiter.remaining())
+
+    def test_from_env(self):
+        rate_limiter = RateLimiter.from_env({"STRAVA_CLIENT_RATE_LIMITS": "200,2000",
+                                             "STRAVA_CLIENT_RATE_LIMIT_RESERVE": "0"})
+        self.assertEqual(200, rate_limiter.remaining())
+        with self.assertRaises(ValueError):
+            RateLimiter.from_env({"STRAVA_CLIENT_RATE_LIMITS": "200"})
+
+
+class TestRateLimitedClients(unittest.TestCase):
+    """
+    Run pooled clients against a fake Strava enforcing limits.
+    """
+
+    def setUp(self):
+        self.fake_strava = FakeStrava(limits=(20, 1000), activity_count=5).start()
+        self.addCleanup(self.fake_strava.stop)
+
+    def _make_pool(self, rate_limiter):
+        def cfn():
+            return StravaClient("-1", "TEST", base_url=self.fake_strava.base_url,
+                                rate_limiter=rate_limiter)
+        return ObjectPool(cfn)
+
+    def _hammer(self, pool, threads=4, requests_per_thread=10):
+        results = {"ok": 0, "rate_limited": 0}
+        lock = threading.Lock()
+
+        def work():
+            for _ in range(requests_per_thread):
+                with pool.use() as client:
+                    try:
+                        client.activities("TOKEN", per_page=2)
+                        outcome = "ok"
+                    except StravaRateLimited:
+                        outcome = "rate_limited"
+                with lock:
+                    results[outcome] += 1
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        results["requests_per_second"] = results["ok"] / (time.perf_counter() - start)
+        return results
+
+    def test_without_rate_limiter_strava_says_429(self):
+        results = self._hammer(self._make_pool(rate_limiter=None))
+        self.assertEqual(20, results["ok"])
+        self.assertEqual(20, results["rate_limited"])
+        self.assertEqual(20, self.fake_strava.rejected)
+
+    def test_shared_rate_limiter_at_the_edge(self):
+        rate_limiter = RateLimiter(limits=(20, 1000))
+        results = self._hammer(self._make_pool(rate_limiter))
+
+        # The whole budget was used, but nothing hit Strava's limit.
+        self.assertEqual(20, results["ok"])
+        self.assertEqual(20, results["rate_limited"])
+        self.assertEqual(20, self.fake_strava.served)
+        self.assertEqual(0, self.fake_strava.rejected)
+        self.assertGreater(results["requests_per_second"], 0)
+
+    def test_limits_learned_from_headers(self):
+        rate_limiter = RateLimiter(limits=(600, 30000))
+        client = self._make_pool(rate_limiter).get()
+        client.athlete("TOKEN")
+        self.assertEqual(19, rate_limiter.remaining())
+
+        for _ in range(19):
+            client.athlete("TOKEN")
+        with self.assertRaises(StravaRateLimited) as cm:
+            client.athlete("TOKEN")
+        self.assertIsNotNone(cm.exception.retry_at)
+        self.assertEqual(0, self.fake_strava.rejected)
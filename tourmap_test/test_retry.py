@@ -0,0 +1,149 @@
+import unittest
+
+from tourmap.utils.metrics import Metrics
+from tourmap.utils.retry import CircuitBreaker, RetryPolicy
+from tourmap.utils.retry import STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN
+from tourmap.utils.strava import StravaClient, StravaError, StravaNotFound
+from tourmap.utils.strava import StravaUnavailable
+
+from tourmap_test.fake_strava import FakeStrava
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff_seconds=0.5, backoff_max_seconds=3.0,
+                             random=lambda: 0.5)
+        self.assertEqual([0.25, 0.5, 1.0, 1.5, 1.5],
+                         [policy.delay(attempt) for attempt in range(5)])
+
+    def test_from_env(self):
+        policy = RetryPolicy.from_env({"STRAVA_CLIENT_RETRIES": "5"})
+        self.assertEqual(5, policy.retries)
+        with self.assertRaises(ValueError):
+            RetryPolicy(retries=-1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.metrics = Metrics()
+        self.breaker = CircuitBreaker(failure_threshold=3, open_seconds=60,
+                                      metrics=self.metrics, clock=lambda: self.now)
+
+    def test_open_half_open_close(self):
+        for _ in range(2):
+            self.assertIsNone(self.breaker.allow())
+            self.breaker.record_failure()
+        self.breaker.record_success()
+        for _ in range(3):
+            self.assertIsNone(self.breaker.allow())
+            self.breaker.record_failure()
+        self.assertEqual(STATE_OPEN, self.breaker.state)
+        self.assertEqual(1060.0, self.breaker.allow())
+        self.assertEqual(1060.0, self.breaker.retry_at())
+
+        # A single probe after open_seconds.
+        self.now += 60
+        self.assertIsNone(self.breaker.retry_at())
+        self.assertIsNone(self.breaker.allow())
+        self.assertEqual(STATE_HALF_OPEN, self.breaker.state)
+        self.assertIsNotNone(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(STATE_CLOSED, self.breaker.state)
+        self.assertIsNone(self.breaker.allow())
+
+        self.assertEqual(1, self.metrics.counter("circuit_breaker_trips"))
+        self.assertEqual(2, self.metrics.counter("circuit_breaker_refused"))
+        self.assertEqual(0, self.metrics.gauge("circuit_breaker_state"))
+
+    def test_probe_failed(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 60
+        self.assertIsNone(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(STATE_OPEN, self.breaker.state)
+        self.assertEqual(1120.0, self.breaker.allow())
+        self.assertEqual(2, self.metrics.gauge("circuit_breaker_state"))
+
+    def test_probe_cancelled(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 60
+        self.assertIsNone(self.breaker.allow())
+        self.breaker.cancel()
+        self.assertIsNone(self.breaker.allow())
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(failure_threshold=0)
+        for _ in range(100):
+            breaker.record_failure()
+        self.assertIsNone(breaker.allow())
+
+
+class TestStravaClientRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.sleeps = []
+
+    def _client(self, base_url, retries=2, circuit_breaker=None):
+        policy = RetryPolicy(retries=retries, random=lambda: 0.5,
+                             sleep=self.sleeps.append)
+        return StravaClient("-1", "TEST", base_url=base_url, retry_policy=policy,
+                            circuit_breaker=circuit_breaker, metrics=self.metrics)
+
+    def test_retried(self):
+        with FakeStrava() as fake_strava:
+            fake_strava.fail_next(2)
+            athlete = self._client(fake_strava.base_url).athlete("TOKEN")
+            self.assertEqual(3, len(fake_strava.paths))
+        self.assertEqual(1, athlete["id"])
+        self.assertEqual([0.25, 0.5], self.sleeps)
+        self.assertEqual(2, self.metrics.counter("strava_retries"))
+        self.assertEqual(0, self.metrics.counter("strava_retries_exhausted"))
+
+    def test_retries_exhausted(self):
+        with FakeStrava() as fake_strava:
+            fake_strava.fail_next(5, status=502)
+            with self.assertRaises(StravaError):
+                self._client(fake_strava.base_url).athlete("TOKEN")
+            self.assertEqual(3, len(fake_strava.paths))
+        self.assertEqual(1, self.metrics.counter("strava_retries_exhausted"))
+
+    def test_not_retried(self):
+        with FakeStrava() as fake_strava:
+            with self.assertRaises(StravaNotFound):
+                self._client(fake_strava.base_url).activity("TOKEN", 1)
+            fake_strava.fail_next(1, status=501)
+            with self.assertRaises(StravaError):
+                self._client(fake_strava.base_url).athlete("TOKEN")
+            self.assertEqual(2, len(fake_strava.paths))
+        self.assertEqual(0, self.metrics.counter("strava_retries"))
+
+    def test_connection_error(self):
+        # Nothing listens on port 1.
+        with self.assertRaises(StravaError):
+            self._client("http://127.0.0.1:1").athlete("TOKEN")
+        self.assertEqual(2, self.metrics.counter("strava_retries"))
+
+    def test_circuit_breaker_shared(self):
+        breaker = CircuitBreaker(failure_threshold=2, open_seconds=60)
+        with FakeStrava() as fake_strava:
+            fake_strava.fail_next(2)
+            client = self._client(fake_strava.base_url, circuit_breaker=breaker)
+            with self.assertRaises(StravaUnavailable) as cm:
+                client.athlete("TOKEN")
+            self.assertIsNotNone(cm.exception.retry_at)
+
+            # Other clients do not even try.
+            other_client = self._client(fake_strava.base_url, circuit_breaker=breaker)
+            with self.assertRaises(StravaUnavailable):
+                other_client.athlete("TOKEN")
+            self.assertEqual(2, len(fake_strava.paths))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import collections
+import unittest
+
+from tourmap.utils.scheduling import FairScheduler, parse_class_values
+
+
+class TestFairScheduler(unittest.TestCase):
+
+    def test_weights(self):
+        scheduler = FairScheduler(
+            collections.OrderedDict([("latest", 3), ("backfill", 1)]))
+        picks = scheduler.order({"latest": 100, "backfill": 100}, slots=40)
+        self.assertEqual(30, picks.count("latest"))
+        self.assertEqual(10, picks.count("backfill"))
+
+    def test_idle_class_takes_all(self):
+        scheduler = FairScheduler({"latest": 3, "backfill": 1})
+        self.assertEqual(["backfill"] * 5, scheduler.order({"backfill": 100}, slots=5))
+        self.assertEqual([], scheduler.order({}, slots=5))
+
+    def test_no_banked_credit(self):
+        """
+        A class coming back after being idle does not get all slots.
+        """
+        scheduler = FairScheduler({"latest": 1, "backfill": 1})
+        for _ in range(10):
+            scheduler.order({"backfill": 100}, slots=10)
+        picks = scheduler.order({"latest": 100, "backfill": 100}, slots=10)
+        self.assertIn(picks.count("latest"), (5, 6))
+
+    def test_min_shares(self):
+        scheduler = FairScheduler({"latest": 100, "photos": 1},
+                                  min_shares={"photos": 0.2}, window=10)
+        picks = scheduler.order({"latest": 1000, "photos": 1000}, slots=100)
+        self.assertAlmostEqual(20, picks.count("photos"), delta=1)
+
+        scheduler = FairScheduler({"latest": 100, "photos": 1})
+        picks = scheduler.order({"latest": 1000, "photos": 1000}, slots=100)
+        self.assertEqual(1, picks.count("photos"))
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            FairScheduler({"latest": 0})
+        with self.assertRaises(ValueError):
+            FairScheduler({"latest": 1}, min_shares={"backfill": 0.1})
+        with self.assertRaises(ValueError):
+            FairScheduler({"latest": 1, "backfill": 1},
+                          min_shares={"latest": 0.6, "backfill": 0.6})
+
+    def test_parse_class_values(self):
+        self.assertEqual({"latest": 4.0, "backfill": 0.5},
+                         parse_class_values("latest=4, backfill=0.5"))
+        self.assertEqual({"latest": 4.0}, parse_class_values({"latest": "4"}))
+        with self.assertRaises(ValueError):
+            parse_class_values("latest")
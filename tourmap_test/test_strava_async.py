@@ -0,0 +1,203 @@
+import asyncio
+import time
+import unittest
+import uuid
+
+import tourmap_test
+
+from tourmap.models import PollState, Token, User
+from tourmap.resources import db
+from tourmap.strava_poller import PollStateData, StravaPoller
+from tourmap.utils.asyncio_executor import AsyncioExecutor
+from tourmap.utils.metrics import Metrics
+from tourmap.utils.objpool import ObjectPool
+from tourmap.utils.ratelimit import RateLimiter
+from tourmap.utils.retry import CircuitBreaker, RetryPolicy
+from tourmap.utils.strava import (
+    StravaClient,
+    StravaError,
+    StravaNotFound,
+    StravaRateLimited,
+    StravaUnavailable,
+)
+from tourmap.utils.strava_async import AsyncStravaClient, aiohttp
+
+from tourmap_test.fake_strava import FakeStrava
+
+
+def _poll_state_data(full_fetch_completed=False):
+    return PollStateData(
+        full_fetch_completed=full_fetch_completed,
+        full_fetch_next_page=None,
+        full_fetch_per_page=None,
+        full_fetch_before=None,
+        last_fetch_completed_at=None,
+        total_fetches=0,
+    )
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp not installed")
+class TestAsyncStravaClient(unittest.TestCase):
+
+    def _run(self, fake_strava, fn, **kwargs):
+        async def run():
+            async with AsyncStravaClient("-1", "TEST", base_url=fake_strava.base_url,
+                                         **kwargs) as client:
+                return await fn(client)
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_activities(self):
+        with FakeStrava(activity_count=5) as fake_strava:
+            activities = self._run(fake_strava,
+                                   lambda c: c.activities("TOKEN", per_page=3))
+            self.assertEqual([a["id"] for a in fake_strava.activities[:3]],
+                             [a["id"] for a in activities])
+            self.assertIn("per_page=3", fake_strava.paths[-1])
+
+            activity = self._run(fake_strava, lambda c: c.activity("TOKEN", 1000001))
+            self.assertEqual(1000001, activity["id"])
+
+            with self.assertRaises(StravaNotFound):
+                self._run(fake_strava, lambda c: c.activity("TOKEN", 1))
+
+    def test_refresh_token(self):
+        with FakeStrava() as fake_strava:
+            result = self._run(fake_strava, lambda c: c.refresh_token("REFRESH"))
+        self.assertEqual("Bearer", result["token_type"])
+
+    def test_rate_limited(self):
+        with FakeStrava(limits=(1, 1000)) as fake_strava:
+            rate_limiter = RateLimiter(limits=(10, 1000))
+            self._run(fake_strava, lambda c: c.athlete("TOKEN"),
+                      rate_limiter=rate_limiter)
+            with self.assertRaises(StravaRateLimited) as cm:
+                self._run(fake_strava, lambda c: c.athlete("TOKEN"),
+                          rate_limiter=rate_limiter)
+        self.assertIsNotNone(cm.exception.retry_at)
+        self.assertEqual(0, rate_limiter.remaining())
+
+    def test_retried(self):
+        metrics = Metrics()
+        policy = RetryPolicy(retries=2, random=lambda: 0.0)
+        with FakeStrava() as fake_strava:
+            fake_strava.fail_next(2)
+            athlete = self._run(fake_strava, lambda c: c.athlete("TOKEN"),
+                                retry_policy=policy, metrics=metrics)
+            self.assertEqual(3, len(fake_strava.paths))
+
+            fake_strava.fail_next(5, status=502)
+            with self.assertRaises(StravaError):
+                self._run(fake_strava, lambda c: c.athlete("TOKEN"),
+                          retry_policy=policy, metrics=metrics)
+            self.assertEqual(6, len(fake_strava.paths))
+        self.assertEqual(1, athlete["id"])
+        self.assertEqual(4, metrics.counter("strava_retries"))
+        self.assertEqual(1, metrics.counter("strava_retries_exhausted"))
+
+    def test_circuit_breaker_shared(self):
+        breaker = CircuitBreaker(failure_threshold=2, open_seconds=60)
+        with FakeStrava() as fake_strava:
+            fake_strava.fail_next(2)
+            with self.assertRaises(StravaError):
+                self._run(fake_strava, lambda c: c.athlete("TOKEN"),
+                          circuit_breaker=breaker)
+            with self.assertRaises(StravaError):
+                self._run(fake_strava, lambda c: c.athlete("TOKEN"),
+                          circuit_breaker=breaker)
+
+            # Open for the synchronous clients, too.
+            sync_client = StravaClient("-1", "TEST", base_url=fake_strava.base_url,
+                                       circuit_breaker=breaker)
+            with self.assertRaises(StravaUnavailable):
+                sync_client.athlete("TOKEN")
+            with self.assertRaises(StravaUnavailable) as cm:
+                self._run(fake_strava, lambda c: c.athlete("TOKEN"),
+                          circuit_breaker=breaker)
+            self.assertEqual(2, len(fake_strava.paths))
+        self.assertIsNotNone(cm.exception.retry_at)
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp not installed")
+class TestAsyncioEngine(tourmap_test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = db.session
+        self.user = User(strava_id=123, email="auser@strava.com")
+        self.session.add_all([
+            self.user,
+            Token(user=self.user, access_token=uuid.uuid4().hex),
+            PollState(user=self.user),
+        ])
+        self.session.commit()
+
+    def _pollers(self, fake_strava, **kwargs):
+        pool = ObjectPool(
+            lambda: StravaClient("-1", "TEST", base_url=fake_strava.base_url))
+        async_client = AsyncStravaClient("-1", "TEST", base_url=fake_strava.base_url)
+        threads = StravaPoller(self.session, pool, **kwargs)
+        asyncio_ = StravaPoller(self.session, pool, engine="asyncio",
+                                async_strava_client=async_client, **kwargs)
+        return threads, asyncio_, async_client
+
+    def test_engine_requires_client(self):
+        with self.assertRaises(ValueError):
+            StravaPoller(self.session, None, engine="asyncio")
+        with self.assertRaises(ValueError):
+            StravaPoller(self.session, None, engine="fibers")
+
+    def test_asyncio_max_concurrency(self):
+        with FakeStrava() as fake_strava:
+            threads, asyncio_, _ = self._pollers(fake_strava, max_concurrency=8,
+                                                 asyncio_max_concurrency=300)
+        self.assertEqual(8, threads.concurrency.max_limit)
+        self.assertEqual(300, asyncio_.concurrency.max_limit)
+
+    def test_same_results(self):
+        with FakeStrava(activity_count=5, photo_count=1) as fake_strava:
+            threads, asyncio_, async_client = self._pollers(fake_strava)
+            expected = threads.fetch_activities(self.user.id, "TOKEN", _poll_state_data())
+            with AsyncioExecutor(on_shutdown=async_client.close) as executor:
+                result = executor.submit(asyncio_.fetch_activities_async, self.user.id,
+                                         "TOKEN", _poll_state_data()).result()
+                photos = executor.submit(
+                    asyncio_.fetch_photos_async, self.user.id, "TOKEN",
+                    [{"id": 1000000, "total_photo_count": 1}]).result()
+
+        self.assertEqual(expected["activity_infos"], result["activity_infos"])
+        self.assertTrue(result["state_update"]["full_fetch_completed"])
+        self.assertEqual(expected["activity_infos"][0]["photos"],
+                         photos["photo_infos"][0]["photos"])
+
+    def test_submit_uses_coroutines(self):
+        with FakeStrava(activity_count=2) as fake_strava:
+            _, asyncio_, _ = self._pollers(fake_strava)
+            fn = asyncio_._job_function(asyncio_.fetch_activities)
+        self.assertEqual(asyncio_.fetch_activities_async, fn)
+        self.assertTrue(asyncio.iscoroutinefunction(fn))
+
+    def test_many_users_in_flight(self):
+        """
+        Hundreds of jobs at the same time on a single event loop.
+        """
+        users = 200
+        with FakeStrava(activity_count=1, latency=0.5) as fake_strava:
+            _, asyncio_, async_client = self._pollers(fake_strava)
+            start = time.monotonic()
+            with AsyncioExecutor(on_shutdown=async_client.close) as executor:
+                futures = [
+                    executor.submit(asyncio_.fetch_activities_async, self.user.id,
+                                    "TOKEN", _poll_state_data(full_fetch_completed=True))
+                    for _ in range(users)
+                ]
+                for f in futures:
+                    f.result()
+            elapsed = time.monotonic() - start
+
+        self.assertEqual(users, fake_strava.served)
+        self.assertGreater(fake_strava.max_in_flight, 50)
+        self.assertLess(elapsed, users * 0.5 / 10)
@@ -127,6 +127,8 @@ class StravaLoginTest(tourmap_test.TestCase):
         self.assertEqual("All Activities", tour.name)
         self.assertTrue(tour.marker_enable_clusters)
         self.assertEqual("middle", tour.marker_positioning)
+        self.assertEqual(1, tour.stats.version)
+        self.assertEqual(0, tour.stats.activity_count)
         user = User.query.first()
         self.assertEqual(user.id, tour.user_id)
 
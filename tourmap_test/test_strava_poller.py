@@ -7,14 +7,27 @@ from concurrent.futures import Future
 import tourmap_test
 import tourmap_test.data
 
-from tourmap.models import Activity, User, Tour, PollState, Token
+from tourmap import database
+from tourmap.models import Activity, ActivityPhotos, User, Tour, TourStats
+from tourmap.models import PollState, Token
 from tourmap.resources import db
-from tourmap.utils import dt2ts
+from tourmap.utils import dt2ts, geometry
+from tourmap.utils.deadline import Deadline, DeadlineExceeded
 from tourmap.utils.json import dumps
 from tourmap.utils.objpool import ObjectPool
-from tourmap.utils.strava import StravaClient, InvalidAthleteAccessToken
+from tourmap.utils.ratelimit import RateLimiter
+from tourmap.utils.retry import CircuitBreaker
+from tourmap.utils.strava import (
+    StravaClient,
+    InvalidAthleteAccessToken,
+    StravaRateLimited,
+)
+from tourmap.utils.strava import StravaUnavailable
 
 from tourmap.strava_poller import StravaPoller
+from tourmap.token_refresher import TokenRefresher
+
+from tourmap_test.fake_strava import FakeStrava
 
 
 class TestStravaPoller(tourmap_test.TestCase):
@@ -71,25 +84,40 @@ class TestStravaPoller(tourmap_test.TestCase):
         poll_state2 = PollState(
             user=self.cuser,
             full_fetch_completed=True,
-            last_fetch_completed_at=datetime.datetime.utcnow(),  # This should not show up
+            # This should not show up
+            next_poll_at=datetime.datetime.utcnow() + datetime.timedelta(minutes=5),
         )
         self.session.add_all([poll_state1, poll_state2])
         self.session.commit()
         states = list(self.strava_poller._get_poll_states())
         self.assertEqual(2, len(states))
 
+    def test_get_poll_states__never_polled_first(self):
+        now = datetime.datetime.utcnow()
+        poll_state1 = PollState(user=self.buser,
+                                next_poll_at=now - datetime.timedelta(minutes=5))
+        poll_state2 = PollState(user=self.cuser,
+                                next_poll_at=now - datetime.timedelta(minutes=10))
+        self.session.add_all([poll_state1, poll_state2])
+        self.session.commit()
+
+        states = list(self.strava_poller._get_poll_states(limit=2))
+        self.assertEqual([self.poll_state, poll_state2], states)
+        self.assertEqual([poll_state1], list(self.strava_poller._get_poll_states()))
+
     def test_fetch_activities__full_fetch_mode(self):
         self.strava_client_mock.activities.return_value = []
         result = self.strava_poller.fetch_activities(self.user.id, self.token.access_token, self.poll_state)
         self.strava_client_mock.activities.assert_called_once_with(
-            page=1,
-            per_page=20,
-            token=self.token.access_token
+            per_page=200,
+            token=self.token.access_token,
+            deadline=None,
         )
 
         self.assertTrue(result["state_update"]["full_fetch_completed"])
         self.assertEqual(2, result["state_update"]["full_fetch_next_page"])
-        self.assertEqual(20, result["state_update"]["full_fetch_per_page"])
+        self.assertEqual(200, result["state_update"]["full_fetch_per_page"])
+        self.assertIsNone(result["state_update"]["full_fetch_before"])
         self.assertIsInstance(
             result["state_update"]["last_fetch_completed_at"],
             datetime.datetime
@@ -108,7 +136,8 @@ class TestStravaPoller(tourmap_test.TestCase):
         self.strava_client_mock.activities.assert_called_once_with(
             after=expected_after_ts,
             token=self.token.access_token,
-            per_page=50
+            per_page=200,
+            deadline=None,
         )
 
         self.assertTrue(result["state_update"]["total_fetches"])
@@ -117,6 +146,162 @@ class TestStravaPoller(tourmap_test.TestCase):
             datetime.datetime
         )
 
+    def test_full_fetch__before_cursor(self):
+        with FakeStrava(activity_count=5) as fake_strava:
+            pool = self._fake_strava_pool(fake_strava)
+            strava_poller = StravaPoller(self.session, pool,
+                                         full_fetch_per_page_default=2)
+
+            for _ in range(5):
+                self.assertFalse(self.poll_state.full_fetch_completed)
+                self._full_fetch_page(strava_poller)
+
+                # Deleting the newest activity does not shift anything.
+                fake_strava.activities[:1] = []
+
+        # Pages overlap by the oldest activity of the previous one.
+        self.assertTrue(self.poll_state.full_fetch_completed)
+        self.assertEqual(datetime.datetime(2018, 12, 28),
+                         self.poll_state.full_fetch_before)
+        self.assertEqual(5, Activity.query.count())
+        self.assertEqual(5, fake_strava.served)
+        self.assertFalse([p for p in fake_strava.paths if "?page=" in p or "&page=" in p])
+
+    def _full_fetch_page(self, strava_poller):
+        result = strava_poller.fetch_activities(
+            self.user.id, self.token.access_token, self.poll_state,
+            known_activities=strava_poller._get_known_activities(self.poll_state))
+        strava_poller._process_result(self.poll_state, result)
+        return [info["activity"]["id"] for info in result["activity_infos"]]
+
+    def test_full_fetch__same_second_on_next_page(self):
+        with FakeStrava(activity_count=4) as fake_strava:
+            ids = [a["id"] for a in fake_strava.activities]
+            activities = fake_strava.activities
+            activities[2]["start_date"] = activities[1]["start_date"]
+            pool = self._fake_strava_pool(fake_strava)
+            strava_poller = StravaPoller(self.session, pool,
+                                         full_fetch_per_page_default=2)
+
+            self.assertEqual(ids[:2], self._full_fetch_page(strava_poller))
+            # The second one is seen again, but skipped as known.
+            self.assertEqual(ids[2:3], self._full_fetch_page(strava_poller))
+            self.assertEqual(ids[3:], self._full_fetch_page(strava_poller))
+
+        self.assertTrue(self.poll_state.full_fetch_completed)
+        self.assertEqual(4, Activity.query.count())
+
+    def test_latest_fetch__same_second_on_next_page(self):
+        self.poll_state.full_fetch_completed = True
+        self.poll_state.last_fetch_completed_at = datetime.datetime(2019, 1, 2)
+        self.session.commit()
+        with FakeStrava(activity_count=4) as fake_strava:
+            # Oldest first: The newest of the first page and the oldest
+            # of the second one start in the same second.
+            activities = fake_strava.activities
+            activities[1]["start_date"] = activities[2]["start_date"]
+            pool = self._fake_strava_pool(fake_strava)
+            strava_poller = StravaPoller(self.session, pool, latest_fetch_per_page=2)
+            result = strava_poller.fetch_activities(self.user.id, self.token.access_token,
+                                                    self.poll_state)
+
+        ids = [info["activity"]["id"] for info in result["activity_infos"]]
+        self.assertEqual(sorted(a["id"] for a in fake_strava.activities), sorted(ids))
+
+    def test_latest_fetch__paginates(self):
+        self.poll_state.full_fetch_completed = True
+        self.poll_state.last_fetch_completed_at = datetime.datetime(2019, 1, 2)
+        self.session.commit()
+        with FakeStrava(activity_count=30) as fake_strava:
+            pool = self._fake_strava_pool(fake_strava)
+            strava_poller = StravaPoller(self.session, pool, latest_fetch_per_page=5)
+            result = strava_poller.fetch_activities(self.user.id, self.token.access_token,
+                                                    self.poll_state)
+
+        # 13 activities within the last 14 days, in pages of 5 that
+        # overlap by one.
+        self.assertEqual(13, len(result["activity_infos"]))
+        ids = {info["activity"]["id"] for info in result["activity_infos"]}
+        self.assertEqual(13, len(ids))
+        self.assertEqual(4, fake_strava.served)
+
+    def _fake_strava_pool(self, fake_strava):
+        return ObjectPool(
+            lambda: StravaClient("-1", "TEST", base_url=fake_strava.base_url))
+
+    def test_fetch_photos__concurrent(self):
+        activities = [{"id": 1000000 + i, "total_photo_count": 1} for i in range(4)]
+        with FakeStrava(activity_count=4, photo_count=1, latency=0.05) as fake_strava:
+            pool = self._fake_strava_pool(fake_strava)
+            sequential = StravaPoller(self.session, pool, photo_fetch_concurrency=1)
+            with pool.use() as client:
+                job = sequential._fetch_photos_for_activities("TOKEN", activities)
+                expected = sequential._run_job(client, job)
+            self.assertEqual(1, fake_strava.max_in_flight)
+
+            fake_strava.max_in_flight = 0
+            concurrent = StravaPoller(self.session, pool, photo_fetch_concurrency=3)
+            with pool.use() as client:
+                job = concurrent._fetch_photos_for_activities("TOKEN", activities)
+                result = concurrent._run_job(client, job)
+
+        self.assertEqual(expected, result)
+        self.assertEqual([256, 1024], list(result[1000000].keys()))
+        self.assertEqual(3, fake_strava.max_in_flight)
+        self.assertEqual(16, fake_strava.served)
+
+    def test_fetch_photos__bounded_pool(self):
+        activities = [{"id": 1000000 + i, "total_photo_count": 1} for i in range(4)]
+        with FakeStrava(activity_count=4, photo_count=1) as fake_strava:
+            pool = ObjectPool(
+                lambda: StravaClient("-1", "TEST", base_url=fake_strava.base_url),
+                maxsize=2)
+            strava_poller = StravaPoller(self.session, pool, photo_fetch_concurrency=3)
+            with pool.use() as client:
+                job = strava_poller._fetch_photos_for_activities("TOKEN", activities)
+                result = strava_poller._run_job(client, job)
+
+        # Threads that found the pool empty used the job's client.
+        self.assertEqual(4, len(result))
+        self.assertEqual(2, pool.size())
+
+    def test_defer_photos(self):
+        self.token.refresh_token = uuid.uuid4().hex
+        self.token.expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=6)
+        self.poll_state.full_fetch_completed = True
+        self.poll_state.last_fetch_completed_at = datetime.datetime(2019, 1, 2)
+        self.session.commit()
+
+        with FakeStrava(activity_count=3, photo_count=2) as fake_strava:
+            pool = self._fake_strava_pool(fake_strava)
+            strava_poller = StravaPoller(self.session, pool, defer_photos=True)
+            result = strava_poller.fetch_activities(self.user.id, self.token.access_token,
+                                                    self.poll_state)
+            self.assertEqual(1, fake_strava.served)
+            strava_poller._process_result(self.poll_state, result)
+
+            # Activities are there, photos are not.
+            self.assertEqual(3, Activity.query.filter_by(photos_pending=True).count())
+            self.assertEqual(0, ActivityPhotos.query.count())
+            next_poll_at = self.poll_state.next_poll_at
+            self.assertGreater(next_poll_at, datetime.datetime.utcnow())
+
+            # Not due, but claimed for a photo job.
+            executor = unittest.mock.Mock()
+            executor.submit.side_effect = lambda fn, **kwargs: Future()
+            strava_poller._submit(executor)
+            fn, = executor.submit.call_args[0]
+            self.assertEqual(strava_poller.fetch_photos, fn)
+
+            result = fn(**executor.submit.call_args[1])
+            strava_poller._process_result(self.poll_state, result)
+
+        self.assertEqual(7, fake_strava.served)
+        self.assertEqual(0, Activity.query.filter_by(photos_pending=True).count())
+        self.assertEqual(3, ActivityPhotos.query.count())
+        self.assertEqual(2, len(ActivityPhotos.query.first().get_photos()[1024]))
+        self.assertEqual(next_poll_at, self.poll_state.next_poll_at)
+
     def test_json_dumps(self):
         serialize_this = {
             "now": datetime.datetime(2019, 9, 29, 13, 34, 24),
@@ -141,6 +326,7 @@ class TestStravaPoller(tourmap_test.TestCase):
         self.assertEqual("Morning Ride", a.name)
         self.assertIsNone(a.summary_polyline)
         self.assertEqual(0, len(a.latlngs))
+        self.assertIsNone(a.packed_latlngs)
         self.assertIsNone(a.start_lat)
         self.assertIsNone(a.start_lng)
         self.assertIsNone(a.end_lat)
@@ -153,6 +339,8 @@ class TestStravaPoller(tourmap_test.TestCase):
         self.assertEqual(7634, a.elapsed_time)
         self.assertTrue(a.summary_polyline)
         self.assertEqual(96, len(a.latlngs))
+        self.assertEqual(96, a.point_count)
+        self.assertEqual(a.latlngs, geometry.unpack_latlngs(a.packed_latlngs))
         self.assertAlmostEqual(37.72, a.start_lat)
         self.assertAlmostEqual(-122.4, a.start_lng)
         self.assertAlmostEqual(37.57, a.end_lat)
@@ -163,24 +351,16 @@ class TestStravaPoller(tourmap_test.TestCase):
 
         self.strava_client_mock.activities.return_value = [activity1_dict]
         self.strava_client_mock.activity_photos.return_value = []
-        self.strava_poller._latest_fetch(
-            self.strava_client_mock,
-            self.user,
-            self.token,
-            self.poll_state
-        )
+        job = self.strava_poller._latest_fetch(self.user, self.token, self.poll_state)
+        self.strava_poller._run_job(self.strava_client_mock, job)
 
     def test_activity_photos__weird_sizes(self):
         from tourmap_test.data import photos2_dict, activity1_dict
 
         self.strava_client_mock.activities.return_value = [activity1_dict]
         self.strava_client_mock.activity_photos.return_value = [photos2_dict]
-        self.strava_poller._latest_fetch(
-            self.strava_client_mock,
-            self.user,
-            self.token,
-            self.poll_state
-        )
+        job = self.strava_poller._latest_fetch(self.user, self.token, self.poll_state)
+        self.strava_poller._run_job(self.strava_client_mock, job)
 
     def test_process_result_futures(self):
         future = Future()
@@ -220,3 +400,636 @@ class TestStravaPoller(tourmap_test.TestCase):
         self.assertTrue(self.poll_state.error_happened)
         self.assertIsNotNone(self.poll_state.last_fetch_completed_at)
         self.assertFalse(self.poll_state.stopped)
+
+    def test_get_next_due_at__due_states_ignored(self):
+        # The single poll_state is due right now, nothing else is pending.
+        self.assertIsNone(self.strava_poller._get_next_due_at())
+
+    def test_get_next_due_at(self):
+        now = datetime.datetime.utcnow()
+        self.poll_state.next_poll_at = now + datetime.timedelta(seconds=20)
+        poll_state = PollState(
+            user=self.buser,
+            full_fetch_completed=True,
+            next_poll_at=now + datetime.timedelta(hours=1),
+        )
+        self.session.add(poll_state)
+        self.session.commit()
+
+        next_due_at = self.strava_poller._get_next_due_at()
+        self.assertEqual(self.poll_state.next_poll_at, next_due_at)
+
+    def test_get_poll_interval_seconds(self):
+        now = datetime.datetime(2019, 10, 1, 12, 0, 0)
+        interval = self.strava_poller._get_poll_interval_seconds
+
+        # Daily uploader: a day divided by 96 is 15 minutes.
+        daily = [now - datetime.timedelta(days=d, hours=2) for d in range(10)]
+        self.assertEqual(900.0, interval(daily, now))
+
+        # Uploads every hour hit the floor.
+        hourly = [now - datetime.timedelta(hours=h) for h in range(10)]
+        self.assertEqual(300, interval(hourly, now))
+
+        # Inactive for two months, or nothing at all, hit the ceiling.
+        inactive = [now - datetime.timedelta(days=60 + d) for d in range(10)]
+        self.assertEqual(21600, interval(inactive, now))
+        self.assertEqual(21600, interval([], now))
+
+    def test_process_result__sets_next_poll_at(self):
+        now = datetime.datetime.utcnow()
+        self.poll_state.full_fetch_completed = True
+        self.session.commit()
+        with unittest.mock.patch.object(self.strava_poller, "_now", return_value=now):
+            self.strava_poller._process_result(self.poll_state, {
+                "activity_infos": [],
+                "state_update": {"last_fetch_completed_at": now},
+            })
+        self.assertEqual(now + datetime.timedelta(seconds=21600),
+                         self.poll_state.next_poll_at)
+
+        # Still in full fetch mode, come back soon.
+        self.poll_state.full_fetch_completed = False
+        with unittest.mock.patch.object(self.strava_poller, "_now", return_value=now):
+            self.strava_poller._process_result(self.poll_state, {
+                "activity_infos": [],
+                "state_update": {"last_fetch_completed_at": now},
+            })
+        self.assertEqual(now + datetime.timedelta(seconds=30),
+                         self.poll_state.next_poll_at)
+
+    def test_run_once__only_scans_when_due(self):
+        now = datetime.datetime(2019, 10, 1, 12, 0, 0)
+        self.poll_state.next_poll_at = now + datetime.timedelta(seconds=20)
+        self.session.commit()
+        strava_poller = StravaPoller(self.session, self.strava_client_pool,
+                                     master_sleep_seconds=30)
+
+        patch = unittest.mock.patch.object
+        with patch(strava_poller, "_now", return_value=now), \
+                patch(strava_poller, "_sleep") as sleep_mock, \
+                patch(strava_poller, "_submit") as submit_mock:
+            executor = unittest.mock.Mock()
+            strava_poller._run_once(executor)
+            submit_mock.assert_called_once_with(executor)
+            sleep_mock.assert_called_once_with(20.0)
+
+            # Nothing became due, so no further DB scan.
+            strava_poller._run_once(executor)
+            self.assertEqual(1, submit_mock.call_count)
+
+    def test_run_once__picks_up_new_poll_states(self):
+        now = datetime.datetime(2019, 10, 1, 12, 0, 0)
+        self.poll_state.next_poll_at = now + datetime.timedelta(hours=1)
+        self.session.commit()
+
+        # Nothing is due, but PollStates of new users have no event
+        # waking the master, so it must not block for long.
+        patch = unittest.mock.patch.object
+        with patch(self.strava_poller, "_now", return_value=now), \
+                patch(self.strava_poller, "_sleep") as sleep_mock, \
+                patch(self.strava_poller, "_submit"):
+            self.strava_poller._run_once(unittest.mock.Mock())
+            sleep_mock.assert_called_once_with(1.0)
+
+    def test_run_once__wakes_up_on_finished_job(self):
+        self.token.refresh_token = uuid.uuid4().hex
+        self.token.expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=6)
+        self.session.commit()
+        executor = unittest.mock.Mock()
+        executor.submit.side_effect = lambda fn, **kwargs: future
+        future = Future()
+        future.set_result({
+            "activity_infos": [],
+            "state_update": {"last_fetch_completed_at": datetime.datetime.utcnow()},
+        })
+
+        with unittest.mock.patch.object(self.strava_poller, "_sleep") as sleep_mock:
+            self.strava_poller._run_once(executor)
+
+        sleep_mock.assert_not_called()
+        self.assertEqual(1, executor.submit.call_count)
+        self.assertFalse(self.strava_poller._has_submitted_ids())
+        self.assertIsNotNone(self.poll_state.last_fetch_completed_at)
+
+    def _process_results_twice(self, strava_poller):
+        from tourmap_test.data import poller_crash_results1
+        results = json.loads(dumps(poller_crash_results1))
+        results["state_update"]["last_fetch_completed_at"] = datetime.datetime.utcnow()
+        strava_poller._process_result(self.poll_state, results)
+        self.assertEqual(4, Activity.query.count())
+        self.assertEqual(4, ActivityPhotos.query.count())
+
+        results["activity_infos"][0]["activity"]["name"] = "Renamed"
+        strava_poller._process_result(self.poll_state, results)
+        self.assertEqual(4, Activity.query.count())
+        self.assertEqual(4, ActivityPhotos.query.count())
+        a = Activity.query.filter_by(strava_id=986628180).one()
+        self.assertEqual("Renamed", a.name)
+        self.assertEqual(self.user.id, a.user_id)
+        self.assertEqual({}, a.photos.get_photos())
+        self.assertEqual(Activity.get_Hashids().encode(a.id), a._hashid)
+
+    def test_process_result__upsert(self):
+        self.assertTrue(database.supports_upsert(self.session))
+        self._process_results_twice(self.strava_poller)
+
+    def test_process_result__orm(self):
+        strava_poller = StravaPoller(self.session, self.strava_client_pool, upsert=False)
+        self._process_results_twice(strava_poller)
+
+    def _process_results_unchanged(self, strava_poller):
+        from tourmap_test.data import poller_crash_results1
+        results = json.loads(dumps(poller_crash_results1))
+        results["state_update"]["last_fetch_completed_at"] = datetime.datetime.utcnow()
+        strava_poller._process_result(self.poll_state, results)
+        a = Activity.query.filter_by(strava_id=986628180).one()
+        self.assertIsNotNone(a.content_hash)
+        self.assertIsNotNone(a.photos.content_hash)
+
+        # Change the rows behind the poller's back. Processing the
+        # same result again should not touch them.
+        a.name = "Changed in the DB"
+        a.photos.data = "{}"
+        self.session.commit()
+        strava_poller._process_result(self.poll_state, results)
+        a = Activity.query.filter_by(strava_id=986628180).one()
+        self.assertEqual("Changed in the DB", a.name)
+        self.assertEqual("{}", a.photos.data)
+
+        # Changing the payload is picked up.
+        results["activity_infos"][0]["activity"]["name"] = "Big Basin Loop"
+        strava_poller._process_result(self.poll_state, results)
+        a = Activity.query.filter_by(strava_id=986628180).one()
+        self.assertEqual("Big Basin Loop", a.name)
+
+    def test_process_result__upsert_skips_unchanged(self):
+        self._process_results_unchanged(self.strava_poller)
+
+    def test_process_result__orm_skips_unchanged(self):
+        strava_poller = StravaPoller(self.session, self.strava_client_pool, upsert=False)
+        self._process_results_unchanged(strava_poller)
+
+    def _process_results_tour_stats(self, strava_poller):
+        from tourmap_test.data import poller_crash_results1
+        other_tour = Tour(user=self.user, name="Other Test Tour",
+                          start_date=datetime.datetime(2000, 1, 1),
+                          end_date=datetime.datetime(2000, 12, 31))
+        self.session.add(other_tour)
+        self.session.commit()
+
+        results = json.loads(dumps(poller_crash_results1))
+        results["state_update"]["last_fetch_completed_at"] = datetime.datetime.utcnow()
+        strava_poller._process_result(self.poll_state, results)
+        stats = self.tour.stats
+        self.assertEqual(1, stats.version)
+        self.assertEqual(TourStats.compute(self.tour), {
+            k: getattr(stats, k) for k in TourStats.compute(self.tour)
+        })
+        shown = [a for a in Activity.query if a.point_count]
+        self.assertEqual(3, len(shown))
+        self.assertEqual(len(shown), stats.activity_count)
+        self.assertEqual(sum(a.distance for a in shown), stats.total_distance)
+        self.assertEqual(min(a.min_lat for a in shown), stats.min_lat)
+        self.assertIsNone(other_tour.stats)
+
+        # Nothing changed, nothing rebuilt.
+        strava_poller._process_result(self.poll_state, results)
+        self.assertEqual(1, self.tour.stats.version)
+
+        results = {
+            "activity_infos": [],
+            "deleted_strava_ids": [986628180],
+            "state_update": {},
+        }
+        strava_poller._process_result(self.poll_state, results)
+        self.assertEqual(2, self.tour.stats.version)
+        self.assertEqual(len(shown) - 1, self.tour.stats.activity_count)
+        self.assertIsNone(other_tour.stats)
+
+    def test_process_result__upsert_tour_stats(self):
+        self._process_results_tour_stats(self.strava_poller)
+
+    def test_process_result__orm_tour_stats(self):
+        strava_poller = StravaPoller(self.session, self.strava_client_pool, upsert=False)
+        self._process_results_tour_stats(strava_poller)
+
+    def test_latest_fetch__skips_known_activities(self):
+        from tourmap_test.data import activity1_dict
+        self.poll_state.full_fetch_completed = True
+        self.poll_state.last_fetch_completed_at = datetime.datetime(2017, 11, 20)
+        activity = Activity(user=self.user, strava_id=activity1_dict["id"])
+        activity.update_from_strava(activity1_dict)
+        self.session.add(activity)
+        self.session.commit()
+
+        known_activities = self.strava_poller._get_known_activities(self.poll_state)
+        self.assertEqual({activity1_dict["id"]: (activity.content_hash, 1)},
+                         known_activities)
+
+        self.strava_client_mock.activities.return_value = [activity1_dict]
+        job = self.strava_poller._latest_fetch(
+            self.user.id,
+            self.token.access_token,
+            self.poll_state,
+            known_activities=known_activities,
+        )
+        result = self.strava_poller._run_job(self.strava_client_mock, job)
+        self.assertEqual([], result["activity_infos"])
+        self.strava_client_mock.activity_photos.assert_not_called()
+
+        # Another photo showed up...
+        activity_dict = dict(activity1_dict, total_photo_count=2)
+        self.strava_client_mock.activities.return_value = [activity_dict]
+        self.strava_client_mock.activity_photos.return_value = []
+        job = self.strava_poller._latest_fetch(
+            self.user.id,
+            self.token.access_token,
+            self.poll_state,
+            known_activities=known_activities,
+        )
+        result = self.strava_poller._run_job(self.strava_client_mock, job)
+        self.assertEqual(1, len(result["activity_infos"]))
+        self.assertEqual(2, self.strava_client_mock.activity_photos.call_count)
+
+    def test_process_result_future_rate_limited(self):
+        future = Future()
+        retry_at = dt2ts(datetime.datetime.utcnow()) + 60
+        future.set_exception(StravaRateLimited(retry_at=retry_at))
+        futures = {
+            self.poll_state.id: future,
+        }
+        self.strava_poller._process_result_futures(futures)
+
+        # No error and still due.
+        self.assertFalse(self.poll_state.error_happened)
+        self.assertIsNone(self.poll_state.last_fetch_completed_at)
+        self.assertIsNotNone(self.strava_poller._get_deferred_until())
+
+    def test_process_result_future_circuit_open(self):
+        future = Future()
+        retry_at = dt2ts(datetime.datetime.utcnow()) + 60
+        future.set_exception(StravaUnavailable(retry_at=retry_at))
+        self.strava_poller._process_result_futures({self.poll_state.id: future})
+
+        # Not counted as failure of the PollState.
+        self.assertFalse(self.poll_state.error_happened)
+        self.assertFalse(self.poll_state.consecutive_failures)
+        self.assertIsNotNone(self.strava_poller._get_deferred_until())
+        self.assertEqual(1, self.strava_poller.metrics.counter("jobs_circuit_open"))
+
+    def test_deferred_while_circuit_open(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=1, open_seconds=60)
+        strava_poller = StravaPoller(self.session, self.strava_client_pool,
+                                     circuit_breaker=circuit_breaker)
+        self.assertIsNone(strava_poller._get_deferred_until())
+        circuit_breaker.record_failure()
+        self.assertIsNotNone(strava_poller._get_deferred_until())
+
+    def _done_futures(self):
+        """
+        A done future for the PollStates of self.user and self.buser,
+        the latter one with a result that fails to be stored.
+        """
+        from tourmap_test.data import poller_crash_results1
+        bpoll_state = PollState(user=self.buser)
+        self.session.add(bpoll_state)
+        self.session.commit()
+
+        result = json.loads(dumps(poller_crash_results1))
+        result["state_update"]["last_fetch_completed_at"] = datetime.datetime.utcnow()
+        futures = {self.poll_state.id: Future(), bpoll_state.id: Future()}
+        futures[self.poll_state.id].set_result(result)
+        futures[bpoll_state.id].set_result({"state_update": {}})
+        return futures, bpoll_state
+
+    def test_write_results__group_commit(self):
+        futures, bpoll_state = self._done_futures()
+        futures[bpoll_state.id] = Future()
+        futures[bpoll_state.id].set_result({"activity_infos": [], "state_update": {}})
+        items = [(id, f, Future()) for id, f in futures.items()]
+
+        with unittest.mock.patch.object(self.session, "commit",
+                                        wraps=self.session.commit) as commit_mock:
+            self.strava_poller._write_results(items)
+        commit_mock.assert_called_once_with()
+
+        self.assertTrue(all(written.done() for _, _, written in items))
+        self.assertEqual(4, Activity.query.count())
+        self.assertIsNotNone(self.poll_state.next_poll_at)
+        self.assertFalse(bpoll_state.error_happened)
+
+    def test_write_results__one_by_one_after_failure(self):
+        futures, bpoll_state = self._done_futures()
+        items = [(id, f, Future()) for id, f in futures.items()]
+        self.strava_poller._write_results(items)
+
+        self.assertTrue(all(written.done() for _, _, written in items))
+        self.assertEqual(4, Activity.query.count())
+        self.assertFalse(self.poll_state.error_happened)
+        self.assertTrue(bpoll_state.error_happened)
+        self.assertEqual(1, self.strava_poller.metrics.counter("write_batch_fallbacks"))
+
+    def test_writer_thread(self):
+        futures, bpoll_state = self._done_futures()
+        strava_poller = StravaPoller(self.session, self.strava_client_pool,
+                                     writer_batch_size=10, writer_max_latency_seconds=0.1)
+        strava_poller._start_writer(self.app)
+        try:
+            self.assertTrue(strava_poller._process_result_futures(futures))
+            self.assertEqual({}, futures)
+            # Waiting to be written: Still leased and not submitted again.
+            self.assertEqual({self.poll_state.id, bpoll_state.id},
+                             set(strava_poller._get_submitted_ids()))
+        finally:
+            strava_poller._stop_writer()
+
+        self.assertFalse(strava_poller._has_submitted_ids())
+        self.session.expire_all()
+        self.assertEqual(4, Activity.query.count())
+        self.assertIsNotNone(self.poll_state.next_poll_at)
+        self.assertTrue(bpoll_state.error_happened)
+
+    def test_process_done_future__backoff(self):
+        now = datetime.datetime.utcnow()
+        strava_poller = StravaPoller(self.session, self.strava_client_pool,
+                                     error_backoff_base_seconds=60,
+                                     error_backoff_max_seconds=200)
+        failed = Future()
+        failed.set_exception(Exception("Broken"))
+
+        delays = []
+        with unittest.mock.patch.object(strava_poller, "_now", return_value=now), \
+                unittest.mock.patch.object(strava_poller, "_random", return_value=1.0):
+            for _ in range(4):
+                strava_poller._process_done_future(self.poll_state.id, failed)
+                delays.append((self.poll_state.next_poll_at - now).total_seconds())
+
+        self.assertEqual([60, 120, 200, 200], delays)
+        self.assertEqual(4, self.poll_state.consecutive_failures)
+
+        succeeded = Future()
+        succeeded.set_result({"activity_infos": [], "state_update": {}})
+        strava_poller._process_done_future(self.poll_state.id, succeeded)
+        self.assertFalse(self.poll_state.error_happened)
+        self.assertEqual(0, self.poll_state.consecutive_failures)
+
+        # The errors are still there.
+        errors = self.poll_state.errors.all()
+        self.assertEqual(4, len(errors))
+        self.assertEqual(["Unhandled Error"] * 4, [e.message for e in errors])
+
+    def test_get_retry_at__jitter(self):
+        now = datetime.datetime.utcnow()
+        self.poll_state.consecutive_failures = 2
+        patch = unittest.mock.patch.object
+        with patch(self.strava_poller, "_now", return_value=now), \
+                patch(self.strava_poller, "_random", return_value=0.0):
+            retry_at = self.strava_poller._get_retry_at(self.poll_state)
+        self.assertEqual(now + datetime.timedelta(seconds=60), retry_at)
+
+    def test_submit_limited_by_rate_limiter(self):
+        for user in [self.buser, self.cuser]:
+            token = Token(user=user, access_token=uuid.uuid4().hex)
+            self.session.add_all([token, PollState(user=user)])
+        for token in Token.query:
+            token.refresh_token = uuid.uuid4().hex
+            token.expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=6)
+        self.session.commit()
+
+        rate_limiter = RateLimiter(limits=(2, 1000))
+        strava_poller = StravaPoller(self.session, self.strava_client_pool,
+                                     rate_limiter=rate_limiter)
+        executor = unittest.mock.Mock()
+        executor.submit.side_effect = lambda fn, **kwargs: Future()
+        strava_poller._submit(executor)
+        self.assertEqual(2, executor.submit.call_count)
+
+        # Budget used up: Nothing is submitted, but deferred
+        for _ in range(2):
+            rate_limiter.try_acquire()
+        self.assertIsNotNone(strava_poller._get_deferred_until())
+        with unittest.mock.patch.object(strava_poller, "_submit") as submit_mock:
+            with unittest.mock.patch.object(strava_poller, "_wait"):
+                strava_poller._run_once(executor)
+            submit_mock.assert_not_called()
+
+    def test_submit_limited_by_concurrency(self):
+        for user in [self.buser, self.cuser]:
+            self.session.add_all([Token(user=user, access_token=uuid.uuid4().hex),
+                                  PollState(user=user)])
+        for token in Token.query:
+            token.refresh_token = uuid.uuid4().hex
+            token.expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=6)
+        self.session.commit()
+
+        strava_poller = StravaPoller(self.session, self.strava_client_pool,
+                                     min_concurrency=1, max_concurrency=2)
+        self.assertEqual(2, strava_poller.concurrency.limit)
+        executor = unittest.mock.Mock()
+        executor.submit.side_effect = lambda fn, **kwargs: Future()
+        strava_poller._submit(executor)
+        self.assertEqual(2, executor.submit.call_count)
+
+        # All slots busy
+        strava_poller._submit(executor)
+        self.assertEqual(2, executor.submit.call_count)
+
+    def test_submit__token_refresher(self):
+        self.token.refresh_token = uuid.uuid4().hex
+        self.token.expires_at = (
+            datetime.datetime.utcnow() + datetime.timedelta(minutes=30))
+        self.session.commit()
+
+        executor = unittest.mock.Mock()
+        executor.submit.side_effect = lambda fn, **kwargs: Future()
+        with unittest.mock.patch.object(TokenRefresher, "start"), \
+                unittest.mock.patch.object(TokenRefresher, "wake") as wake:
+            self.strava_poller._start_token_refresher(None)
+            self.strava_poller._submit(executor)
+
+        # No inline refresh, the refresher is asked to hurry up.
+        executor.submit.assert_not_called()
+        self.strava_client_mock.refresh_token.assert_not_called()
+        wake.assert_called_once_with()
+        self.assertIsNone(self.poll_state.lease_owner)
+        self.assertEqual(1, self.strava_poller.metrics.counter("jobs_waiting_for_token"))
+
+    def test_request__observed_by_concurrency(self):
+        strava_poller = StravaPoller(self.session, self.strava_client_pool,
+                                     min_concurrency=1, max_concurrency=8)
+        method = unittest.mock.Mock(return_value=[])
+        self.assertEqual([], strava_poller._request(method, "token", per_page=10))
+        method.assert_called_once_with("token", deadline=None, per_page=10)
+
+        method.side_effect = StravaRateLimited(retry_at=None)
+        with self.assertRaises(StravaRateLimited):
+            strava_poller._request(method, "token")
+        self.assertEqual(2, strava_poller._adjust_concurrency())
+        self.assertEqual(2, strava_poller.metrics.gauge("concurrency_limit"))
+        self.assertEqual(2, strava_poller.metrics.snapshot()[
+            "histograms"]["request_duration_seconds"]["count"])
+
+    def test_get_poll_states__fair_between_classes(self):
+        """
+        A signup wave does not crowd out latest fetches of existing users.
+        """
+        now = datetime.datetime.utcnow()
+        self.poll_state.full_fetch_completed = True
+        self.poll_state.next_poll_at = now - datetime.timedelta(minutes=5)
+        for i in range(10):
+            user = User(strava_id=1000 + i, email="new{}@strava.com".format(i))
+            self.session.add_all([user, PollState(user=user)])
+        self.session.commit()
+
+        strava_poller = StravaPoller(self.session, self.strava_client_pool,
+                                     scheduler_weights="latest=1,backfill=1")
+        poll_states = list(strava_poller._get_poll_states(limit=2))
+        self.assertEqual(2, len(poll_states))
+        self.assertIn(self.poll_state, poll_states)
+
+        gauge = strava_poller.metrics.gauge
+        self.assertEqual(1, gauge("queue_depth.latest"))
+        self.assertEqual(10, gauge("queue_depth.backfill"))
+        self.assertEqual(0, gauge("queue_depth.photos"))
+        self.assertEqual(1, strava_poller.metrics.counter("jobs_claimed.backfill"))
+        wait = strava_poller.metrics.snapshot()["histograms"]["wait_seconds.latest"]
+        self.assertEqual(1, wait["count"])
+        self.assertGreaterEqual(wait["sum"], 5 * 60)
+
+    def test_watchdog(self):
+        self.token.refresh_token = uuid.uuid4().hex
+        self.token.expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=6)
+        self.session.commit()
+        strava_poller = StravaPoller(self.session, self.strava_client_pool,
+                                     job_deadline_seconds=0)
+        executor = unittest.mock.Mock()
+        future = Future()
+        executor.submit.side_effect = lambda fn, **kwargs: future
+        strava_poller._submit(executor)
+        deadline = executor.submit.call_args[1]["deadline"]
+
+        # Not running yet, so not overdue.
+        self.assertEqual(0, strava_poller._check_deadlines())
+
+        deadline.start()
+        for _ in range(2):
+            self.assertEqual(1, strava_poller._check_deadlines())
+        self.assertTrue(deadline.cancelled)
+        self.assertEqual(1, self.poll_state.overrun_count)
+        self.assertIsNotNone(self.poll_state.last_overrun_at)
+        self.assertEqual(1, strava_poller.metrics.counter("job_overruns"))
+        self.assertEqual(1, strava_poller.metrics.gauge("stuck_slots"))
+
+        # The job notices with its next request.
+        with self.assertRaises(DeadlineExceeded):
+            deadline.check()
+        future.set_exception(DeadlineExceeded("Cancelled"))
+        strava_poller._process_result_futures({self.poll_state.id: future})
+        self.assertEqual("Deadline exceeded", self.poll_state.error_message)
+        self.assertIsNone(self.poll_state.lease_owner)
+        self.assertEqual(0, strava_poller._check_deadlines())
+
+    def test_fetch_activities__deadline(self):
+        with FakeStrava(activity_count=3, photo_count=1, latency=0.2) as fake_strava:
+            pool = self._fake_strava_pool(fake_strava)
+            strava_poller = StravaPoller(self.session, pool)
+            with self.assertRaises(DeadlineExceeded):
+                strava_poller.fetch_activities(self.user.id, self.token.access_token,
+                                               self.poll_state, deadline=Deadline(0.3))
+
+        # The listing and some photos, but not all of them.
+        self.assertLess(len(fake_strava.paths), 7)
+        histogram = strava_poller.metrics.snapshot()["histograms"]["job_duration_seconds"]
+        self.assertEqual(1, histogram["count"])
+        self.assertLess(histogram["sum"], 1.0)
+
+    def test_get_poll_states__leases(self):
+        self.session.add_all([PollState(user=self.buser), PollState(user=self.cuser)])
+        self.session.commit()
+
+        apoller = StravaPoller(self.session, self.strava_client_pool, poller_id="a")
+        bpoller = StravaPoller(self.session, self.strava_client_pool, poller_id="b")
+
+        # Disjoint batches.
+        astates = list(apoller._get_poll_states(limit=2))
+        bstates = list(bpoller._get_poll_states())
+        self.assertEqual(2, len(astates))
+        self.assertEqual(1, len(bstates))
+        self.assertNotIn(bstates[0].id, [s.id for s in astates])
+        self.assertTrue(all(s.lease_owner == "a" for s in astates))
+        self.assertEqual("b", bstates[0].lease_owner)
+
+        # Leased ones are not claimed again until released, not even
+        # by their owner.
+        self.assertEqual(0, len(list(apoller._get_poll_states())))
+        self.assertEqual(0, len(list(bpoller._get_poll_states())))
+        bstates[0].release_lease()
+        self.session.commit()
+        self.assertEqual(1, len(list(bpoller._get_poll_states())))
+
+        # Poller a died, its leases expire and b picks up.
+        past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        for state in astates:
+            state.lease_expires_at = past
+        self.session.commit()
+        self.assertEqual(2, len(list(bpoller._get_poll_states())))
+
+    def _claimed_by_other_poller_meanwhile(self, skip_locked):
+        other_lease_expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        claim = self.strava_poller._claim
+
+        def claim_after_other_poller(query, now):
+            # Another poller leases and commits between the candidate
+            # query and the claim.
+            self.session.query(PollState).update({
+                PollState.lease_owner: "other",
+                PollState.lease_expires_at: other_lease_expires_at,
+            }, synchronize_session=False)
+            self.session.commit()
+            return claim(query, now)
+
+        with unittest.mock.patch.object(self.strava_poller, "_claim",
+                                        side_effect=claim_after_other_poller), \
+                unittest.mock.patch("tourmap.database.supports_skip_locked",
+                                    return_value=skip_locked):
+            states = list(self.strava_poller._get_poll_states())
+
+        self.assertEqual([], states)
+        self.session.refresh(self.poll_state)
+        self.assertEqual("other", self.poll_state.lease_owner)
+        self.assertEqual(other_lease_expires_at, self.poll_state.lease_expires_at)
+
+    def test_get_poll_states__claimed_meanwhile(self):
+        self._claimed_by_other_poller_meanwhile(skip_locked=False)
+
+    def test_get_poll_states__claimed_meanwhile_skip_locked(self):
+        # SQLite ignores FOR UPDATE, the query still has to re-check.
+        self._claimed_by_other_poller_meanwhile(skip_locked=True)
+
+    def test_process_result__releases_lease(self):
+        states = list(self.strava_poller._get_poll_states())
+        self.assertEqual(1, len(states))
+        self.assertIsNotNone(self.poll_state.lease_owner)
+        self.strava_poller._process_result(self.poll_state, {
+            "activity_infos": [],
+            "state_update": {"last_fetch_completed_at": datetime.datetime.utcnow()},
+        })
+        self.assertIsNone(self.poll_state.lease_owner)
+        self.assertIsNone(self.poll_state.lease_expires_at)
+
+    def test_renew_leases(self):
+        executor = unittest.mock.Mock()
+        executor.submit.side_effect = lambda fn, **kwargs: Future()
+        self.token.refresh_token = uuid.uuid4().hex
+        self.token.expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=6)
+        self.session.commit()
+        self.strava_poller._submit(executor)
+        lease_expires_at = self.poll_state.lease_expires_at
+        self.assertIsNotNone(lease_expires_at)
+
+        later = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+        with unittest.mock.patch.object(self.strava_poller, "_now", return_value=later):
+            self.strava_poller._renew_leases()
+        self.session.expire_all()
+        self.assertGreater(self.poll_state.lease_expires_at, lease_expires_at)
@@ -0,0 +1,213 @@
+import datetime
+import uuid
+from concurrent.futures import Future
+
+import tourmap_test
+
+from tourmap.models import Activity, PollState, Token, User, WebhookEvent
+from tourmap.resources import db
+from tourmap.utils.objpool import ObjectPool
+from tourmap.utils.strava import StravaClient
+from tourmap.strava_poller import StravaPoller
+
+from tourmap_test.fake_strava import FakeStrava, WebhookEventGenerator
+
+
+class TestStravaWebhook(tourmap_test.TestCase):
+
+    def _get_app_config(self):
+        config = super()._get_app_config()
+        config["STRAVA_WEBHOOK_VERIFY_TOKEN"] = "VERIFY"
+        config["STRAVA_WEBHOOK_SUBSCRIPTION_ID"] = 4711
+        return config
+
+    def setUp(self):
+        super().setUp()
+        self.session = db.session
+        self.user = User(strava_id=123, email="auser@strava.com")
+        now = datetime.datetime.utcnow()
+        self.token = Token(user=self.user, access_token=uuid.uuid4().hex,
+                           refresh_token=uuid.uuid4().hex,
+                           expires_at=now + datetime.timedelta(hours=6))
+        self.poll_state = PollState(user=self.user, full_fetch_completed=True,
+                                    next_poll_at=now + datetime.timedelta(days=1))
+        self.session.add_all([self.user, self.token, self.poll_state])
+        self.session.commit()
+        self.events = WebhookEventGenerator(owner_id=self.user.strava_id)
+
+    def _post(self, event):
+        return self.client.post("/strava/webhook", json=event)
+
+    def _fetch(self, poller):
+        return poller.fetch_activities(
+            self.user.id, self.token.access_token, self.poll_state,
+            webhook_events=poller._get_webhook_events(self.poll_state),
+            athlete_id=self.user.strava_id)
+
+    def _run_job(self, poller):
+        future = Future()
+        try:
+            future.set_result(self._fetch(poller))
+        except Exception as e:
+            future.set_exception(e)
+        poller._process_done_future(self.poll_state.id, future)
+
+    def _poller(self, fake_strava):
+        pool = ObjectPool(
+            lambda: StravaClient("-1", "TEST", base_url=fake_strava.base_url))
+        return StravaPoller(self.session, pool, webhook_reconcile_interval_seconds=86400)
+
+    def test_validation(self):
+        response = self.client.get("/strava/webhook", query_string={
+            "hub.mode": "subscribe",
+            "hub.verify_token": "VERIFY",
+            "hub.challenge": "15f7d1a91c1f40f8a748fd134752feb3",
+        })
+        response.assertStatusCode(200)
+        self.assertEqual({"hub.challenge": "15f7d1a91c1f40f8a748fd134752feb3"},
+                         response.get_json())
+
+    def test_validation__bad_verify_token(self):
+        response = self.client.get("/strava/webhook", query_string={
+            "hub.mode": "subscribe",
+            "hub.verify_token": "WRONG",
+            "hub.challenge": "15f7d1a91c1f40f8a748fd134752feb3",
+        })
+        response.assertStatusCode(403)
+
+    def test_events_are_queued(self):
+        for event in [self.events.create(1), self.events.update(1, title="Messy"),
+                      self.events.delete(2)]:
+            self._post(event).assertStatusCode(200)
+
+        queued = WebhookEvent.query.order_by(WebhookEvent.id).all()
+        self.assertEqual([(1, "create"), (1, "update"), (2, "delete")],
+                         [(e.object_id, e.aspect_type) for e in queued])
+        self.assertEqual(datetime.datetime(2019, 10, 1, 12, 0, 3), queued[-1].event_time)
+
+    def test_unknown_athlete_ignored(self):
+        events = WebhookEventGenerator(owner_id=999)
+        self._post(events.create(1)).assertStatusCode(200)
+        self.assertEqual(0, WebhookEvent.query.count())
+
+    def test_bad_events(self):
+        response = self._post({"object_type": "activity", "subscription_id": 4711})
+        response.assertStatusCode(400)
+        self.client.post("/strava/webhook", data="garbage").assertStatusCode(400)
+        event = self.events.create(1)
+        event["subscription_id"] = 1
+        self._post(event).assertStatusCode(403)
+        self.assertEqual(0, WebhookEvent.query.count())
+
+    def test_deauthorize(self):
+        self._post(self.events.create(1))
+        self._post(self.events.deauthorize()).assertStatusCode(200)
+
+        # Only queued, the poller confirms it with Strava.
+        self.assertFalse(self.poll_state.stopped)
+        self.assertEqual([(1, "create"), (123, WebhookEvent.DEAUTHORIZE)],
+                         [(e.object_id, e.aspect_type)
+                          for e in WebhookEvent.query.order_by(WebhookEvent.id)])
+
+        with FakeStrava(activity_count=0, athlete_id=123) as fake_strava:
+            fake_strava.revoked_tokens.add(self.token.access_token)
+            self._run_job(self._poller(fake_strava))
+            self.assertEqual(["/api/v3/athlete"], fake_strava.paths)
+
+        self.assertTrue(self.poll_state.stopped)
+        self.assertTrue(self.poll_state.error_happened)
+        self.assertEqual(0, WebhookEvent.query.count())
+
+    def test_deauthorize_forged(self):
+        self._post(self.events.deauthorize()).assertStatusCode(200)
+
+        with FakeStrava(activity_count=0, athlete_id=123) as fake_strava:
+            self._run_job(self._poller(fake_strava))
+            self.assertEqual(1, fake_strava.served)
+
+        self.assertFalse(self.poll_state.stopped)
+        self.assertFalse(self.poll_state.error_happened)
+        self.assertEqual(0, WebhookEvent.query.count())
+
+    def test_disabled_without_verify_token(self):
+        self.app.config["STRAVA_WEBHOOK_VERIFY_TOKEN"] = None
+        self._post(self.events.create(1)).assertStatusCode(404)
+
+    def test_events_refused_without_subscription_id(self):
+        self.app.config["STRAVA_WEBHOOK_SUBSCRIPTION_ID"] = None
+        self._post(self.events.create(1)).assertStatusCode(404)
+        self._post(self.events.deauthorize()).assertStatusCode(404)
+        self.assertEqual(0, WebhookEvent.query.count())
+        self.assertFalse(self.poll_state.stopped)
+
+    def test_deauthorize_other_subscription(self):
+        event = self.events.deauthorize()
+        event["subscription_id"] = 1
+        self._post(event).assertStatusCode(403)
+        self.assertFalse(self.poll_state.stopped)
+
+    def test_poller_handles_events(self):
+        """
+        Events posted to the endpoint end up as activities through a
+        poller working against FakeStrava.
+        """
+        with FakeStrava(activity_count=3, athlete_id=123) as fake_strava:
+            poller = self._poller(fake_strava)
+            first, second = [a["id"] for a in fake_strava.activities[:2]]
+
+            self._post(self.events.create(first))
+            self._post(self.events.create(second))
+            self._post(self.events.update(second, title="Renamed"))
+            result = self._fetch(poller)
+            next_poll_at = self.poll_state.next_poll_at
+            poller._process_result(self.poll_state, result)
+
+            # Two activities, two requests and the reconciliation poll
+            # was not moved.
+            self.assertEqual(2, fake_strava.served)
+            self.assertEqual({first, second}, {a.strava_id for a in Activity.query})
+            self.assertEqual(0, WebhookEvent.query.count())
+            self.assertEqual(next_poll_at, self.poll_state.next_poll_at)
+
+            # A deleted activity and one Strava does not know anymore.
+            fake_strava.activities.pop(0)
+            self._post(self.events.delete(first))
+            self._post(self.events.update(99))
+            result = self._fetch(poller)
+            poller._process_result(self.poll_state, result)
+            self.assertEqual([second], [a.strava_id for a in Activity.query])
+            self.assertEqual(4, fake_strava.served)
+
+            # A delete event for an activity Strava still has deletes
+            # nothing.
+            self._post(self.events.delete(second))
+            result = self._fetch(poller)
+            poller._process_result(self.poll_state, result)
+            self.assertEqual([second], [a.strava_id for a in Activity.query])
+            self.assertEqual(0, WebhookEvent.query.count())
+
+    def test_poller_drops_activities_of_other_athletes(self):
+        with FakeStrava(activity_count=2, athlete_id=123) as fake_strava:
+            poller = self._poller(fake_strava)
+            fake_strava.activities[0]["athlete"]["id"] = 999
+            for a in fake_strava.activities:
+                self._post(self.events.create(a["id"]))
+            poller._process_result(self.poll_state, self._fetch(poller))
+
+            self.assertEqual([fake_strava.activities[1]["id"]],
+                             [a.strava_id for a in Activity.query])
+            self.assertEqual(0, WebhookEvent.query.count())
+
+    def test_poll_state_with_events_is_due(self):
+        poller = StravaPoller(self.session, strava_client_pool=None)
+        self.assertEqual([], list(poller._get_poll_states()))
+
+        self._post(self.events.create(1))
+        self.assertEqual([self.poll_state], list(poller._get_poll_states()))
+
+        # After an error, events wait for next_poll_at.
+        self.poll_state.release_lease()
+        self.poll_state.set_error("Failed", {})
+        self.session.commit()
+        self.assertEqual([], list(poller._get_poll_states()))
+        self.assertEqual([], poller._get_webhook_events(self.poll_state))
@@ -0,0 +1,126 @@
+import datetime
+import unittest.mock
+import uuid
+
+import tourmap_test
+
+from tourmap.models import User, PollState, Token
+from tourmap.resources import db
+from tourmap.utils import dt2ts
+from tourmap.utils.objpool import ObjectPool
+from tourmap.utils.strava import StravaClient, StravaBadRequest, StravaTimeout
+
+from tourmap.token_refresher import TokenRefresher
+
+from tourmap_test.fake_strava import FakeStrava
+
+
+class TestTokenRefresher(tourmap_test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = db.session
+        now = datetime.datetime.utcnow()
+
+        self.users = [User(strava_id=123 + i, email="user{}@strava.com".format(i))
+                      for i in range(4)]
+        self.tokens = [
+            # Expired, due, due within ahead_seconds, not due.
+            Token(user=self.users[0], access_token=uuid.uuid4().hex,
+                  refresh_token=uuid.uuid4().hex,
+                  expires_at=now - datetime.timedelta(hours=1)),
+            Token(user=self.users[1], access_token=uuid.uuid4().hex,
+                  refresh_token=uuid.uuid4().hex,
+                  expires_at=now + datetime.timedelta(minutes=30)),
+            Token(user=self.users[2], access_token=uuid.uuid4().hex,
+                  refresh_token=uuid.uuid4().hex,
+                  expires_at=now + datetime.timedelta(minutes=55)),
+            Token(user=self.users[3], access_token=uuid.uuid4().hex,
+                  refresh_token=uuid.uuid4().hex,
+                  expires_at=now + datetime.timedelta(hours=5)),
+        ]
+        self.poll_states = [PollState(user=u) for u in self.users]
+        self.session.add_all(self.users + self.tokens + self.poll_states)
+        self.session.commit()
+
+        self.expires_at = now + datetime.timedelta(hours=6)
+        self.strava_client_mock = unittest.mock.Mock(spec=StravaClient)
+        self.strava_client_mock.refresh_token.side_effect = lambda refresh_token: {
+            "access_token": "access-" + refresh_token,
+            "refresh_token": "refresh-" + refresh_token,
+            "expires_at": dt2ts(self.expires_at),
+        }
+        self.refresher = TokenRefresher(self.session,
+                                        ObjectPool(lambda: self.strava_client_mock),
+                                        ahead_seconds=15 * 60, batch_size=2)
+
+    def test_refresh_due(self):
+        refresh_tokens = [t.refresh_token for t in self.tokens]
+
+        self.assertEqual(3, self.refresher.refresh_due())
+
+        self.assertEqual(3, self.strava_client_mock.refresh_token.call_count)
+        for token, refresh_token in zip(self.tokens[:3], refresh_tokens):
+            self.assertEqual("access-" + refresh_token, token.access_token)
+            self.assertFalse(token.should_refresh())
+        self.assertEqual(refresh_tokens[3], self.tokens[3].refresh_token)
+        self.assertEqual(3, self.refresher.metrics.counter("tokens_refreshed"))
+
+        # Nothing left to do.
+        self.assertEqual(0, self.refresher.refresh_due())
+        self.assertEqual(3, self.strava_client_mock.refresh_token.call_count)
+
+    def test_refresh_due__first_fetch_and_stopped(self):
+        self.tokens[3].refresh_token = None
+        access_token = self.tokens[3].access_token
+        for poll_state in self.poll_states[:3]:
+            poll_state.stop()
+        self.session.commit()
+
+        self.assertEqual(1, self.refresher.refresh_due())
+        self.strava_client_mock.refresh_token.assert_called_once_with(access_token)
+
+    def test_refresh_due__rejected(self):
+        error = StravaBadRequest(400, "Bad Request", [
+            {"resource": "RefreshToken", "field": "refresh_token", "code": "invalid"}
+        ])
+        self.strava_client_mock.refresh_token.side_effect = error
+
+        self.assertEqual(0, self.refresher.refresh_due())
+
+        for poll_state in self.poll_states[:3]:
+            self.assertTrue(poll_state.stopped)
+            self.assertTrue(poll_state.error_happened)
+            self.assertEqual(400, poll_state.get_error_data()["status_code"])
+        self.assertFalse(self.poll_states[3].stopped)
+        self.assertEqual(3, self.refresher.metrics.counter("token_refresh_rejected"))
+
+    def test_refresh_due__retried(self):
+        self.strava_client_mock.refresh_token.side_effect = StravaTimeout()
+
+        self.assertEqual(0, self.refresher.refresh_due())
+
+        for poll_state in self.poll_states:
+            self.assertFalse(poll_state.stopped)
+            self.assertFalse(poll_state.error_happened)
+        self.assertTrue(self.tokens[0].should_refresh())
+        self.assertEqual(3, self.refresher.metrics.counter("token_refresh_errors"))
+
+    def test_ahead_seconds_capped(self):
+        refresher = TokenRefresher(self.session,
+                                   ObjectPool(lambda: self.strava_client_mock),
+                                   ahead_seconds=6 * 60 * 60)
+        # Strava would hand out the same token for the one expiring in
+        # 5 hours, which would then be refreshed in every round.
+        self.assertEqual(3, refresher.refresh_due())
+        self.assertEqual(0, refresher.refresh_due())
+
+    def test_refresh_due__fake_strava(self):
+        with FakeStrava() as fake_strava:
+            pool = ObjectPool(lambda: StravaClient("-1", "TEST",
+                                                   base_url=fake_strava.base_url))
+            refresher = TokenRefresher(self.session, pool, concurrency=2)
+            self.assertEqual(3, refresher.refresh_due())
+
+        for token in self.tokens:
+            self.assertFalse(token.should_refresh())
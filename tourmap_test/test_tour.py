@@ -1,6 +1,6 @@
 import tourmap_test
 
-from tourmap.models import Tour
+from tourmap.models import Tour, TourStats
 from tourmap.resources import db
 
 
@@ -72,6 +72,19 @@ class TestTour(tourmap_test.TestCase):
         self.assertEqual("2017-11-30", tour.start_date_str)
         self.assertEqual("2017-12-24", tour.end_date_str)
 
+    def test_users_create_tour_builds_stats(self):
+        form = {
+            "name": "Another test tour",
+            "start_date": "2017-10-01",
+        }
+        url = "/users/{}/tours".format(self.user1.hashid)
+        response = self.client.post(url, data=form)
+        response.assertStatusCode(303)
+
+        tour = Tour.query.filter_by(name="Another test tour").one()
+        self.assertEqual(1, tour.stats.version)
+        self.assertEqual(1, tour.stats.activity_count)
+
     def test_users_create_tour_twice_same_name(self):
         form = {
             "name": "TOUR_NAME",
@@ -162,6 +175,8 @@ class TestTour(tourmap_test.TestCase):
         response.assertIsRedirect(302, "/users/{}".format(self.user1.hashid))
 
     def test_delete_tour_http_delete_twice(self):
+        self.tour1.rebuild_stats()
+        db.session.commit()
         url = "/users/{}/tours/{}/delete".format(self.user1.hashid, self.tour1.hashid)
         response = self.client.post(url)
         response.assertIsRedirect(302, "/users/{}".format(self.user1.hashid))
@@ -169,6 +184,7 @@ class TestTour(tourmap_test.TestCase):
         response.assertStatusCode(404)
 
         self.assertFalse(Tour.query.count())
+        self.assertFalse(TourStats.query.count())
 
     def test_delete_tour_of_wrong_user(self):
         db.session.add(self.tour2)
@@ -215,6 +231,25 @@ class TestTour(tourmap_test.TestCase):
         tour1 = Tour.query.get(self.tour1.id)
         self.assertEqual("Changed Name", tour1.name)
 
+    def test_update_tour_rebuilds_stats(self):
+        url = "/users/{}/tours/{}".format(self.user1.hashid, self.tour1.hashid)
+        form = {
+            "name": "Changed Name",
+        }
+        response = self.client.post(url, data=form)
+        response.assertStatusCode(302)
+        tour1 = Tour.query.get(self.tour1.id)
+        self.assertEqual(1, tour1.stats.version)
+        self.assertEqual(1, tour1.stats.activity_count)
+
+        # activity1 is from 2017-10-18
+        form["start_date"] = "2018-01-01"
+        response = self.client.post(url, data=form)
+        response.assertStatusCode(302)
+        tour1 = Tour.query.get(self.tour1.id)
+        self.assertEqual(2, tour1.stats.version)
+        self.assertEqual(0, tour1.stats.activity_count)
+
     def test_update_tour_invalid_data(self):
         # Updating a tour by POSTING tour it's endpoint
         url = "/users/{}/tours/{}".format(self.user1.hashid, self.tour1.hashid)
@@ -1,12 +1,16 @@
 """
 Test the /users/{}/tours/{} endpoints
 """
+import base64
 import json
+import unittest.mock
+
 import tourmap_test
 
-from tourmap.models import ActivityPhotos
+from tourmap.models import Activity, ActivityPhotos, TourStats
 from tourmap.resources import db
 from tourmap.controllers import TourController
+from tourmap.utils import geometry, seconds_to_readable_interval
 
 
 class TestTourMap(tourmap_test.TestCase):
@@ -31,7 +35,7 @@ class TestTourMap(tourmap_test.TestCase):
         self.assertIn("photos", a)
         self.assertEqual(4, len(a["photos"]))
         self.assertIn("name", a)
-        self.assertIn("latlngs", a)
+        self.assertIn("packed_latlngs", a)
 
     def test_tour_controller_activity_none_activity_photos(self):
         result = self.tc.prepare_activities_for_map(self.tour2)["activities"]
@@ -41,7 +45,7 @@ class TestTourMap(tourmap_test.TestCase):
         self.assertIn("photos", a)
         self.assertEqual(0, len(a["photos"]))
         self.assertIn("name", a)
-        self.assertIn("latlngs", a)
+        self.assertIn("packed_latlngs", a)
 
     def test_tour_controller_activity_with_empty_activity_photos(self):
         activity = self.activity2
@@ -73,3 +77,177 @@ class TestTourMap(tourmap_test.TestCase):
         max_corner1 = settings["max_bounds"]["corner1"]
         max_corner2 = settings["max_bounds"]["corner2"]
         self.assertLess(max_corner1, max_corner2)
+
+    def test_tour_controller_packed(self):
+        activity = self.activity1
+        self.assertIsNone(activity.packed_latlngs)
+        unpacked = self.tc.prepare_activities_for_map(self.tour1)["activities"]
+
+        activity.pack_summary_polyline()
+        db.session.commit()
+        packed = self.tc.prepare_activities_for_map(self.tour1)["activities"]
+        self.assertEqual(unpacked, packed)
+        expected = geometry.pack_polyline(activity.summary_polyline)["packed_latlngs"]
+        self.assertEqual(expected, base64.b64decode(packed[0]["packed_latlngs"]))
+
+        latlngs = activity.latlngs
+        self.assertEqual([
+            (min(ll[0] for ll in latlngs), min(ll[1] for ll in latlngs)),
+            (max(ll[0] for ll in latlngs), max(ll[1] for ll in latlngs)),
+        ], packed[0]["bounds"])
+
+    def test_tour_controller_stats(self):
+        unstored = self.tc.prepare_activities_for_map(self.tour1)
+        self.assertEqual(seconds_to_readable_interval(self.moving_time1),
+                         unstored["totals"]["moving_time_str"])
+
+        self.activity1.pack_summary_polyline()
+        self.tour1.rebuild_stats()
+        db.session.commit()
+        data = self.tc.prepare_activities_for_map(self.tour1)
+        self.assertEqual(unstored["totals"], data["totals"])
+        settings = self.tc.get_map_settings(self.tour1, data["activities"])
+        self.assertEqual(data["activities"][0]["bounds"],
+                         [settings["bounds"]["corner1"], settings["bounds"]["corner2"]])
+
+        # Stored totals are used as they are.
+        self.tour1.stats.total_moving_time = 60
+        db.session.commit()
+        data = self.tc.prepare_activities_for_map(self.tour1)
+        self.assertEqual(seconds_to_readable_interval(60),
+                         data["totals"]["moving_time_str"])
+
+    def test_tour_controller_query_count(self):
+        def prepare_queries():
+            self.tour1.rebuild_stats()
+            db.session.commit()
+            db.session.expire_all()
+            with self.count_queries() as statements:
+                result = self.tc.prepare_activities_for_map(self.tour1)
+            return len(result["activities"]), statements
+
+        count, statements = prepare_queries()
+        self.assertEqual(1, count)
+
+        for i in range(1, 21):
+            activity = Activity(
+                user=self.user1,
+                strava_id=self.activity1.strava_id + i,
+                type="Ride",
+                name="Activity {}".format(i),
+                start_date=self.start_date1,
+                start_date_local=self.start_date_local1,
+                moving_time=self.moving_time1,
+                elapsed_time=self.elapsed_time1,
+                utc_offset=self.utc_offset1,
+                summary_polyline=self.activity1.summary_polyline,
+            )
+            photos = ActivityPhotos(user=self.user1, activity=activity,
+                                    data=json.dumps(self.photos1.get_photos()))
+            db.session.add_all([activity, photos])
+        db.session.commit()
+
+        count, more_statements = prepare_queries()
+        self.assertEqual(21, count)
+        self.assertEqual(len(statements), len(more_statements))
+        # The tour, its user and stats, and the activities with photos.
+        self.assertLessEqual(len(more_statements), 4)
+
+
+class TestTourMapCaching(tourmap_test.TestCase):
+    """
+    The tour page and its data.json. Static assets are not built here.
+    """
+
+    def _get_app_config(self):
+        config = super()._get_app_config()
+        config["ASSETS_DEBUG"] = True
+        return config
+
+    def setUp(self):
+        super().setUp()
+        db.session.add_all([self.user1, self.tour1, self.activity1, self.photos1])
+        db.session.add_all([self.user2, self.tour2, self.activity2])
+        db.session.commit()
+        self.tour_url = "/users/{}/tours/{}".format(self.user1.hashid, self.tour1.hashid)
+        self.data_url = self.tour_url + "/data.json"
+
+    def test_tour_page(self):
+        response = self.client.get(self.tour_url)
+        response.assertStatusCode(200)
+        response.assertHTML()
+        response.assertDataContains(b"data.json?v=1")
+        response.assertNotDataContains(b"packed_latlngs")
+        self.assertIn("private", response.headers["Cache-Control"])
+        self.assertIn("no-cache", response.headers["Cache-Control"])
+        self.assertNotIn("no-store", response.headers["Cache-Control"])
+
+        etag = response.headers["ETag"]
+        response = self.client.get(self.tour_url, headers={"If-None-Match": etag})
+        response.assertStatusCode(304)
+
+        self.tour1.rebuild_stats()
+        db.session.commit()
+        response = self.client.get(self.tour_url, headers={"If-None-Match": etag})
+        response.assertStatusCode(200)
+        response.assertDataContains(b"data.json?v=2")
+
+    def test_tour_data(self):
+        response = self.client.get(self.data_url)
+        response.assertStatusCode(200)
+        data = json.loads(response.data)
+        self.assertEqual(1, data["version"])
+        expected = TourController().prepare_activities_for_map(self.tour1)
+        self.assertEqual(expected["totals"], data["totals"])
+        self.assertEqual([a["packed_latlngs"] for a in expected["activities"]],
+                         [a["packed_latlngs"] for a in data["activities"]])
+        etag = response.headers["ETag"]
+        self.assertFalse(etag.startswith("W/"))
+        self.assertIn("no-cache", response.headers["Cache-Control"])
+        self.assertIn("private", response.headers["Cache-Control"])
+
+        response = self.client.get(self.data_url, headers={"If-None-Match": etag})
+        response.assertStatusCode(304)
+        self.assertEqual(b"", response.data)
+        self.assertEqual(etag, response.headers["ETag"])
+
+        # Changes to the tour bump the version.
+        self.tour1.rebuild_stats()
+        db.session.commit()
+        response = self.client.get(self.data_url, headers={"If-None-Match": etag})
+        response.assertStatusCode(200)
+        self.assertNotEqual(etag, response.headers["ETag"])
+        self.assertEqual(2, json.loads(response.data)["version"])
+
+    def test_tour_data_stats_built_concurrently(self):
+        compute = TourStats.compute
+
+        def compute_while_built_elsewhere(tour):
+            # By another request, committed right away.
+            db.engine.execute(TourStats.__table__.insert().values(
+                tour_id=tour.id, version=3))
+            return compute(tour)
+
+        with unittest.mock.patch.object(TourStats, "compute",
+                                        side_effect=compute_while_built_elsewhere):
+            response = self.client.get(self.data_url)
+        response.assertStatusCode(200)
+        self.assertEqual(3, json.loads(response.data)["version"])
+
+    def test_tour_data_versioned_public(self):
+        url = "/users/{}/tours/{}/data.json".format(self.user2.hashid, self.tour2.hashid)
+        response = self.client.get(url + "?v=1")
+        response.assertStatusCode(200)
+        cache_control = response.headers["Cache-Control"]
+        self.assertIn("public", cache_control)
+        self.assertIn("max-age=31536000", cache_control)
+
+        # An outdated version is served, but not cached.
+        response = self.client.get(url + "?v=0")
+        response.assertStatusCode(200)
+        self.assertIn("no-cache", response.headers["Cache-Control"])
+
+    def test_tour_data_wrong_user(self):
+        url = "/users/{}/tours/{}/data.json".format(self.user2.hashid, self.tour1.hashid)
+        response = self.client.get(url)
+        response.assertStatusCode(404)